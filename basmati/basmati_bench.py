@@ -0,0 +1,34 @@
+import logging
+from typing import List
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Names of the scales and benchmarks in `basmati.bench`, for the command line without importing it.
+SCALE_NAMES = ['small', 'medium', 'large']
+BENCHMARK_NAMES = ['find_upstream', 'find_downstream', 'area_select', 'is_downstream', 'is_downstream_many',
+                   'build_raster_from_geometries', 'build_weights_from_lon_lat', 'coarse_grain2d']
+
+
+def bench_main(scales: List[str], names: List[str] = None, repeat: int = 5, output: str = None) -> pd.DataFrame:
+    """Entry point for running basmati benchmarks on synthetic data.
+
+    Prints a table of timings (s) and peak memory (MiB) of each benchmark.
+
+    :param scales: scales to run at, keys of `basmati.bench.SCALES`
+    :param names: names of benchmarks to run (default: all)
+    :param repeat: number of timed runs of each benchmark
+    :param output: also write results to this CSV file, if given
+    :return: dataframe of results
+    """
+    # Slow import - only needed here.
+    from basmati.bench import run_benchmarks
+
+    logger.info('Running BASMATI benchmarks')
+    results = run_benchmarks(scales, names, repeat)
+    print(results.to_string(index=False, float_format='{:.4f}'.format))
+    if output:
+        logger.info(f'Writing results to: {output}')
+        results.to_csv(output, index=False)
+    return results
@@ -2,6 +2,7 @@ import argparse
 import sys
 from typing import List
 
+from basmati.basmati_bench import bench_main, BENCHMARK_NAMES, SCALE_NAMES
 from basmati.basmati_demo import demo_main
 from basmati.basmati_errors import BasmatiError
 from basmati.downloader import download_main, DATASETS, HYDROBASINS_REGIONS
@@ -38,6 +39,40 @@ def _build_parser() -> argparse.ArgumentParser:
     download_parser.add_argument('--delete-zip',
                                  action='store_true',
                                  help='Delete zipfile after unpacking')
+    download_parser.add_argument('--jobs', '-j',
+                                 type=int,
+                                 default=1,
+                                 help='Number of files to download at once')
+    download_parser.add_argument('--levels',
+                                 type=int,
+                                 nargs='+',
+                                 help='HydroBASINS levels to extract (default: all)')
+    download_parser.add_argument('--suffixes',
+                                 nargs='+',
+                                 help='File suffixes to extract, e.g. .shp .shx .dbf .prj (default: all)')
+    download_parser.add_argument('--cache-dir',
+                                 help='Convert extracted HydroBASINS shapefiles into columnar cache in this directory')
+    download_parser.add_argument('--verify',
+                                 action='store_true',
+                                 help='Check SHA-256 of all existing files against their manifests')
+
+    # bench
+    bench_parser = subparsers.add_parser('bench', help='Run benchmarks on synthetic data')
+    bench_parser.add_argument('--scales', '-s',
+                              nargs='+',
+                              choices=SCALE_NAMES,
+                              default=['small'],
+                              help='Scales of synthetic data to run at')
+    bench_parser.add_argument('--benchmarks', '-b',
+                              nargs='+',
+                              choices=BENCHMARK_NAMES,
+                              help='Benchmarks to run (default: all)')
+    bench_parser.add_argument('--repeat', '-n',
+                              type=int,
+                              default=5,
+                              help='Number of timed runs of each benchmark')
+    bench_parser.add_argument('--output', '-o',
+                              help='Write results to CSV file')
 
     # version
     version_parser = subparsers.add_parser('version', help='Print BASMATI version')
@@ -69,7 +104,10 @@ def basmati_cmd(argv: List[str] = sys.argv) -> None:
         if args.subcmd_name == 'demo':
             demo_main()
         elif args.subcmd_name in ['download', 'dl']:
-            download_main(args.dataset, args.region, args.delete_zip)
+            download_main(args.dataset, args.region, args.delete_zip, args.jobs,
+                          args.levels, args.suffixes, args.cache_dir, args.verify)
+        elif args.subcmd_name == 'bench':
+            bench_main(args.scales, args.benchmarks, args.repeat, args.output)
         elif args.subcmd_name == 'version':
             print(get_version(form='long' if args.long else 'short'))
 
@@ -0,0 +1,12 @@
+from basmati.bench.benchmarks import BENCHMARKS, Benchmark, run_benchmark, run_benchmarks
+from basmati.bench.synthetic import SCALES, synthetic_hydrobasins, random_polygons
+
+__all__ = [
+    'BENCHMARKS',
+    'Benchmark',
+    'run_benchmark',
+    'run_benchmarks',
+    'SCALES',
+    'synthetic_hydrobasins',
+    'random_polygons',
+]
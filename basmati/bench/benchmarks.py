@@ -0,0 +1,227 @@
+"""Benchmarks of the hot paths in `basmati.hydrosheds` and `basmati.utils`, run on synthetic data.
+
+Each benchmark is a class with `setup(scale)`, which builds its inputs (not timed), and `run()`, which is timed. This
+is the same layout as asv benchmarks, so that they can be tracked over time without the real HydroSHEDS data.
+"""
+import time
+import tracemalloc
+from logging import getLogger
+from typing import Iterable, List
+
+import numpy as np
+import pandas as pd
+from rasterio.transform import Affine
+
+from basmati.bench.synthetic import SCALES, synthetic_hydrobasins, random_polygons
+from basmati.hydrosheds import is_downstream, is_downstream_many
+from basmati.utils import build_raster_from_geometries, build_weights_from_lon_lat, coarse_grain2d
+
+logger = getLogger('basmati.bench')
+
+
+class Benchmark:
+    """Base class of benchmarks.
+
+    Subclasses set `name`, and `size` (the number of items, e.g. basins, that `run` processes) in `setup`.
+    """
+    name = None
+
+    def __init__(self) -> None:
+        self.size = None
+
+    def setup(self, scale: str) -> None:
+        """Build inputs for scale.
+
+        :param scale: key of `SCALES`
+        """
+        raise NotImplementedError
+
+    def run(self) -> None:
+        """Run the code being benchmarked."""
+        raise NotImplementedError
+
+
+class _HydrobasinsBenchmark(Benchmark):
+    num_queries = 100
+
+    def setup(self, scale: str) -> None:
+        params = SCALES[scale]
+        self.gdf = synthetic_hydrobasins(params['top_basins'], params['levels'], params['bounds'])
+        rng = np.random.default_rng(0)
+        self.pfaf_ids = rng.choice(self.gdf.PFAF_ID.values, self.num_queries)
+        self.size = len(self.gdf)
+
+
+class FindUpstream(_HydrobasinsBenchmark):
+    """`find_upstream` from random basins. The first run includes building the basin network."""
+    name = 'find_upstream'
+
+    def run(self) -> None:
+        for pfaf_id in self.pfaf_ids:
+            self.gdf.find_upstream(pfaf_id)
+
+
+class FindDownstream(_HydrobasinsBenchmark):
+    """`find_downstream` from random basins. The first run includes building the basin network."""
+    name = 'find_downstream'
+
+    def run(self) -> None:
+        for pfaf_id in self.pfaf_ids:
+            self.gdf.find_downstream(pfaf_id)
+
+
+class AreaSelect(_HydrobasinsBenchmark):
+    """`area_select` for 10 bands of area."""
+    name = 'area_select'
+
+    def setup(self, scale: str) -> None:
+        super().setup(scale)
+        edges = np.quantile(self.gdf.SUB_AREA.values, np.linspace(0, 1, 11))
+        self.bands = list(zip(edges[:-1], edges[1:]))
+
+    def run(self) -> None:
+        for min_area, max_area in self.bands:
+            self.gdf.area_select(min_area, max_area)
+
+
+class IsDownstream(_HydrobasinsBenchmark):
+    """`is_downstream` for random pairs of basins at the highest level."""
+    name = 'is_downstream'
+    num_pairs = 10000
+
+    def setup(self, scale: str) -> None:
+        super().setup(scale)
+        rng = np.random.default_rng(0)
+        pfaf_ids = self.gdf.PFAF_ID.values[self.gdf.LEVEL.values == self.gdf.LEVEL.max()]
+        self.pfaf_ids_a = rng.choice(pfaf_ids, self.num_pairs)
+        self.pfaf_ids_b = rng.choice(pfaf_ids, self.num_pairs)
+        self.size = self.num_pairs
+
+    def run(self) -> None:
+        for pfaf_id_a, pfaf_id_b in zip(self.pfaf_ids_a, self.pfaf_ids_b):
+            is_downstream(pfaf_id_a, pfaf_id_b)
+
+
+class IsDownstreamMany(IsDownstream):
+    """`is_downstream_many` for the same pairs as `IsDownstream`."""
+    name = 'is_downstream_many'
+
+    def run(self) -> None:
+        is_downstream_many(self.pfaf_ids_a, self.pfaf_ids_b)
+
+
+class _PolygonsBenchmark(Benchmark):
+    def setup(self, scale: str) -> None:
+        self.params = SCALES[scale]
+        self.polygons = random_polygons(self.params['polygons'], self.params['bounds'])
+        self.size = len(self.polygons)
+
+
+class BuildRaster(_PolygonsBenchmark):
+    """`build_raster_from_geometries` of random polygons."""
+    name = 'build_raster_from_geometries'
+
+    def setup(self, scale: str) -> None:
+        super().setup(scale)
+        lon_min, lat_min, lon_max, lat_max = self.params['bounds']
+        self.shape = self.params['raster_shape']
+        nlat, nlon = self.shape
+        self.tx = Affine((lon_max - lon_min) / nlon, 0, lon_min, 0, -(lat_max - lat_min) / nlat, lat_max)
+
+    def run(self) -> None:
+        build_raster_from_geometries(self.polygons, self.shape, self.tx)
+
+
+class BuildWeights(_PolygonsBenchmark):
+    """Sparse `build_weights_from_lon_lat` of random polygons."""
+    name = 'build_weights_from_lon_lat'
+
+    def run(self) -> None:
+        lon_min, lat_min, lon_max, lat_max = self.params['bounds']
+        nlat, nlon = self.params['weights_shape']
+        build_weights_from_lon_lat(self.polygons, lon_min, lon_max, lat_min, lat_max, nlon, nlat, sparse=True)
+
+
+class CoarseGrain2d(Benchmark):
+    """`coarse_grain2d` of a random raster by (10, 10)."""
+    name = 'coarse_grain2d'
+
+    def setup(self, scale: str) -> None:
+        self.arr = np.random.default_rng(0).random(SCALES[scale]['raster_shape'])
+        self.size = self.arr.size
+
+    def run(self) -> None:
+        coarse_grain2d(self.arr, (10, 10))
+
+
+BENCHMARKS = [FindUpstream, FindDownstream, AreaSelect, IsDownstream, IsDownstreamMany,
+              BuildRaster, BuildWeights, CoarseGrain2d]
+
+
+def run_benchmark(benchmark_cls: type, scale: str, repeat: int = 5) -> dict:
+    """Time benchmark at scale, and measure its peak memory.
+
+    `run` is timed repeat times, then run once more with tracemalloc to get the peak memory allocated by Python and
+    numpy (memory allocated by e.g. GEOS or GDAL is not seen).
+
+    :param benchmark_cls: `Benchmark` subclass
+    :param scale: key of `SCALES`
+    :param repeat: number of timed runs
+    :return: dict of results
+    """
+    if repeat < 1:
+        raise ValueError(f'repeat must be at least 1: {repeat}')
+    benchmark = benchmark_cls()
+    logger.debug(f'Setting up {benchmark.name} ({scale})')
+    benchmark.setup(scale)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        benchmark.run()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        benchmark.run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    logger.debug(f'{benchmark.name} ({scale}): min {min(times):.4f} s, peak {peak / 2**20:.1f} MiB')
+    return {
+        'name': benchmark.name,
+        'scale': scale,
+        'size': benchmark.size,
+        'first_s': times[0],
+        'min_s': min(times),
+        'median_s': float(np.median(times)),
+        'peak_mem_MiB': peak / 2**20,
+    }
+
+
+def run_benchmarks(scales: Iterable[str] = ('small',), names: Iterable[str] = None,
+                   repeat: int = 5) -> pd.DataFrame:
+    """Run benchmarks at each scale.
+
+    :param scales: keys of `SCALES`
+    :param names: names of benchmarks to run (default: all)
+    :param repeat: number of timed runs of each benchmark
+    :raises: ValueError if a scale or name is not recognized
+    :return: dataframe with one row of results per benchmark per scale
+    """
+    scales = list(scales)
+    for scale in scales:
+        if scale not in SCALES:
+            raise ValueError(f'Unknown scale {scale}, must be one of {list(SCALES)}')
+    benchmark_classes = {cls.name: cls for cls in BENCHMARKS}
+    if names is None:
+        names = list(benchmark_classes)
+    for name in names:
+        if name not in benchmark_classes:
+            raise ValueError(f'Unknown benchmark {name}, must be one of {list(benchmark_classes)}')
+
+    results = []
+    for scale in scales:
+        for name in names:
+            logger.info(f'Running {name} ({scale})')
+            results.append(run_benchmark(benchmark_classes[name], scale, repeat))
+    return pd.DataFrame(results)
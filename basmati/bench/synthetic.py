@@ -0,0 +1,152 @@
+"""Synthetic HydroBASINS-like datasets, for benchmarking without the real HydroSHEDS data.
+
+Basins are generated as random Pfafstetter trees: each basin is split into an odd number of sub-basins at the next
+level, with odd digits along the main stem (1 at the outlet) and even digits for the tributaries, which drain into
+the next odd digit down. Sub-basins are random strips of their parent, so geometries nest exactly.
+"""
+from typing import Tuple
+
+import geopandas as gpd
+import numpy as np
+import shapely
+
+# Approx. km per degree, used to give SUB_AREA realistic values.
+KM_PER_DEG = 111.32
+
+# Parameters of each scale of benchmark:
+# top_basins: number of level 1 basins
+# levels: number of Pfafstetter levels
+# polygons: (ny, nx) grid of random polygons
+# raster_shape: (nlat, nlon) of raster for `build_raster_from_geometries`
+# weights_shape: (nlat, nlon) of grid for `build_weights_from_lon_lat`
+# bounds: (lon_min, lat_min, lon_max, lat_max) of domain
+SCALES = {
+    'small': dict(top_basins=3, levels=4, polygons=(10, 10), raster_shape=(360, 720),
+                  weights_shape=(45, 90), bounds=(60, 0, 150, 45)),
+    'medium': dict(top_basins=9, levels=5, polygons=(30, 30), raster_shape=(1800, 3600),
+                   weights_shape=(180, 360), bounds=(60, 0, 150, 45)),
+    'large': dict(top_basins=9, levels=6, polygons=(100, 100), raster_shape=(5400, 10800),
+                  weights_shape=(360, 720), bounds=(60, 0, 150, 45)),
+}
+
+
+def _split_strips(rng: np.random.Generator, rects: np.ndarray, num_strips: np.ndarray, axis: int) -> np.ndarray:
+    # Split each rect (xmin, ymin, xmax, ymax) into num_strips random strips along axis (0: x, 1: y).
+    parent = np.repeat(np.arange(len(rects)), num_strips)
+    starts = np.cumsum(num_strips) - num_strips
+    # Gamma variates normalised within each parent are a Dirichlet sample, i.e. random fractions that sum to 1.
+    sizes = rng.gamma(4, size=len(parent))
+    cum_sizes = np.cumsum(sizes)
+    group_totals = np.add.reduceat(sizes, starts)
+    group_offsets = cum_sizes[starts] - sizes[starts]
+    upper = (cum_sizes - group_offsets[parent]) / group_totals[parent]
+    upper[starts + num_strips - 1] = 1
+    # Each strip starts exactly where the previous one ends.
+    lower = np.roll(upper, 1)
+    lower[starts] = 0
+
+    child_rects = rects[parent].copy()
+    lo = rects[parent, axis]
+    extent = rects[parent, axis + 2] - lo
+    child_rects[:, axis] = lo + lower * extent
+    child_rects[:, axis + 2] = lo + upper * extent
+    child_rects[starts + num_strips - 1, axis + 2] = rects[:, axis + 2]
+    return child_rects
+
+
+def synthetic_hydrobasins(top_basins: int = 9, levels: int = 4,
+                          bounds: Tuple[float, float, float, float] = (60, 0, 150, 45),
+                          region_code: int = 4, seed: int = 0) -> gpd.GeoDataFrame:
+    """Generate a random HydroBASINS-like geodataframe, with all levels from 1 to levels.
+
+    Has the same columns as `load_hydrobasins_geodataframe` that are used for analysis: `HYBAS_ID`, `NEXT_DOWN`,
+    `PFAF_ID`, `SUB_AREA`, `LEVEL`, `PFAF_STR` and `geometry` (boxes). Each basin has 3, 5, 7 or 9 sub-basins at the
+    next level, so there are about 6**(levels - 1) * top_basins basins at the highest level.
+
+    :param top_basins: number of level 1 basins (1-9), which all drain to the sea
+    :param levels: number of levels
+    :param bounds: (lon_min, lat_min, lon_max, lat_max) of domain that basins cover
+    :param region_code: first digit of `HYBAS_ID`
+    :param seed: random seed
+    :return: geodataframe of basins
+    """
+    if not 1 <= top_basins <= 9:
+        raise ValueError(f'top_basins must be between 1 and 9: {top_basins}')
+    rng = np.random.default_rng(seed)
+    rects = _split_strips(rng, np.array([bounds], dtype=float), np.array([top_basins]), 0)
+    pfaf_id = np.arange(1, top_basins + 1, dtype=np.int64)
+    next_down_pfaf = np.zeros(top_basins, dtype=np.int64)
+    level_data = [(pfaf_id, next_down_pfaf, rects)]
+
+    for level in range(2, levels + 1):
+        parent_pfaf, parent_next_down, parent_rects = level_data[-1]
+        num_children = rng.choice([3, 5, 7, 9], size=len(parent_pfaf))
+        parent = np.repeat(np.arange(len(parent_pfaf)), num_children)
+        digit = np.arange(len(parent)) - np.repeat(np.cumsum(num_children) - num_children, num_children) + 1
+        pfaf_id = parent_pfaf[parent] * 10 + digit
+
+        # Tributaries (even) drain into the main stem basin below them, main stem basins (odd) into the next one
+        # down. The outlet basin (1) drains into the headwater (highest digit) basin of the parent's downstream
+        # basin, where the parent joins it.
+        next_down_pfaf = np.where(digit % 2 == 0, pfaf_id - 1, pfaf_id - 2)
+        outlet = digit == 1
+        downstream_parent = parent_next_down[parent[outlet]]
+        # Parent Pfafstetter ids are generated in sorted order (0, for the sea, finds position 0, but is masked).
+        headwater_digit = num_children[np.searchsorted(parent_pfaf, downstream_parent)]
+        next_down_pfaf[outlet] = np.where(downstream_parent == 0, 0, downstream_parent * 10 + headwater_digit)
+        rects = _split_strips(rng, parent_rects, num_children, (level + 1) % 2)
+        level_data.append((pfaf_id, next_down_pfaf, rects))
+
+    pfaf_id = np.concatenate([d[0] for d in level_data])
+    next_down_pfaf = np.concatenate([d[1] for d in level_data])
+    rects = np.concatenate([d[2] for d in level_data])
+    level = np.concatenate([np.full(len(d[0]), i + 1, dtype=np.int64) for i, d in enumerate(level_data)])
+    # Ids look like real ones, e.g. 4030012345: region code, 2 digit level, then a sequence number.
+    hybas_id = region_code * 10**9 + level * 10**7 + np.arange(1, len(pfaf_id) + 1)
+    next_down = np.zeros_like(hybas_id)
+    drains = next_down_pfaf != 0
+    # Pfafstetter ids are unique across levels, as the number of digits is the level.
+    sort_idx = np.argsort(pfaf_id)
+    next_down[drains] = hybas_id[sort_idx[np.searchsorted(pfaf_id[sort_idx], next_down_pfaf[drains])]]
+
+    sub_area = (rects[:, 2] - rects[:, 0]) * (rects[:, 3] - rects[:, 1]) * KM_PER_DEG**2
+    gdf = gpd.GeoDataFrame({
+        'HYBAS_ID': hybas_id,
+        'NEXT_DOWN': next_down,
+        'PFAF_ID': pfaf_id,
+        'SUB_AREA': sub_area,
+        'LEVEL': level,
+    }, geometry=shapely.box(*rects.T), crs='epsg:4326')
+    gdf['PFAF_STR'] = gdf.PFAF_ID.apply(str)
+    return gdf
+
+
+def random_polygons(shape: Tuple[int, int], bounds: Tuple[float, float, float, float] = (60, 0, 150, 45),
+                    num_vertices: int = 32, seed: int = 0) -> np.ndarray:
+    """Generate one random star-shaped polygon in each cell of a grid.
+
+    The polygons have irregular edges, like basins, and do not overlap.
+
+    :param shape: (ny, nx) of grid
+    :param bounds: (lon_min, lat_min, lon_max, lat_max) of grid
+    :param num_vertices: number of vertices of each polygon
+    :param seed: random seed
+    :return: array of polygons, in row-major order from (lon_min, lat_min)
+    """
+    rng = np.random.default_rng(seed)
+    ny, nx = shape
+    lon_min, lat_min, lon_max, lat_max = bounds
+    dx = (lon_max - lon_min) / nx
+    dy = (lat_max - lat_min) / ny
+    y, x = np.mgrid[:ny, :nx]
+    centre_x = lon_min + (x.ravel() + 0.5 + rng.uniform(-0.1, 0.1, nx * ny)) * dx
+    centre_y = lat_min + (y.ravel() + 0.5 + rng.uniform(-0.1, 0.1, nx * ny)) * dy
+
+    theta = np.linspace(0, 2 * np.pi, num_vertices, endpoint=False)
+    # Radius as a fraction of cell size - polygons stay inside their (jittered) cell.
+    radius = rng.uniform(0.15, 0.4, (nx * ny, num_vertices))
+    coords = np.empty((nx * ny, num_vertices + 1, 2))
+    coords[:, :-1, 0] = centre_x[:, None] + radius * dx * np.cos(theta)
+    coords[:, :-1, 1] = centre_y[:, None] + radius * dy * np.sin(theta)
+    coords[:, -1] = coords[:, 0]
+    return shapely.polygons(coords)
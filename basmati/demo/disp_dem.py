@@ -7,7 +7,7 @@ import matplotlib.pyplot as plt
 import numpy as np
 
 from basmati.hydrosheds import load_hydrosheds_dem
-from basmati.utils import coarse_grain2d
+from basmati.utils import coarse_grain
 
 logger = logging.getLogger(__name__)
 
@@ -31,8 +31,7 @@ def disp_dem():
 
     ma_dem = np.ma.masked_array(dem, mask)
 
-    dem_coarse = coarse_grain2d(dem, (10, 10))
-    ma_dem_coarse = np.ma.masked_array(dem_coarse, dem_coarse < -1000)
+    ma_dem_coarse = coarse_grain(dem, (10, 10), mask=mask)
 
     plot_dem(ma_dem, 'DEM Asia at 30 s resolution (1 / 120 deg)', 'dem_asia_30s.png', extent)
     plot_dem(ma_dem_coarse, 
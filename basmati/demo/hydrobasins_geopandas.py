@@ -7,7 +7,7 @@ import cartopy.crs as ccrs
 import matplotlib.pyplot as plt
 import pandas as pd
 
-from basmati.hydrosheds import load_hydrobasins_geodataframe
+from basmati.hydrosheds import load_hydrobasins_geodataframe, attach_geometry
 
 logger = logging.getLogger(__name__)
 
@@ -22,13 +22,14 @@ def plot_selected_basins(hb_gdf):
 
     ax = plt.axes(projection=ccrs.PlateCarree())
     ax.coastlines()
-    upstream.plot(ax=ax)
-    downstream_furthest.plot(ax=ax, color='yellow')
+    # Only decode the geometries of the basins that are plotted.
+    attach_geometry(upstream).plot(ax=ax)
+    attach_geometry(downstream_furthest).plot(ax=ax, color='yellow')
 
     id_up_area_max = hb_gdf['UP_AREA'].idxmax()
-    hb_gdf.find_upstream(hb_gdf.loc[id_up_area_max].PFAF_ID).plot(ax=ax, color='red')
+    attach_geometry(hb_gdf.find_upstream(hb_gdf.loc[id_up_area_max].PFAF_ID)).plot(ax=ax, color='red')
 
-    hb_gdf[hb_gdf['NEXT_DOWN'] == 0].plot(ax=ax, color='k')
+    attach_geometry(hb_gdf[hb_gdf['NEXT_DOWN'] == 0]).plot(ax=ax, color='k')
 
     output_filename = 'basmati_demo_figs/hydrobasins_level8_selected_basins.png'
     logger.info(f'Saving figure to: {output_filename}')
@@ -61,7 +62,7 @@ def plot_basin_area_stats(hb_gdf):
 def hydrobasins_geopandas():
     logger.info(f'Running {__file__}: hydrobasins_geopandas()')
     hydrosheds_dir = os.getenv('HYDROSHEDS_DIR')
-    hb_gdf = load_hydrobasins_geodataframe(hydrosheds_dir, 'as', range(1, 9))
+    hb_gdf = load_hydrobasins_geodataframe(hydrosheds_dir, 'as', range(1, 9), geometry=False)
 
     plot_selected_basins(hb_gdf[hb_gdf.LEVEL == 8])
     plot_basin_area_stats(hb_gdf)
@@ -13,7 +13,8 @@ def basin_overlay_4349():
     logger.info(f'Running {__file__}: basin_overlay_4349()')
     hydrosheds_dir = os.getenv('HYDROSHEDS_DIR')
     hb_gdf = load_hydrobasins_geodataframe(hydrosheds_dir, 'as', range(4, 6))
-    bounds, tx, dem, mask = load_hydrosheds_dem(hydrosheds_dir, 'as')
+    # Only read the part of the DEM that is plotted.
+    bounds, tx, dem, mask = load_hydrosheds_dem(hydrosheds_dir, 'as', bounds=(90, 20, 115, 40))
     extent = (bounds.left, bounds.right, bounds.bottom, bounds.top)
 
     hb_gdf4 = hb_gdf[hb_gdf.LEVEL == 4]
@@ -1,19 +1,31 @@
+import hashlib
+import http.client
 import itertools
+import json
+import re
+import threading
+import time
+import warnings
+import zlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import os
 import zipfile
 from logging import getLogger
 from pathlib import Path
-from typing import Union
+from typing import Union, Iterable, Callable, Dict, List, Tuple
+from urllib.parse import urljoin, urlsplit, urlunsplit
 
 from basmati.basmati_errors import BasmatiError
-from basmati.utils import sysrun
+from basmati.version import get_version
+from basmati.zipstream import CHUNK_SIZE, GrowingFile, extract_zip_stream
 
 logger = getLogger('basmati.download')
 
 DATASETS = ['ALL', 'hydrosheds_dem_30s', 'hydrobasins_all_levels']
 HYDROBASINS_REGIONS = ['ALL', 'af', 'ar', 'as', 'au', 'eu', 'gr', 'na', 'sa', 'si']
 
-# These URLs are stable, but they won't download with requests. They WILL download using wget though.
+# These URLs are stable, and redirect to the files, which download_file follows.
 # Copied from: https://www.dropbox.com/sh/hmpwobbz9qixxpe/AAAI_jasMJPZl_6wX6d3vEOla?dl=0
 HYDROSHEDS_URLS = {
     'hydrosheds_dem_30s': {
@@ -52,32 +64,211 @@ HYDROSHEDS_URLS = {
     }
 }
 
+# Names of the members of each dataset's zip files, for finding files that were extracted without a manifest.
+HYDROSHEDS_MEMBER_GLOBS = {
+    'hydrosheds_dem_30s': '{region}_dem_30s*',
+    'hydrobasins_all_levels': 'hybas_{region}_lev*',
+}
 
-def download_file_wget(url: str, basedir: Path, filename: Path) -> Path:
+
+class ConnectionPool:
+    """Pool of keep-alive HTTP(S) connections, which can be shared between threads.
+
+    Idle connections are kept per (scheme, host, port), and reused for later requests to the same server.
+    """
+
+    def __init__(self, max_idle_per_host: int = 4, timeout: float = 60) -> None:
+        """Create empty pool.
+
+        :param max_idle_per_host: maximum number of idle connections to keep for each server
+        :param timeout: socket timeout, in s
+        """
+        self.max_idle_per_host = max_idle_per_host
+        self.timeout = timeout
+        self._idle = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def _get(self, key: Tuple[str, str, int]) -> Tuple[http.client.HTTPConnection, bool]:
+        with self._lock:
+            if self._idle[key]:
+                return self._idle[key].pop(), True
+        return self._new_connection(key), False
+
+    def _new_connection(self, key: Tuple[str, str, int]) -> http.client.HTTPConnection:
+        scheme, host, port = key
+        conn_cls = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        return conn_cls(host, port, timeout=self.timeout)
+
+    def release(self, key: Tuple[str, str, int], conn: http.client.HTTPConnection,
+                resp: http.client.HTTPResponse) -> None:
+        """Return a connection to the pool once its response has been read.
+
+        :param key: key from `ConnectionPool.request`
+        :param conn: connection
+        :param resp: response that has been read
+        """
+        with self._lock:
+            if not resp.will_close and resp.isclosed() and len(self._idle[key]) < self.max_idle_per_host:
+                self._idle[key].append(conn)
+                return
+        conn.close()
+
+    def request(self, url: str, headers: Dict[str, str] = None, max_redirects: int = 10):
+        """Send a GET request, following redirects.
+
+        :param url: URL to get
+        :param headers: request headers
+        :param max_redirects: maximum number of redirects to follow
+        :raises: BasmatiError if there are too many redirects
+        :return: tuple(key, connection, response) - response must be read then passed to `ConnectionPool.release`
+        """
+        for _ in range(max_redirects + 1):
+            parts = urlsplit(url)
+            default_port = 443 if parts.scheme == 'https' else 80
+            key = (parts.scheme, parts.hostname, parts.port or default_port)
+            path = urlunsplit(('', '', parts.path or '/', parts.query, ''))
+            conn, reused = self._get(key)
+            try:
+                try:
+                    conn.request('GET', path, headers=headers or {})
+                    resp = conn.getresponse()
+                except (http.client.RemoteDisconnected, ConnectionError):
+                    if not reused:
+                        raise
+                    # Server closed idle connection - retry on a new one.
+                    conn.close()
+                    conn = self._new_connection(key)
+                    conn.request('GET', path, headers=headers or {})
+                    resp = conn.getresponse()
+                if resp.status in (301, 302, 303, 307, 308) and resp.getheader('Location'):
+                    location = urljoin(url, resp.getheader('Location'))
+                    logger.debug(f'Redirected from {url} to {location}')
+                    resp.read()
+                    self.release(key, conn, resp)
+                    url = location
+                    continue
+            except BaseException:
+                # Do not leak the socket of a connection that failed.
+                conn.close()
+                raise
+            return key, conn, resp
+        raise BasmatiError(f'Too many redirects for {url}')
+
+    def close(self) -> None:
+        """Close all idle connections."""
+        with self._lock:
+            for conns in self._idle.values():
+                for conn in conns:
+                    conn.close()
+            self._idle.clear()
+
+
+_connection_pool = ConnectionPool()
+
+
+class DownloadCancelledError(BasmatiError):
+    """Download stopped because its cancel event was set"""
+
+
+def download_file(url: str, basedir: Path, filename: Path, pool: ConnectionPool = None,
+                  chunk_size: int = CHUNK_SIZE, progress_interval: float = 5,
+                  cancel: threading.Event = None) -> Path:
     """Downloads a file from a given URL to the desired basedir / filename.
 
-    Uses wget and system command because requests cannot resolve the redirects of the
-    stable dropbox links used by HydroSHEDS.
+    The file is streamed to basedir / <filename>.part in chunks of chunk_size bytes, and renamed to filename once
+    the download is complete. If the .part file already exists (e.g. from an interrupted download), the download is
+    resumed from the end of it using an HTTP Range request. Redirects are followed, and connections are kept alive
+    in pool so that later downloads from the same server reuse them. Progress and throughput are logged every
+    progress_interval s. If cancel is set, the download stops after the current chunk, leaving the .part file.
+
     See here for the base Dropbox directory:
     https://www.dropbox.com/sh/hmpwobbz9qixxpe/AAAI_jasMJPZl_6wX6d3vEOla?dl=0
 
     :param url: URL where file can be downloaded
     :param basedir: directory to download to
     :param filename: filename of file to download
+    :param pool: connection pool to use (default: shared module pool)
+    :param chunk_size: size of chunks to write, in bytes
+    :param progress_interval: time between progress messages, in s
+    :param cancel: set to stop the download
+    :raises: BasmatiError if file already exists, or download fails
+    :raises: DownloadCancelledError if cancel is set
     :return: filepath of downloaded file
     """
+    pool = pool or _connection_pool
     filepath = basedir / filename
     if filepath.exists():
         raise BasmatiError(f'{filepath} already exists')
-    cmd = f'wget {url} -O {filepath}'
-    logger.debug(cmd)
-    resp = sysrun(cmd)
-    logger.debug(resp)
-    logger.debug(resp.stdout)
-
+    partpath = basedir / f'{filename}.part'
+    offset = partpath.stat().st_size if partpath.exists() else 0
+
+    headers = {'User-Agent': f'basmati/{get_version()}', 'Accept-Encoding': 'identity'}
+    if offset:
+        logger.info(f'Resuming download of {filepath} from {offset} bytes')
+        headers['Range'] = f'bytes={offset}-'
+    key, conn, resp = pool.request(url, headers)
+    try:
+        if resp.status == 416 and offset:
+            # Range not satisfiable: .part file is already complete if it is the size of the whole file.
+            total = resp.getheader('Content-Range', '').rpartition('/')[2]
+            resp.read()
+            if total != str(offset):
+                raise BasmatiError(f'Cannot resume download of {filepath}: HTTP 416')
+            partpath.replace(filepath)
+            return filepath
+        if resp.status == 200:
+            # Server ignored Range header (or there was no .part file) - start from the beginning.
+            offset = 0
+        elif resp.status != 206 or not resp.getheader('Content-Range', '').startswith(f'bytes {offset}-'):
+            raise BasmatiError(f'Download of {url} failed: HTTP {resp.status} {resp.reason}')
+        length = resp.getheader('Content-Length')
+        total = offset + int(length) if length is not None else None
+
+        received = 0
+        start_time = last_report = time.monotonic()
+        with open(partpath, 'ab' if offset else 'wb') as f:
+            while True:
+                if cancel is not None and cancel.is_set():
+                    raise DownloadCancelledError(f'Download of {url} cancelled')
+                chunk = resp.read(chunk_size)
+                if not chunk:
+                    break
+                f.write(chunk)
+                received += len(chunk)
+                now = time.monotonic()
+                if now - last_report >= progress_interval:
+                    last_report = now
+                    rate = received / (now - start_time) / 2**20
+                    size = f'{(offset + received) / 2**20:.1f}'
+                    if total:
+                        size += f'/{total / 2**20:.1f} MiB ({100 * (offset + received) / total:.0f}%)'
+                    else:
+                        size += ' MiB'
+                    logger.info(f'{filename}: {size}, {rate:.1f} MiB/s')
+        if total is not None and offset + received != total:
+            raise BasmatiError(f'Incomplete download of {url}: got {offset + received} of {total} bytes')
+    finally:
+        pool.release(key, conn, resp)
+
+    elapsed = max(time.monotonic() - start_time, 1e-6)
+    logger.info(f'Downloaded {filepath}: {received / 2**20:.1f} MiB in {elapsed:.1f} s '
+                f'({received / elapsed / 2**20:.1f} MiB/s)')
+    partpath.replace(filepath)
     return filepath
 
 
+def download_file_wget(url: str, basedir: Path, filename: Path) -> Path:
+    """Deprecated alias of `download_file`, which no longer uses wget.
+
+    :param url: URL where file can be downloaded
+    :param basedir: directory to download to
+    :param filename: filename of file to download
+    :return: filepath of downloaded file
+    """
+    warnings.warn('download_file_wget is deprecated, use download_file', DeprecationWarning, stacklevel=2)
+    return download_file(url, basedir, filename)
+
+
 def unzip_file(basedir: Path, zipfilepath: Path) -> None:
     """Completely extract a zip file to a given basedir
 
@@ -88,34 +279,335 @@ def unzip_file(basedir: Path, zipfilepath: Path) -> None:
         zip_ref.extractall(str(basedir))
 
 
+def _sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _crc32(path: Path) -> int:
+    crc = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def file_record(path: Path, sha256: bool = True) -> dict:
+    """Record of a file's size, mtime and SHA-256, for a download manifest.
+
+    :param path: path to file
+    :param sha256: compute SHA-256 (`None` in record if False)
+    :return: record of file
+    """
+    stat = path.stat()
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': _sha256(path) if sha256 else None}
+
+
+def verify_file(path: Path, record: dict, full: bool = False) -> bool:
+    """Check a file against its manifest record.
+
+    Files with the recorded size and mtime are assumed to be unchanged unless full is set. Otherwise, the SHA-256
+    of the file is checked - files whose record has no SHA-256 cannot be checked, and do not match.
+
+    :param path: path to file
+    :param record: record from `file_record`, or `None` if there is no record
+    :param full: always check SHA-256
+    :return: True if the file matches its record
+    """
+    if record is None:
+        return False
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return False
+    if stat.st_size != record['size']:
+        return False
+    if not full and stat.st_mtime_ns == record['mtime_ns']:
+        return True
+    return record['sha256'] is not None and _sha256(path) == record['sha256']
+
+
+def member_filter(levels: Iterable[int] = None, suffixes: Iterable[str] = None) -> Callable[[str], bool]:
+    """Filter for zip members, by HydroBASINS level and/or file suffix.
+
+    Members that do not have a level in their name (e.g. DEM files) are only filtered by suffix.
+
+    :param levels: HydroBASINS levels to keep, all if `None`
+    :param suffixes: suffixes to keep (e.g. `['.shp', '.dbf']`), all if `None`
+    :return: function that returns True for zip member names to keep
+    """
+    levels = None if levels is None else set(levels)
+    suffixes = None if suffixes is None else {suffix.lower() for suffix in suffixes}
+
+    def keep(name: str) -> bool:
+        if suffixes is not None and Path(name).suffix.lower() not in suffixes:
+            return False
+        match = re.search(r'_lev(\d\d)_', name)
+        if levels is not None and match and int(match.group(1)) not in levels:
+            return False
+        return True
+    return keep
+
+
 class UnrecognizedRegionError(BasmatiError):
     """Region not one of the know 2-digit codes in `HYDROBASINS_REGIONS`"""
 
 
 class HydroshedsDownloader:
     """Downloads and unzips HydroSHEDS dataset files from Dropbox
+
+    Zip files are extracted while they are being downloaded: each member is written out as soon as all of its bytes
+    have arrived.
+
+    After each dataset/region has been fetched, a manifest of the files in it (with their sizes and SHA-256) is
+    written to `.basmati_manifests` in hydrosheds_dir. On later runs, the files are verified against the manifest,
+    and only those that are missing or corrupt are extracted again (from the zip file, if it was kept and is intact)
+    or downloaded again. The zip file is only needed if some files are missing or corrupt.
+
+    If there is no manifest, e.g. the files were downloaded by an older version of basmati, one is made from the
+    files that are already there. Their sizes are checked against the zip file if it is there, and their SHA-256 is
+    only computed (and their CRC checked against the zip file) with full_verify.
     """
     # N.B. more restrictive than HYDROBASINS_REGIONS
     hydrosheds_30s_regions = ['af', 'ar', 'as', 'au', 'eu', 'na', 'sa']
-
-    def __init__(self, hydrosheds_dir: Union[str, Path], delete_zip: bool) -> None:
+    # Files of a HydroBASINS shapefile that are needed to build its cache (.prj is optional).
+    shapefile_suffixes = {'.shp', '.shx', '.dbf'}
+    manifest_dirname = '.basmati_manifests'
+
+    def __init__(self, hydrosheds_dir: Union[str, Path], delete_zip: bool,
+                 levels: Iterable[int] = None, suffixes: Iterable[str] = None,
+                 cache_dir: Union[str, Path] = None, full_verify: bool = False,
+                 verify_workers: int = 8) -> None:
         """Creates instance to download data to a given hydrosheds_dir.
 
         :param hydrosheds_dir: directory to download data to - must exist
         :raises: BasmatiError if hydrosheds_dir does not exist
         :param delete_zip: delete zipfiles after download and extract
+        :param levels: only extract these HydroBASINS levels (all if `None`)
+        :param suffixes: only extract files with these suffixes (all if `None`)
+        :param cache_dir: convert each extracted HydroBASINS shapefile into the columnar cache in this directory
+        :param full_verify: check SHA-256 of every existing file, even if its size and mtime are unchanged
+        :param verify_workers: number of files to verify at once
         """
         self.hydrosheds_dir = Path(hydrosheds_dir)
         self.delete_zip = delete_zip
+        self.member_filter = member_filter(levels, suffixes)
+        self.cache_dir = cache_dir
+        self.full_verify = full_verify
+        self.verify_workers = verify_workers
         if not self.hydrosheds_dir.exists():
             raise BasmatiError(f'{self.hydrosheds_dir} does not exist')
 
-    def _unzip_file(self, filename: Path) -> None:
-        logger.info(f'Unzipping {filename}')
-        unzip_file(self.hydrosheds_dir, filename)
-        if self.delete_zip:
-            logger.info(f'Deleting {filename}')
-            filename.unlink()
+    def _convert_shapefile(self, shp_path: Path, converted: set) -> None:
+        # Slow import - only needed here.
+        from basmati.hydrosheds import build_hydrobasins_cache
+        logger.info(f'Converting {shp_path} to cache')
+        build_hydrobasins_cache(shp_path, self.cache_dir)
+        converted.add(shp_path)
+
+    def _on_member(self, path: Path, extracted: set, converted: set) -> None:
+        # Convert a shapefile as soon as all of the files that it needs have been extracted.
+        if self.cache_dir is None or not path.name.startswith('hybas_'):
+            return
+        extracted.add(path)
+        shp_path = path.with_suffix('.shp')
+        if all(shp_path.with_suffix(suffix) in extracted for suffix in self.shapefile_suffixes):
+            self._convert_shapefile(shp_path, converted)
+
+    def _convert_remaining(self, extracted: set, converted: set) -> None:
+        # Convert shapefiles that had some files extracted, and the rest extracted by an earlier run. This is only
+        # done once extraction has finished, so that none of their files are still going to be replaced.
+        shp_paths = {path.with_suffix('.shp') for path in extracted if path.suffix in self.shapefile_suffixes}
+        for shp_path in sorted(shp_paths - converted):
+            if all(shp_path.with_suffix(suffix).exists() for suffix in self.shapefile_suffixes):
+                self._convert_shapefile(shp_path, converted)
+
+    def _extract(self, zippath: Path, keep: Callable[[str], bool], url: str = None) -> List[str]:
+        # Extract members for which keep is True from zippath, downloading it from url at the same time if given.
+        # Returns the names of all members of zippath.
+        names = []
+
+        def record_and_keep(name: str) -> bool:
+            names.append(name)
+            return keep(name)
+
+        partpath = zippath.with_name(f'{zippath.name}.part')
+        done = threading.Event()
+        extracted = set()
+        converted = set()
+
+        def on_member(path: Path) -> None:
+            self._on_member(path, extracted, converted)
+
+        if url is None:
+            logger.info(f'Extracting from {zippath}')
+            done.set()
+            with GrowingFile(partpath, zippath, done) as stream:
+                extract_zip_stream(stream, self.hydrosheds_dir, record_and_keep, on_member)
+            self._convert_remaining(extracted, converted)
+            return names
+
+        logger.info(f'Downloading from {url}')
+        cancel = threading.Event()
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            download = pool.submit(download_file, url, self.hydrosheds_dir, Path(zippath.name), cancel=cancel)
+            download.add_done_callback(lambda _: done.set())
+            try:
+                with GrowingFile(partpath, zippath, done) as stream:
+                    extract_zip_stream(stream, self.hydrosheds_dir, record_and_keep, on_member)
+            except BaseException as e:
+                # Stop downloading, rather than reporting the error once the whole file has arrived.
+                cancel.set()
+                download_error = download.exception()
+                if download_error is not None and not isinstance(download_error, DownloadCancelledError):
+                    # Errors from the download take precedence, as they will cause errors in extraction. The .part
+                    # file is kept, so that the download can be resumed.
+                    raise download_error from e
+                if isinstance(e, BasmatiError):
+                    # The zip file is corrupt - remove it, as resuming from it would fail in the same way.
+                    for path in [partpath, zippath]:
+                        if path.exists():
+                            logger.info(f'Removing corrupt {path}')
+                            path.unlink()
+                raise
+            download.result()
+        self._convert_remaining(extracted, converted)
+        logger.info(f'Downloaded and extracted {zippath}')
+        return names
+
+    def _verify(self, files: Dict[Path, dict]) -> set:
+        # Verify files against their records in parallel, returning the paths that fail.
+        with ThreadPoolExecutor(max_workers=self.verify_workers) as pool:
+            results = pool.map(lambda item: verify_file(*item, full=self.full_verify), files.items())
+            return {path for path, ok in zip(files, results) if not ok}
+
+    def _member_name(self, path: Path) -> str:
+        return path.relative_to(self.hydrosheds_dir).as_posix()
+
+    def manifest_path(self, dataset: str, region: str) -> Path:
+        """Path of manifest for dataset and region.
+
+        :param dataset: HydroSHEDS dataset
+        :param region: 2 character region code
+        :return: path of manifest
+        """
+        return self.hydrosheds_dir / self.manifest_dirname / f'{dataset}.{region}.json'
+
+    def _write_manifest(self, manifest_path: Path, manifest: dict) -> None:
+        manifest_path.parent.mkdir(exist_ok=True)
+        tmp_path = manifest_path.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps(manifest, indent=2))
+        tmp_path.replace(manifest_path)
+
+    def _bootstrap_manifest(self, dataset: str, region: str, url: str, zippath: Path) -> Union[dict, None]:
+        # Make a manifest of the wanted members that are already there. The names of all members are taken from the
+        # zip file if it can be read, and otherwise from the files that match the dataset's member names.
+        zip_infos = None
+        if zippath.exists():
+            try:
+                with zipfile.ZipFile(zippath) as zf:
+                    zip_infos = {info.filename: info for info in zf.infolist()}
+            except (zipfile.BadZipFile, OSError):
+                logger.info(f'Cannot read {zippath}')
+        if zip_infos is not None:
+            all_members = list(zip_infos)
+        else:
+            pattern = HYDROSHEDS_MEMBER_GLOBS[dataset].format(region=region)
+            all_members = sorted(self._member_name(path) for path in self.hydrosheds_dir.glob(pattern)
+                                 if path.is_file() and path.suffix not in ('.zip', '.part', '.tmp'))
+
+        def existing_record(name: str) -> Union[dict, None]:
+            path = self.hydrosheds_dir / name
+            if not path.is_file():
+                return None
+            if zip_infos is not None:
+                if path.stat().st_size != zip_infos[name].file_size:
+                    return None
+                if self.full_verify and _crc32(path) != zip_infos[name].CRC:
+                    return None
+            return file_record(path, self.full_verify)
+
+        wanted = [name for name in all_members if not name.endswith('/') and self.member_filter(name)]
+        with ThreadPoolExecutor(max_workers=self.verify_workers) as pool:
+            members = {name: record for name, record in zip(wanted, pool.map(existing_record, wanted)) if record}
+        if not members:
+            return None
+        logger.info(f'{dataset} {region}: making manifest from {len(members)} existing files')
+        # A zip file that can be read is used to extract missing members - extracting checks their CRCs.
+        zip_record = file_record(zippath, self.full_verify) if zip_infos is not None else None
+        return {'url': url, 'zip': zip_record, 'all_members': all_members, 'members': members}
+
+    def _fetch(self, dataset: str, region: str) -> None:
+        if region not in HYDROSHEDS_URLS[dataset]:
+            raise UnrecognizedRegionError(f'No URL for {dataset} {region}')
+        url, filename = HYDROSHEDS_URLS[dataset][region]
+        zippath = self.hydrosheds_dir / filename
+        manifest_path = self.manifest_path(dataset, region)
+        bootstrapped = False
+        if manifest_path.exists():
+            manifest = json.loads(manifest_path.read_text())
+        else:
+            manifest = self._bootstrap_manifest(dataset, region, url, zippath)
+            bootstrapped = manifest is not None
+            if not bootstrapped:
+                manifest = {'url': url, 'zip': None, 'all_members': None, 'members': {}}
+
+        keep = self.member_filter
+        zip_ok = False
+        if manifest['all_members'] is not None:
+            wanted = [name for name in manifest['all_members'] if self.member_filter(name)]
+            files = {self.hydrosheds_dir / name: manifest['members'].get(name) for name in wanted}
+            logger.debug(f'Verifying {len(files)} files for {dataset} {region}')
+            if bootstrapped:
+                # Records of the files that are there have just been made.
+                bad = {path for path, record in files.items() if record is None}
+            else:
+                bad = self._verify(files)
+            if not bad:
+                logger.info(f'{dataset} {region} up to date')
+                if bootstrapped:
+                    self._write_manifest(manifest_path, manifest)
+                return
+            bad_names = {self._member_name(path) for path in bad}
+            logger.info(f'{dataset} {region}: {len(bad)} files missing or corrupt')
+            # The zip file is only needed now.
+            zip_ok = verify_file(zippath, manifest['zip'], self.full_verify)
+
+            def keep(name: str) -> bool:
+                return name in bad_names
+        elif zippath.exists():
+            # No manifest or existing files, e.g. a zip file that was downloaded but not extracted - extracting checks
+            # the CRC of every member.
+            zip_ok = True
+
+        if zip_ok:
+            names = self._extract(zippath, keep)
+        else:
+            if zippath.exists():
+                logger.info(f'Removing corrupt {zippath}')
+                zippath.unlink()
+            names = self._extract(zippath, keep, url)
+
+        # Record every member that was extracted, and the zip file.
+        manifest['all_members'] = names
+        paths = [self.hydrosheds_dir / name for name in names
+                 if not name.endswith('/') and keep(name) and (self.hydrosheds_dir / name).exists()]
+        if zippath.exists():
+            paths.append(zippath)
+        with ThreadPoolExecutor(max_workers=self.verify_workers) as pool:
+            records = dict(zip(paths, pool.map(file_record, paths)))
+        manifest['members'].update({self._member_name(path): record
+                                    for path, record in records.items() if path != zippath})
+        if zippath in records:
+            manifest['zip'] = records[zippath]
+        self._write_manifest(manifest_path, manifest)
+
+        if self.delete_zip and zippath.exists():
+            logger.info(f'Deleting {zippath}')
+            zippath.unlink()
 
     def download_hydrosheds_dem_30s(self, region: str) -> None:
         """Download 30s Digital Elevation Model for region.
@@ -127,13 +619,7 @@ class HydroshedsDownloader:
                    f'{", ".join(self.hydrosheds_30s_regions)}')
             raise UnrecognizedRegionError(msg)
 
-        url, filename = HYDROSHEDS_URLS['hydrosheds_dem_30s'][region]
-        logger.info(f'Downloading from {url}')
-        filepath = download_file_wget(url, self.hydrosheds_dir, Path(filename))
-        logger.info(f'Downloaded {filepath}')
-
-        if filepath.suffix == '.zip':
-            self._unzip_file(filepath)
+        self._fetch('hydrosheds_dem_30s', region)
 
     def download_hydrobasins_all_levels(self, region: str) -> None:
         """Download HydroBASINS dataset, levels 1-12.
@@ -145,28 +631,41 @@ class HydroshedsDownloader:
                    f'{", ".join(self.hydrosheds_30s_regions)}')
             raise UnrecognizedRegionError(msg)
 
-        url, filename = HYDROSHEDS_URLS['hydrobasins_all_levels'][region]
-        logger.info(f'Downloading from {url}')
-        filepath = download_file_wget(url, self.hydrosheds_dir, Path(filename))
-        logger.info(f'Downloaded {filepath}')
+        self._fetch('hydrobasins_all_levels', region)
 
-        if filepath.suffix == '.zip':
-            self._unzip_file(filepath)
 
+def _download_dataset_region(downloader: HydroshedsDownloader, dataset: str, region: str) -> None:
+    logger.info(f'Downloading: {dataset}, {region}')
 
-def download_main(dataset: str, region: str, delete_zip: bool) -> None:
+    try:
+        if dataset == 'hydrosheds_dem_30s':
+            downloader.download_hydrosheds_dem_30s(region)
+        elif dataset == 'hydrobasins_all_levels':
+            downloader.download_hydrobasins_all_levels(region)
+    except UnrecognizedRegionError:
+        logger.info(f'  {dataset} {region} not found')
+
+
+def download_main(dataset: str, region: str, delete_zip: bool, jobs: int = 1,
+                  levels: Iterable[int] = None, suffixes: Iterable[str] = None,
+                  cache_dir: Union[str, Path] = None, full_verify: bool = False) -> None:
     """Entry point for downloading HydroSHEDS datasets for the given region
 
     Relies on HYDROSHEDS_DIR env var being set.
 
     e.g.:
-    $ basmati download -d <dataset> -r <region>
+    $ basmati download -d <dataset> -r <region> -j <jobs>
 
     :raises: BasmatiError if HYDROSHEDS_DIR not set
     :raises: BasmatiError region or dataset not recognized
     :param dataset: HydroSHEDS dataset to download
     :param region: 2 character region code
     :param delete_zip: delete downloaded zipfiles after extract
+    :param jobs: number of files to download at once
+    :param levels: only extract these HydroBASINS levels (all if `None`)
+    :param suffixes: only extract files with these suffixes (all if `None`)
+    :param cache_dir: convert extracted HydroBASINS shapefiles into the columnar cache in this directory
+    :param full_verify: check SHA-256 of all existing files against their manifests
     """
     hydrosheds_dir = os.getenv('HYDROSHEDS_DIR')
     if not hydrosheds_dir:
@@ -186,12 +685,17 @@ def download_main(dataset: str, region: str, delete_zip: bool) -> None:
         logger.error(msg)
         raise BasmatiError(msg)
 
+    if jobs < 1:
+        msg = f'jobs must be at least 1, not {jobs}'
+        logger.error(msg)
+        raise BasmatiError(msg)
+
     hydrosheds_dirpath = Path(hydrosheds_dir)
     if not hydrosheds_dirpath.exists():
         logger.info(f'Creating {hydrosheds_dirpath}')
         hydrosheds_dirpath.mkdir(parents=True)
 
-    downloader = HydroshedsDownloader(hydrosheds_dirpath, delete_zip)
+    downloader = HydroshedsDownloader(hydrosheds_dirpath, delete_zip, levels, suffixes, cache_dir, full_verify)
     if dataset == 'ALL':
         datasets = DATASETS[1:]
     else:
@@ -201,13 +705,14 @@ def download_main(dataset: str, region: str, delete_zip: bool) -> None:
     else:
         regions = [region]
 
-    for dataset, region in itertools.product(datasets, regions):
-        logger.info(f'Downloading: {dataset}, {region}')
-
-        try:
-            if dataset == 'hydrosheds_dem_30s':
-                downloader.download_hydrosheds_dem_30s(region)
-            elif dataset == 'hydrobasins_all_levels':
-                downloader.download_hydrobasins_all_levels(region)
-        except UnrecognizedRegionError:
-            logger.info(f'  {dataset} {region} not found')
+    if jobs == 1:
+        for dataset, region in itertools.product(datasets, regions):
+            _download_dataset_region(downloader, dataset, region)
+        return
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(_download_dataset_region, downloader, dataset, region)
+                   for dataset, region in itertools.product(datasets, regions)]
+    # Raise the first error, once all downloads have finished.
+    for future in futures:
+        future.result()
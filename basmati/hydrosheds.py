@@ -1,14 +1,21 @@
-from logging import getLogger
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from logging import getLogger, DEBUG
 from pathlib import Path
-from typing import Union, Iterable, Tuple, Set
+from typing import Union, Iterable, Tuple, List, Optional
 
 import geopandas as gpd
 import numpy as np
 import pandas as pd
 import rasterio
+import rasterio.windows
 from numpy import ndarray
 from pandas.core.base import PandasObject
+from rasterio.coords import BoundingBox
 from rasterio.transform import Affine
+from rasterio.windows import Window
+
+from basmati.shapefile import read_dbf, get_geometry_reader
 
 logger = getLogger('basmati.hydrosheds')
 
@@ -16,74 +23,300 @@ HYDROBASINS_FILE_TPL = 'hybas_{region}_lev{level:02}_v1c.shp'
 HYDROSHEDS_DEM_FILE_TPL = '{region}_dem_{resolution}.bil'
 
 
+def _hydrobasins_cache_path(cache_dir: Union[str, Path], filepath: Path) -> Path:
+    # Key on the mtime and size of the shapefile, so that a changed shapefile invalidates its cache entry.
+    stat = filepath.stat()
+    return Path(cache_dir, f'{filepath.stem}.{stat.st_mtime_ns}.{stat.st_size}.parquet')
+
+
+def _write_hydrobasins_cache(cache_path: Path, gdf: gpd.GeoDataFrame) -> None:
+    logger.debug(f'Writing hydrobasins cache: {cache_path}')
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    stem = cache_path.name.split('.')[0]
+    for stale_path in cache_path.parent.glob(f'{stem}.*.parquet'):
+        logger.debug(f'Removing stale hydrobasins cache: {stale_path}')
+        stale_path.unlink()
+    # Write then rename, so that an interrupted write never leaves a partial cache file.
+    tmp_path = cache_path.with_suffix('.tmp')
+    gdf.to_parquet(tmp_path)
+    tmp_path.replace(cache_path)
+
+
+def build_hydrobasins_cache(filepath: Union[str, Path], cache_dir: Union[str, Path]) -> Path:
+    """Convert one HydroBASINS shapefile into the columnar cache used by `load_hydrobasins_geodataframe`.
+
+    Does nothing if the cache is already up to date.
+
+    :param filepath: path to shapefile
+    :param cache_dir: directory of cache
+    :return: path of cache file
+    """
+    filepath = Path(filepath)
+    cache_path = _hydrobasins_cache_path(cache_dir, filepath)
+    if not cache_path.exists():
+        _write_hydrobasins_cache(cache_path, gpd.read_file(str(filepath)))
+    return cache_path
+
+
+def _read_hydrobasins_file(filepath: Path, cache_dir: Union[str, Path, None] = None,
+                           columns: List[str] = None) -> gpd.GeoDataFrame:
+    """Read one HydroBASINS shapefile, optionally through the columnar cache.
+
+    :param filepath: path to shapefile
+    :param cache_dir: directory of cache, no caching if `None`
+    :param columns: columns to read, all if `None` (include `geometry` to read geometries)
+    :return: geodataframe of shapefile, without geometry if `geometry` not in columns
+    """
+    read_geometry = columns is None or 'geometry' in columns
+    if cache_dir is None:
+        gdf = gpd.read_file(str(filepath), ignore_geometry=not read_geometry)
+    else:
+        cache_path = build_hydrobasins_cache(filepath, cache_dir)
+        logger.debug(f'Reading hydrobasins cache: {cache_path}')
+        if read_geometry:
+            gdf = gpd.read_parquet(cache_path, columns=columns)
+        else:
+            gdf = pd.read_parquet(cache_path, columns=columns)
+    if columns is not None:
+        gdf = gdf[columns]
+    return gpd.GeoDataFrame(gdf) if not read_geometry else gdf
+
+
+def _read_hydrobasins_attributes(filepath: Path, columns: List[str] = None) -> pd.DataFrame:
+    """Read the attributes of one HydroBASINS shapefile from its .dbf file.
+
+    :param filepath: path to shapefile
+    :param columns: columns to read, all if `None`
+    :return: dataframe of attributes, with record number of each basin in `SHP_REC`
+    """
+    df = read_dbf(filepath.with_suffix('.dbf'), columns)
+    df['SHP_REC'] = df.index.values.astype(np.int32)
+    return df
+
+
 def load_hydrobasins_geodataframe(hydrosheds_dir: Union[str, Path], region: str,
                                   levels: Iterable = range(1, 7),
-                                  hydrobasins_file_tpl: str = HYDROBASINS_FILE_TPL) -> gpd.GeoDataFrame:
+                                  hydrobasins_file_tpl: str = HYDROBASINS_FILE_TPL,
+                                  cache_dir: Union[str, Path] = None,
+                                  columns: Iterable[str] = None,
+                                  workers: int = 1,
+                                  use_processes: bool = False,
+                                  geometry: bool = True) -> Union[gpd.GeoDataFrame, pd.DataFrame]:
     """Load all data for the desired region and levels.
 
+    If `cache_dir` is given, each shapefile is converted once into a GeoParquet file in `cache_dir` (geometry stored
+    as WKB), which is read instead of the shapefile on later calls. The cache is rebuilt if the shapefile's mtime or
+    size changes.
+
+    With `workers > 1`, the levels are read in parallel, so loading takes about as long as the slowest level. The
+    result is identical to loading them one after another.
+
+    With `geometry=False`, only the attributes in the .dbf files are read, into a pandas dataframe with narrow
+    dtypes. This is much faster and smaller than loading the geometries, and is all that is needed for e.g.
+    `find_upstream` or `area_select`. `PFAF_STR` is not added, and `cache_dir` is not used. The geometries of
+    selected rows can be added later with `attach_geometry`.
+
     :param hydrosheds_dir: directory of HydroSHEDS datasets
     :param region: 2 character region code
     :param levels: Pfafstetter levels to load
     :param hydrobasins_file_tpl: filename template
+    :param cache_dir: directory of columnar cache (requires pyarrow), no caching if `None`
+    :param columns: columns to load (`PFAF_ID` is always loaded) - leave out `geometry` to skip reading geometries
+    :param workers: number of levels to read in parallel
+    :param use_processes: use a process pool instead of a thread pool when `workers > 1`
+    :param geometry: load geometries, if `False` return a dataframe of attributes only
     :return: geodataframe containing all the data for the desired region and levels
     """
     if not Path(hydrosheds_dir).exists():
         raise OSError(f'{hydrosheds_dir} does not exist')
-    crss = []
-    gdfs = []
+    if columns is not None:
+        columns = list(columns)
+        if 'PFAF_ID' not in columns:
+            columns.append('PFAF_ID')
+    read_geometry = columns is None or 'geometry' in columns
+    levels = list(levels)
+    filepaths = []
     for level in levels:
         filename = hydrobasins_file_tpl.format(region=region, level=level)
         filepath = Path(hydrosheds_dir, filename)
         if not filepath.exists():
             raise OSError(f'{filepath} does not exist')
         logger.debug(f'Loading hydrobasins region: {region}; level: {level}; {filepath}')
-        gdf = gpd.read_file(str(filepath))
-        crss.append(gdf.crs)
+        filepaths.append(filepath)
+
+    if geometry:
+        read_file = partial(_read_hydrobasins_file, cache_dir=cache_dir, columns=columns)
+    else:
+        if columns is not None and 'geometry' in columns:
+            columns.remove('geometry')
+        read_file = partial(_read_hydrobasins_attributes, columns=columns)
+    if workers > 1:
+        pool_cls = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        with pool_cls(max_workers=workers) as pool:
+            # N.B. map returns results in the order of levels.
+            gdfs = list(pool.map(read_file, filepaths))
+    else:
+        gdfs = [read_file(filepath) for filepath in filepaths]
+
+    if not geometry:
+        for level, df in zip(levels, gdfs):
+            df['LEVEL'] = np.int8(level)
+        df = pd.concat(gdfs, ignore_index=True)
+        # Used by attach_geometry to find the shapefile of each level.
+        df.attrs['hydrobasins_filepaths'] = {level: str(filepath) for level, filepath in zip(levels, filepaths)}
+        get_pfaf_index(df)
+        return df
+
+    crss = []
+    for level, gdf in zip(levels, gdfs):
+        if read_geometry:
+            crss.append(gdf.crs)
         gdf['LEVEL'] = level
-        gdfs.append(gdf)
-
-    # CRS is the Coordinate Reference System.
-    # http://geopandas.org/projections.html
-    assert all(crs == crss[0] for crs in crss[1:]), f'All CRS info not identical: {crss}'
-    # The HydroBASINS data is all in epsg:4326, which is lat/lon:
-    # https://spatialreference.org/ref/epsg/4326/
-    # This is the same as WGS84.
-    # assert crss[0] == {'init': 'epsg:4326'}, f'Unexpected CRS: {crss[0]}'
-    # N.B. old method uses dict for CRS, new just uses string.
-    crs0 = crss[0]
-    if isinstance(crs0, dict):
-        crs0 = crs0['init']
-    assert crs0 == 'epsg:4326', f'Unexpected CRS: {crss[0]}'
 
     # N.B. CRS data is lost on pd.concat.
     gdf = gpd.GeoDataFrame(pd.concat(gdfs, ignore_index=True))
-    logger.debug(f'Setting CRS to {crss[0]}')
-    gdf.crs = crss[0]
+
+    if read_geometry:
+        # CRS is the Coordinate Reference System.
+        # http://geopandas.org/projections.html
+        assert all(crs == crss[0] for crs in crss[1:]), f'All CRS info not identical: {crss}'
+        # The HydroBASINS data is all in epsg:4326, which is lat/lon:
+        # https://spatialreference.org/ref/epsg/4326/
+        # This is the same as WGS84.
+        # assert crss[0] == {'init': 'epsg:4326'}, f'Unexpected CRS: {crss[0]}'
+        # N.B. old method uses dict for CRS, new just uses string.
+        crs0 = crss[0]
+        if isinstance(crs0, dict):
+            crs0 = crs0['init']
+        assert crs0 == 'epsg:4326', f'Unexpected CRS: {crss[0]}'
+
+        logger.debug(f'Setting CRS to {crss[0]}')
+        gdf.crs = crss[0]
+
     gdf['PFAF_STR'] = gdf.PFAF_ID.apply(str)
+    get_pfaf_index(gdf)
     return gdf
 
 
+def attach_geometry(df: pd.DataFrame) -> gpd.GeoDataFrame:
+    """Attach geometries to a dataframe loaded with `load_hydrobasins_geodataframe(..., geometry=False)`.
+
+    The `SHP_REC` column acts as a lazy geometry column: each geometry is decoded from the .shp file (found through
+    the .shx index) the first time it is needed, and cached. So filter `df` first, e.g.:
+    `attach_geometry(df.find_upstream(pfaf_id))`
+    and only the bytes for the selected basins are read.
+
+    :param df: (filtered) hydrobasins attribute dataframe
+    :return: geodataframe with same rows as `df`
+    """
+    filepaths = df.attrs['hydrobasins_filepaths']
+    levels = df.LEVEL.values
+    geometries = np.empty(len(df), dtype=object)
+    for level in np.unique(levels):
+        is_level = levels == level
+        reader = get_geometry_reader(filepaths[int(level)])
+        geometries[is_level] = reader.geometries(df.SHP_REC.values[is_level])
+    # All HydroBASINS data is in epsg:4326 (see load_hydrobasins_geodataframe).
+    return gpd.GeoDataFrame(df, geometry=gpd.GeoSeries(geometries, index=df.index), crs='epsg:4326')
+
+
+def _bounds_to_window(bounds: Tuple[float, float, float, float], affine_tx: Affine, height: int,
+                      width: int) -> Window:
+    # Smallest window of whole cells that covers bounds, clipped to dataset.
+    window = rasterio.windows.from_bounds(*bounds, transform=affine_tx)
+    row_start = max(int(np.floor(round(window.row_off, 6))), 0)
+    col_start = max(int(np.floor(round(window.col_off, 6))), 0)
+    row_stop = min(int(np.ceil(round(window.row_off + window.height, 6))), height)
+    col_stop = min(int(np.ceil(round(window.col_off + window.width, 6))), width)
+    return Window.from_slices((row_start, row_stop), (col_start, col_stop))
+
+
+def _memmap_bil(filepath: Path, dem_buf: rasterio.DatasetReader) -> Optional[ndarray]:
+    # Band interleaved by line files are raw rows of each band, described by a .hdr file. Only the simple case of
+    # a single band of contiguous rows with no padding is memory-mapped - None is returned for anything else.
+    hdr = {}
+    for line in filepath.with_suffix('.hdr').read_text().splitlines():
+        if line.strip():
+            key, *value = line.split()
+            hdr[key.upper()] = ' '.join(value)
+    dtype = np.dtype(dem_buf.dtypes[0])
+    row_bytes = dem_buf.width * dtype.itemsize
+    expected = {
+        'LAYOUT': 'BIL',
+        'NROWS': str(dem_buf.height),
+        'NCOLS': str(dem_buf.width),
+        'NBANDS': '1',
+        'NBITS': str(dtype.itemsize * 8),
+        'BANDROWBYTES': str(row_bytes),
+        'TOTALROWBYTES': str(row_bytes),
+        'BANDGAPBYTES': '0',
+        'SKIPBYTES': '0',
+    }
+    unsupported = [f'{key} {hdr[key]}' for key, value in expected.items()
+                   if key in hdr and hdr[key].upper() != value]
+    if unsupported:
+        logger.warning(f'Cannot memory-map {filepath} ({", ".join(unsupported)}), reading it instead')
+        return None
+    byteorder = '>' if hdr.get('BYTEORDER', 'I').upper() in ('M', 'MOTOROLA') else '<'
+    return np.memmap(filepath, dtype=dtype.newbyteorder(byteorder), mode='r',
+                     shape=(dem_buf.height, dem_buf.width))
+
+
 def load_hydrosheds_dem(hydrosheds_dir: Union[str, Path], region: str, resolution: str = '30s',
-                        hydrosheds_dem_file_tpl: str = HYDROSHEDS_DEM_FILE_TPL) -> Tuple[ndarray, Affine,
-                                                                                         ndarray, ndarray]:
+                        hydrosheds_dem_file_tpl: str = HYDROSHEDS_DEM_FILE_TPL,
+                        window: Union[Window, Tuple[Tuple[int, int], Tuple[int, int]]] = None,
+                        bounds: Tuple[float, float, float, float] = None,
+                        mmap: bool = False) -> Tuple[BoundingBox, Affine, ndarray, ndarray]:
     """Load a HydroSHEDS Digital Elevation Model (DEM).
 
+    Use `window` or `bounds` to read only a region of interest. The returned bounds and affine transform are then
+    those of the region. With `mmap=True`, the raw .bil file is memory-mapped rather than read, and the DEM is a
+    read-only view onto it, so only the rows that are used are ever read from disk. Files that are not a single
+    band of unpadded rows (see the .hdr file) are read as normal, with a warning.
+
     :param hydrosheds_dir: directory of HydroSHEDS datasets
     :param region: 2 character region code
     :param resolution: resolution to load
     :param hydrosheds_dem_file_tpl: filename template
+    :param window: window to read, as a rasterio `Window` or `((row_start, row_stop), (col_start, col_stop))`
+    :param bounds: `(left, bottom, right, top)` to read - all cells that overlap these bounds are read
+    :param mmap: memory-map the DEM instead of reading it into memory
     :return: bounds, affine transform, DEM and mask of the DEM
     """
+    if window is not None and bounds is not None:
+        raise ValueError('Only one of window and bounds can be given')
     filename = hydrosheds_dem_file_tpl.format(region=region, resolution=resolution)
+    filepath = Path(hydrosheds_dir, filename)
     logger.debug(f'Loading hydrosheds DEM region: {region}; resolution: {resolution}; {filename}')
-    with rasterio.open(Path(hydrosheds_dir, filename)) as dem_buf:
+    with rasterio.open(filepath) as dem_buf:
         # N.B. in different order to rasterio tx!
         gdal_tx = np.array(dem_buf.get_transform())
         affine_tx = rasterio.transform.Affine(gdal_tx[1], gdal_tx[2], gdal_tx[0],
                                               gdal_tx[4], gdal_tx[5], gdal_tx[3])
-        dem = dem_buf.read()[0]
-        mask = ~dem_buf.dataset_mask()
-        bounds = dem_buf.bounds
+        full_window = Window(0, 0, dem_buf.width, dem_buf.height)
+        if bounds is not None:
+            window = _bounds_to_window(bounds, affine_tx, dem_buf.height, dem_buf.width)
+        elif window is None:
+            window = full_window
+        elif not isinstance(window, Window):
+            window = Window.from_slices(*window)
+        window = rasterio.windows.intersection(window, full_window)
+        logger.debug(f'Reading window {window}')
+
+        bil = _memmap_bil(filepath, dem_buf) if mmap else None
+        if bil is not None:
+            row_slice, col_slice = window.toslices()
+            dem = bil[row_slice, col_slice]
+            # Same convention as ~dataset_mask(): 255 where there is no data.
+            if dem_buf.nodata is None:
+                mask = np.zeros(dem.shape, dtype=np.uint8)
+            else:
+                mask = (dem == dem_buf.nodata).astype(np.uint8) * np.uint8(255)
+        else:
+            dem = dem_buf.read(1, window=window)
+            mask = ~dem_buf.dataset_mask(window=window)
+        bounds = BoundingBox(*rasterio.windows.bounds(window, affine_tx))
+        affine_tx = rasterio.windows.transform(window, affine_tx)
     return bounds, affine_tx, dem, mask
 
 
@@ -119,6 +352,416 @@ def is_downstream(pfaf_id_a: Union[int, str], pfaf_id_b: Union[int, str]) -> boo
     return False
 
 
+# Enough powers of 10 for any Pfafstetter code that fits in an int64.
+_POW10 = 10**np.arange(19, dtype=np.int64)
+
+
+def _num_digits(pfaf_ids: ndarray) -> ndarray:
+    return np.searchsorted(_POW10, pfaf_ids, side='right')
+
+
+def is_downstream_many(pfaf_ids_a: Union[ndarray, Iterable], pfaf_ids_b: Union[ndarray, Iterable],
+                       outer: bool = False) -> ndarray:
+    """Vectorized version of `is_downstream` that works on arrays of Pfafstetter ids.
+
+    Uses integer digit arithmetic instead of string operations. Inputs are broadcast against each other, so e.g. one
+    upstream id can be tested against many downstream ids. With `outer=True`, all pairs are tested, e.g. for all the
+    basins at one level: `is_downstream_many(pfaf_ids, pfaf_ids, outer=True)`.
+    N.B. where one id is a prefix of the other (e.g. 88 and 881) the result is `False`.
+
+    :param pfaf_ids_a: first Pfafstetter ids (upstream)
+    :param pfaf_ids_b: second Pfafstetter ids (downstream)
+    :param outer: if `True`, return matrix with element `[i, j]` for `pfaf_ids_a[i]` and `pfaf_ids_b[j]`
+    :return: boolean array, `True` where pfaf_id_b is downstream of pfaf_id_a
+    """
+    a = np.asarray(pfaf_ids_a).astype(np.int64)
+    b = np.asarray(pfaf_ids_b).astype(np.int64)
+    if outer:
+        a = a.ravel()[:, None]
+        b = b.ravel()[None, :]
+    a, b = np.broadcast_arrays(a, b)
+    len_a = _num_digits(a)
+    len_b = _num_digits(b)
+    min_len = np.minimum(len_a, len_b)
+    max_len = int(max(len_a.max(initial=0), len_b.max(initial=0)))
+
+    # Length of common prefix of a and b, found by comparing the leading k digits of each.
+    num_common = np.zeros(a.shape, dtype=np.int64)
+    for k in range(1, max_len + 1):
+        prefix_a = a // _POW10[np.maximum(len_a - k, 0)]
+        prefix_b = b // _POW10[np.maximum(len_b - k, 0)]
+        num_common += (k <= min_len) & (num_common == k - 1) & (prefix_a == prefix_b)
+
+    # First differing digit of b must be less than that of a.
+    differ = num_common < min_len
+    digit_a = (a // _POW10[np.maximum(len_a - num_common - 1, 0)]) % 10
+    digit_b = (b // _POW10[np.maximum(len_b - num_common - 1, 0)]) % 10
+    res = differ & (digit_b < digit_a)
+
+    # All digits of b from the first differing digit on must be odd or 0.
+    for i in range(max_len):
+        digit = (b // _POW10[np.maximum(len_b - i - 1, 0)]) % 10
+        res &= ~((i >= num_common) & (i < len_b) & (digit % 2 == 0) & (digit != 0))
+    return res
+
+
+def _build_children(parent: ndarray) -> Tuple[ndarray, ndarray]:
+    # CSR arrays of children from parent array: children of i are child_index[child_ptr[i]:child_ptr[i + 1]].
+    n = len(parent)
+    has_parent = parent >= 0
+    child_order = np.argsort(parent[has_parent], kind='stable')
+    child_index = np.flatnonzero(has_parent)[child_order]
+    child_ptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(parent[has_parent], minlength=n), out=child_ptr[1:])
+    return child_index, child_ptr
+
+
+def _gather_children(child_index: ndarray, child_ptr: ndarray, positions: ndarray) -> ndarray:
+    # Concatenate children of all positions without a python loop.
+    starts = child_ptr[positions]
+    counts = child_ptr[positions + 1] - starts
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return child_index[np.repeat(starts, counts) + offsets]
+
+
+class _SortedLookup:
+    """Map unique integer keys to their positions using a sorted copy of the keys."""
+
+    def __init__(self, keys: ndarray, name: str) -> None:
+        self._order = np.argsort(keys, kind='stable')
+        self._sorted_keys = keys[self._order]
+        assert (np.diff(self._sorted_keys) > 0).all(), f'{name} values not unique'
+
+    def __call__(self, keys: ndarray) -> ndarray:
+        """Positions of keys, -1 where key not found."""
+        keys = np.asarray(keys)
+        if not len(self._sorted_keys):
+            return np.full(keys.shape, -1, dtype=np.int64)
+        idx = np.minimum(np.searchsorted(self._sorted_keys, keys), len(self._sorted_keys) - 1)
+        return np.where(self._sorted_keys[idx] == keys, self._order[idx], -1)
+
+
+class BasinNetwork:
+    """Index of the `NEXT_DOWN` river network for a single level.
+
+    Basins are referred to by integer position (0 to n - 1) in the order that their `HYBAS_ID` values are given.
+    The downstream basin of each basin is stored in `parent` (-1 if there is none, e.g. at the coast), and the
+    upstream neighbours of each basin are stored as CSR arrays: the children of basin `i` are
+    `child_index[child_ptr[i]:child_ptr[i + 1]]`.
+
+    Building the index is O(n log n); walking upstream or downstream from a basin is then proportional to the number
+    of basins found.
+    """
+
+    def __init__(self, hybas_id: ndarray, next_down: ndarray, rows: ndarray = None) -> None:
+        """Build the network index.
+
+        :param hybas_id: HydroBASINS ids of basins
+        :param next_down: HydroBASINS id of the next basin downstream of each basin (0 if none)
+        :param rows: positions of basins in the originating dataframe, defaults to `range(len(hybas_id))`
+        """
+        self.hybas_id = np.asarray(hybas_id, dtype=np.int64)
+        self.next_down = np.asarray(next_down, dtype=np.int64)
+        n = len(self.hybas_id)
+        self.rows = np.arange(n) if rows is None else np.asarray(rows)
+        assert len(self.next_down) == n and len(self.rows) == n
+
+        self._lookup = _SortedLookup(self.hybas_id, 'HYBAS_ID')
+        self.parent = self._lookup(self.next_down)
+        self.child_index, self.child_ptr = _build_children(self.parent)
+
+    @classmethod
+    def from_gdf(cls, gdf: pd.DataFrame, level: int) -> 'BasinNetwork':
+        """Build the network index for one level of a hydrobasins dataframe.
+
+        :param gdf: hydrobasins dataframe (can contain multiple levels)
+        :param level: level to build network for
+        :return: network with `rows` set to the positions of the level's basins in `gdf`
+        """
+        rows = np.flatnonzero(gdf.LEVEL.values == level)
+        return cls(gdf.HYBAS_ID.values[rows], gdf.NEXT_DOWN.values[rows], rows)
+
+    def __len__(self) -> int:
+        return len(self.hybas_id)
+
+    def position(self, hybas_id: int) -> int:
+        """Position of basin with given HydroBASINS id.
+
+        :param hybas_id: HydroBASINS id of basin
+        :raises: KeyError if basin not in network
+        :return: position of basin
+        """
+        pos = int(self._lookup(np.array([hybas_id], dtype=np.int64))[0])
+        if pos < 0:
+            raise KeyError(hybas_id)
+        return pos
+
+    def children(self, pos: int) -> ndarray:
+        """Positions of basins that flow directly into basin at `pos`."""
+        return self.child_index[self.child_ptr[pos]:self.child_ptr[pos + 1]]
+
+    def upstream(self, pos: int) -> ndarray:
+        """Positions of all basins upstream of basin at `pos`, in no particular order.
+
+        Expands one "generation" of upstream basins at a time using the CSR arrays.
+
+        :param pos: position of start basin
+        :return: positions of upstream basins, not including start basin
+        """
+        found = []
+        frontier = self.children(pos)
+        while len(frontier):
+            found.append(frontier)
+            frontier = _gather_children(self.child_index, self.child_ptr, frontier)
+        if not found:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate(found)
+
+    def downstream(self, pos: int) -> ndarray:
+        """Positions of all basins downstream of basin at `pos`, ordered from nearest to outlet.
+
+        :param pos: position of start basin
+        :return: positions of downstream basins, not including start basin
+        """
+        found = []
+        next_pos = self.parent[pos]
+        while next_pos >= 0:
+            found.append(next_pos)
+            next_pos = self.parent[next_pos]
+        return np.array(found, dtype=np.int64)
+
+    def generations(self) -> List[ndarray]:
+        """Group basins by the number of hops to their outlet.
+
+        First element contains the outlets (basins with no downstream basin), the second all basins that flow
+        directly into an outlet, etc.
+
+        :return: list of arrays of positions
+        """
+        gens = []
+        frontier = np.flatnonzero(self.parent < 0)
+        while len(frontier):
+            gens.append(frontier)
+            frontier = _gather_children(self.child_index, self.child_ptr, frontier)
+        assert sum(len(g) for g in gens) == len(self), 'NEXT_DOWN network contains cycles'
+        return gens
+
+    def _topological_pass(self) -> None:
+        gens = self.generations()
+        n = len(self)
+        outlet = np.arange(n)
+        for gen in gens[1:]:
+            outlet[gen] = outlet[self.parent[gen]]
+
+        # Number of basins in catchment of each basin (including itself), accumulated from the sources down.
+        size = np.ones(n, dtype=np.int64)
+        for gen in gens[:0:-1]:
+            size += np.bincount(self.parent[gen], weights=size[gen], minlength=n).astype(np.int64)
+
+        # Lay out basins in preorder, so that the catchment of each basin is a contiguous block that starts with
+        # the basin itself. Siblings are placed one after the other after their parent.
+        child_size = size[self.child_index]
+        cum_child_size = np.cumsum(child_size) - child_size
+        parent_of_child = np.repeat(np.arange(n), np.diff(self.child_ptr))
+        sibling_offset = cum_child_size - cum_child_size[self.child_ptr[parent_of_child]]
+        child_offset = np.zeros(n, dtype=np.int64)
+        child_offset[self.child_index] = sibling_offset
+
+        start = np.zeros(n, dtype=np.int64)
+        roots = gens[0] if gens else np.zeros(0, dtype=np.int64)
+        start[roots] = np.cumsum(size[roots]) - size[roots]
+        for gen in gens[1:]:
+            start[gen] = start[self.parent[gen]] + 1 + child_offset[gen]
+        order = np.empty(n, dtype=np.int64)
+        order[start] = np.arange(n)
+
+        self._outlet = outlet
+        self._catchment_size = size
+        self._catchment_start = start
+        self._catchment_order = order
+
+    @property
+    def outlet(self) -> ndarray:
+        """Position of the terminal outlet of each basin (outlets are their own outlet)."""
+        if not hasattr(self, '_outlet'):
+            self._topological_pass()
+        return self._outlet
+
+    def catchment_layout(self) -> Tuple[ndarray, ndarray, ndarray]:
+        """Preorder layout of the network, in which every catchment is a contiguous block.
+
+        The catchment of basin `i` is `order[start[i]:start[i] + size[i]]`, and starts with `i` itself.
+
+        :return: order, start, size
+        """
+        if not hasattr(self, '_outlet'):
+            self._topological_pass()
+        return self._catchment_order, self._catchment_start, self._catchment_size
+
+    def catchment(self, pos: int) -> ndarray:
+        """Positions of all basins in the catchment of basin at `pos`, starting with the basin itself.
+
+        :param pos: position of basin
+        :return: positions of basin and all basins upstream of it (a view into the preorder layout)
+        """
+        order, start, size = self.catchment_layout()
+        return order[start[pos]:start[pos] + size[pos]]
+
+
+class PfafIndex:
+    """Index of the Pfafstetter hierarchy of a (multi-level) hydrobasins dataframe.
+
+    Basins are referred to by their row position in the dataframe, and are looked up by their integer Pfafstetter
+    id. The basin one level lower (larger) than each basin is stored in `parent` (-1 if it is not in the dataframe),
+    and the basins one level higher (smaller) are stored as CSR arrays: the children of basin `i` are
+    `child_index[child_ptr[i]:child_ptr[i + 1]]`, in row order.
+    """
+
+    def __init__(self, pfaf_id: ndarray) -> None:
+        """Build the hierarchy index.
+
+        :param pfaf_id: Pfafstetter ids of all basins
+        """
+        self.pfaf_id = np.asarray(pfaf_id).astype(np.int64)
+        self._lookup = _SortedLookup(self.pfaf_id, 'PFAF_ID')
+        self.parent = self._lookup(self.pfaf_id // 10)
+        self.child_index, self.child_ptr = _build_children(self.parent)
+
+    def __len__(self) -> int:
+        return len(self.pfaf_id)
+
+    def positions(self, pfaf_ids: Union[ndarray, Iterable]) -> ndarray:
+        """Positions of basins with given Pfafstetter ids, -1 where not found."""
+        return self._lookup(np.asarray(pfaf_ids).astype(np.int64))
+
+    def position(self, pfaf_id: Union[int, str]) -> int:
+        """Position of basin with given Pfafstetter id.
+
+        :param pfaf_id: Pfafstetter id of basin
+        :raises: KeyError if basin not in index
+        :return: position of basin
+        """
+        pos = int(self.positions([pfaf_id])[0])
+        if pos < 0:
+            raise KeyError(pfaf_id)
+        return pos
+
+    def children(self, pos: int) -> ndarray:
+        """Positions of basins one level higher (smaller) than basin at `pos`."""
+        return self.child_index[self.child_ptr[pos]:self.child_ptr[pos + 1]]
+
+
+# Columns that the stored indexes are built from.
+_INDEXED_COLUMNS = ['HYBAS_ID', 'NEXT_DOWN', 'PFAF_ID', 'LEVEL']
+
+
+def _column_values(gdf: pd.DataFrame, column: str) -> ndarray:
+    # Much faster than gdf[column].values, which builds a Series (this is called on every query).
+    try:
+        return gdf._get_column_array(gdf.columns.get_loc(column))
+    except AttributeError:
+        # pandas < 1.3.
+        return gdf[column].values
+
+
+def _column_key(values: ndarray) -> tuple:
+    # Identifies a column's data buffer. The array itself is kept, so that its memory cannot be reused by another
+    # column while the key is stored.
+    return values, values.__array_interface__['data'][0], values.shape, values.strides
+
+
+def _gdf_cache(gdf: pd.DataFrame) -> dict:
+    # Indexes are stored on the dataframe instance, so are never shared with frames derived from it (e.g. by
+    # filtering). The data buffers of the columns they are built from are checked on lookup, which is O(1) and
+    # catches frames that have been modified in place by e.g. sorting, dropping rows or assigning a column. Values
+    # edited in place (e.g. with `.loc`) keep the same buffers - see `clear_basin_indexes`.
+    try:
+        cache = object.__getattribute__(gdf, '_basmati_cache')
+    except AttributeError:
+        cache = {}
+        object.__setattr__(gdf, '_basmati_cache', cache)
+    keys = {column: _column_key(_column_values(gdf, column)) for column in _INDEXED_COLUMNS if column in gdf.columns}
+    indexed_keys = cache.get('columns', {})
+    if (indexed_keys.keys() != keys.keys()
+            or any(indexed_keys[column][1:] != key[1:] for column, key in keys.items())):
+        cache.clear()
+        cache['columns'] = keys
+    return cache
+
+
+def clear_basin_indexes(gdf: pd.DataFrame) -> None:
+    """Clear the indexes stored on gdf, so that they are rebuilt the next time that they are needed.
+
+    Only needed if `HYBAS_ID`, `NEXT_DOWN`, `PFAF_ID` or `LEVEL` values have been edited in place, e.g.
+    `gdf.loc[rows, 'NEXT_DOWN'] = ...`. Other changes (e.g. sorting in place) are detected.
+
+    :param gdf: hydrobasins dataframe
+    """
+    _gdf_cache(gdf).clear()
+
+
+def get_basin_network(gdf: pd.DataFrame, level: int) -> BasinNetwork:
+    """Get `BasinNetwork` for level of gdf, building it if necessary.
+
+    The network is built once per level and stored on `gdf`, so repeated queries on the same dataframe are fast.
+    It is rebuilt if `HYBAS_ID`, `NEXT_DOWN`, `PFAF_ID` or `LEVEL` have been replaced since, e.g. if `gdf` has been
+    sorted in place. Call `clear_basin_indexes` after editing their values in place.
+
+    :param gdf: hydrobasins dataframe
+    :param level: level of network
+    :return: network for level
+    """
+    cache = _gdf_cache(gdf)
+    key = ('network', level)
+    if key not in cache:
+        logger.debug(f'Building basin network for level {level}')
+        cache[key] = BasinNetwork.from_gdf(gdf, level)
+    return cache[key]
+
+
+def get_pfaf_index(gdf: pd.DataFrame) -> PfafIndex:
+    """Get `PfafIndex` for gdf, building it if necessary.
+
+    The index is built when loading (see `load_hydrobasins_geodataframe`), or the first time that it is needed, and
+    stored on `gdf`. As with `get_basin_network`, it is rebuilt if the columns it depends on have been replaced.
+
+    :param gdf: hydrobasins dataframe
+    :return: Pfafstetter hierarchy index
+    """
+    cache = _gdf_cache(gdf)
+    if 'pfaf_index' not in cache:
+        logger.debug('Building Pfafstetter index')
+        cache['pfaf_index'] = PfafIndex(gdf.PFAF_ID.values)
+    return cache['pfaf_index']
+
+
+def upstream_labels(gdf: pd.DataFrame, level: int) -> pd.DataFrame:
+    """Label every basin at a level with its terminal outlet and its upstream catchment.
+
+    Does one topological pass over the `NEXT_DOWN` network, rather than calling `find_upstream` once per basin.
+    e.g. to get the catchment of every coastal outlet:
+    `labels = upstream_labels(gdf, 6); labels[labels.HYBAS_ID == labels.OUTLET_ID]`
+
+    :param gdf: hydrobasins dataframe
+    :param level: level to label
+    :return: dataframe with the same index as the level's rows in gdf, and columns `HYBAS_ID`, `OUTLET_ID` (id of
+        terminal outlet) and `UPSTREAM_IDS` (array of ids of all basins in the catchment, starting with the basin
+        itself)
+    """
+    network = get_basin_network(gdf, level)
+    outlet_id = network.hybas_id[network.outlet]
+    order, starts, sizes = network.catchment_layout()
+    # Catchments are views into a single preordered id array, so no per-basin copies are made.
+    preordered_id = network.hybas_id[order]
+    upstream_ids = np.empty(len(network), dtype=object)
+    for pos, (start, size) in enumerate(zip(starts, sizes)):
+        upstream_ids[pos] = preordered_id[start:start + size]
+    return pd.DataFrame({'HYBAS_ID': network.hybas_id,
+                         'OUTLET_ID': outlet_id,
+                         'UPSTREAM_IDS': upstream_ids},
+                        index=gdf.index[network.rows])
+
+
 def _find_downstream(gdf: gpd.GeoDataFrame, start_basin_pfaf_id: int) -> gpd.GeoDataFrame:
     """Find all downstream basins at the same level as the start basin.
 
@@ -129,24 +772,11 @@ def _find_downstream(gdf: gpd.GeoDataFrame, start_basin_pfaf_id: int) -> gpd.Geo
     :param start_basin_pfaf_id: Pfafstetter id of start basin
     :return: filtered geodataframe at level of start basin based on which basins are downstream of start basin
     """
-    assert isinstance(gdf, gpd.GeoDataFrame)
-    start_row = gdf[gdf.PFAF_ID == start_basin_pfaf_id].iloc[0]
-    gdf_lev = gdf[gdf.LEVEL == start_row.LEVEL]
-    next_row = start_row
-    downstream = np.array(gdf_lev.HYBAS_ID == start_row.HYBAS_ID, dtype=bool)
-
-    while next_row is not None:
-        next_downstream = np.array(next_row['NEXT_DOWN'] == gdf_lev['HYBAS_ID'], dtype=bool)
-        downstream |= next_downstream
-        next_gdf = gdf_lev[next_downstream]
-        if len(next_gdf):
-            assert len(next_gdf) == 1
-            next_row = next_gdf.iloc[0]
-        else:
-            next_row = None
-
-    # gdf_lev[downstream] includes start row: don't return it [:-1].
-    return gdf_lev[downstream].iloc[:-1]
+    assert isinstance(gdf, pd.DataFrame)
+    start_row = gdf.iloc[get_pfaf_index(gdf).position(start_basin_pfaf_id)]
+    network = get_basin_network(gdf, start_row.LEVEL)
+    downstream = network.downstream(network.position(start_row.HYBAS_ID))
+    return gdf.iloc[np.sort(network.rows[downstream])]
 
 
 def _find_upstream(gdf: gpd.GeoDataFrame, start_basin_pfaf_id: int) -> gpd.GeoDataFrame:
@@ -159,19 +789,11 @@ def _find_upstream(gdf: gpd.GeoDataFrame, start_basin_pfaf_id: int) -> gpd.GeoDa
     :param start_basin_pfaf_id: Pfafstetter id of start basin
     :return: filtered geodataframe at level of start basin based on which basins are upstream of start basin
     """
-    assert isinstance(gdf, gpd.GeoDataFrame)
-    start_row = gdf[gdf.PFAF_ID == start_basin_pfaf_id].iloc[0]
-    gdf_lev = gdf[gdf.LEVEL == start_row.LEVEL]
-    next_hops = np.array(gdf_lev['NEXT_DOWN'] == start_row['HYBAS_ID'], dtype=bool)
-    all_hops = next_hops.copy()
-    while next_hops.sum():
-        next_gdf = gdf_lev.loc[next_hops]
-        next_hops = np.zeros_like(next_hops)
-        for i, row in next_gdf.iterrows():
-            next_hops |= np.array(gdf_lev['NEXT_DOWN'] == row['HYBAS_ID'], dtype=bool)
-            all_hops |= next_hops
-
-    return gdf_lev[all_hops > 0]
+    assert isinstance(gdf, pd.DataFrame)
+    start_row = gdf.iloc[get_pfaf_index(gdf).position(start_basin_pfaf_id)]
+    network = get_basin_network(gdf, start_row.LEVEL)
+    upstream = network.upstream(network.position(start_row.HYBAS_ID))
+    return gdf.iloc[np.sort(network.rows[upstream])]
 
 
 def _find_next_level_larger(gdf: gpd.GeoDataFrame, start_basin_pfaf_id: int) -> gpd.GeoDataFrame:
@@ -187,10 +809,9 @@ def _find_next_level_larger(gdf: gpd.GeoDataFrame, start_basin_pfaf_id: int) ->
     :param start_basin_pfaf_id: Pfafstetter id of start basin
     :return: filtered geodataframe with 0 or 1 basins at level lower
     """
-    assert isinstance(gdf, gpd.GeoDataFrame)
-    larger_gdf = gdf[gdf.PFAF_STR == str(start_basin_pfaf_id)[:-1]]
-    assert len(larger_gdf) <= 1  # can be zero.
-    return larger_gdf
+    assert isinstance(gdf, pd.DataFrame)
+    pos = get_pfaf_index(gdf).positions([int(start_basin_pfaf_id) // 10])
+    return gdf.iloc[pos[pos >= 0]]
 
 
 def _find_next_level_smaller(gdf: gpd.GeoDataFrame, start_basin_pfaf_id: int) -> gpd.GeoDataFrame:
@@ -206,9 +827,31 @@ def _find_next_level_smaller(gdf: gpd.GeoDataFrame, start_basin_pfaf_id: int) ->
     :param start_basin_pfaf_id: Pfafstetter id of start basin
     :return: filtered geodataframe with 0-9 basins at level higher
     """
-    assert isinstance(gdf, gpd.GeoDataFrame)
-    start_row = gdf[gdf.PFAF_ID == start_basin_pfaf_id].iloc[0]
-    return gdf[gdf.PFAF_STR.str.startswith(str(start_basin_pfaf_id)) & (gdf.LEVEL == start_row.LEVEL + 1)]
+    assert isinstance(gdf, pd.DataFrame)
+    pfaf_index = get_pfaf_index(gdf)
+    return gdf.iloc[pfaf_index.children(pfaf_index.position(start_basin_pfaf_id))]
+
+
+def _area_select_masks(gdf: pd.DataFrame, bands: ndarray) -> ndarray:
+    # A basin is selected if it is in the band and its next level larger basin is not. SUB_AREA never increases
+    # going to higher levels, so if any ancestor of a basin is selected then its parent must be in the band too.
+    # This means that checking only the parent excludes every basin that has an already selected ancestor.
+    larger_basin = get_pfaf_index(gdf).parent
+    has_larger = larger_basin >= 0
+    sub_area = gdf.SUB_AREA.values
+    min_area = bands[:, 0:1]
+    max_area = bands[:, 1:2]
+    in_band = (sub_area > min_area) & (sub_area < max_area)
+    larger_in_band = np.zeros_like(in_band)
+    larger_in_band[:, has_larger] = in_band[:, larger_basin[has_larger]]
+
+    if logger.isEnabledFor(DEBUG):
+        levels = gdf.LEVEL.values
+        for (band_min_area, band_max_area), band_in_band in zip(bands, in_band):
+            logger.debug(f'Band {band_min_area} - {band_max_area}')
+            for level in np.unique(levels):
+                logger.debug(f'  level {level} in band: {band_in_band[levels == level].sum()}')
+    return in_band & ~larger_in_band
 
 
 def _area_select(gdf: gpd.GeoDataFrame, min_area: float, max_area: float) -> gpd.GeoDataFrame:
@@ -227,37 +870,22 @@ def _area_select(gdf: gpd.GeoDataFrame, min_area: float, max_area: float) -> gpd
     :param max_area: maximum area of basin
     :return: filtered geodataframe from any level (favouring lower levels) with area between min and max
     """
-    all_good_index: Set[int] = set()
-    good_index = set()
-
-    for level in range(gdf.LEVEL.min(), gdf.LEVEL.max() + 1):
-        gdf_lev = gdf[gdf.LEVEL == level]
-
-        gdf_too_large = gdf_lev[gdf.SUB_AREA > max_area]
-        gdf_just_right = gdf_lev[(gdf.SUB_AREA <= max_area) & (gdf.SUB_AREA >= min_area)]
-        gdf_too_small = gdf_lev[gdf.SUB_AREA < min_area]
+    return _area_select_bands(gdf, [(min_area, max_area)])[0]
 
-        logger.debug(f'Level {level}')
-        logger.debug(f'  too large: {len(gdf_too_large)}')
-        logger.debug(f'  just right: {len(gdf_just_right)}')
-        logger.debug(f'  too small: {len(gdf_too_small)}')
 
-        if len(gdf_just_right) == 0:
-            logger.debug(f'Skipping level: {level}')
-            continue
+def _area_select_bands(gdf: gpd.GeoDataFrame,
+                       bands: Iterable[Tuple[float, float]]) -> List[gpd.GeoDataFrame]:
+    """Perform `area_select` for multiple `(min_area, max_area)` bands in one pass.
 
-        for irow_index in range(len(gdf_lev)):
-            row_index = gdf_lev.index[irow_index]
-            row = gdf_lev.iloc[irow_index]
-
-            if max_area > row.SUB_AREA > min_area:
-                larger_basin = gdf.find_next_level_larger(row.PFAF_ID)
-                larger_basin_index = larger_basin.index[0] if len(larger_basin) else -1
-                if larger_basin_index not in all_good_index:
-                    good_index.add(row_index)
-                all_good_index.add(row_index)
+    Can also be used as a method on a `gpd.GeoDataFrame`:
+    `gdf.area_select_bands([(min_area1, max_area1), (min_area2, max_area2)])`
 
-    return gdf.loc[good_index]
+    :param gdf: hydrobasins geodataframe to traverse
+    :param bands: pairs of minimum and maximum area of basin
+    :return: filtered geodataframe for each band, as from `area_select`
+    """
+    masks = _area_select_masks(gdf, np.array(bands, dtype=float).reshape(-1, 2))
+    return [gdf.iloc[np.flatnonzero(mask)] for mask in masks]
 
 
 # Added to the GeoDataFrame class using:
@@ -267,3 +895,4 @@ PandasObject.find_upstream = _find_upstream
 PandasObject.find_next_level_larger = _find_next_level_larger
 PandasObject.find_next_level_smaller = _find_next_level_smaller
 PandasObject.area_select = _area_select
+PandasObject.area_select_bands = _area_select_bands
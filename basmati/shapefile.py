@@ -0,0 +1,205 @@
+"""Minimal readers for the parts of ESRI shapefiles used by HydroBASINS.
+
+Reading the attribute table (.dbf) directly is much faster than going through `gpd.read_file`, which decodes
+every polygon in the .shp file as well.
+"""
+import struct
+from collections import OrderedDict
+from functools import lru_cache
+from logging import getLogger
+from pathlib import Path
+from typing import Union, Iterable, List, Dict
+
+import numpy as np
+import pandas as pd
+from shapely.geometry import Point, Polygon, MultiPolygon
+from shapely.geometry.base import BaseGeometry
+
+logger = getLogger('basmati.shapefile')
+
+
+def _parse_numeric(raw: np.ndarray, decimals: int) -> np.ndarray:
+    dtype = np.float64 if decimals else np.int64
+    try:
+        return raw.astype(dtype)
+    except ValueError:
+        # Blank fields - fall back to slower parsing, which turns them into NaN.
+        return pd.to_numeric(np.char.strip(raw).astype(str), errors='coerce').to_numpy()
+
+
+def read_dbf(dbf_path: Union[str, Path], columns: Iterable[str] = None) -> pd.DataFrame:
+    """Read the attribute table of a shapefile from its .dbf file.
+
+    Records are parsed in one go using a numpy structured dtype that matches the fixed width record layout.
+    Integer columns are downcast to the narrowest dtype that holds their values. Float columns are kept as float64
+    so that values (e.g. areas) are unchanged.
+
+    :param dbf_path: path to .dbf file
+    :param columns: columns to read, all if `None`
+    :return: dataframe with one row per (non-deleted) record, indexed by record number
+    """
+    with open(dbf_path, 'rb') as f:
+        header = f.read(32)
+        num_records, header_len, record_len = struct.unpack('<IHH', header[4:12])
+        field_bytes = f.read(header_len - 32)
+        data = f.read(num_records * record_len)
+
+    fields = []
+    for i in range(0, len(field_bytes) - 1, 32):
+        if field_bytes[i] == 0x0D:
+            break
+        descriptor = field_bytes[i:i + 32]
+        name = descriptor[:11].split(b'\x00')[0].decode('ascii')
+        field_type = chr(descriptor[11])
+        length, decimals = descriptor[16], descriptor[17]
+        fields.append((name, field_type, length, decimals))
+    logger.debug(f'{dbf_path}: {num_records} records, fields: {[f[0] for f in fields]}')
+
+    dtype = np.dtype([('_deleted', 'S1')] + [(name, f'S{length}') for name, _, length, _ in fields])
+    assert dtype.itemsize == record_len, f'Unexpected record length in {dbf_path}'
+    records = np.frombuffer(data, dtype=dtype, count=num_records)
+    record_nums = np.flatnonzero(records['_deleted'] != b'*')
+    records = records[record_nums]
+
+    if columns is not None:
+        columns = list(columns)
+        fields = [field for field in fields if field[0] in columns]
+
+    df_data = {}
+    for name, field_type, length, decimals in fields:
+        raw = records[name]
+        if field_type in 'NF':
+            values = _parse_numeric(raw, decimals)
+            if values.dtype.kind == 'i':
+                values = pd.to_numeric(values, downcast='integer')
+        elif field_type == 'L':
+            values = np.isin(raw, [b'T', b't', b'Y', b'y'])
+        else:
+            values = np.char.strip(np.char.decode(raw, 'latin-1')).astype(object)
+        df_data[name] = values
+    df = pd.DataFrame(df_data, index=record_nums)
+    if columns is not None:
+        df = df[[column for column in columns if column in df.columns]]
+    return df
+
+
+def _signed_area(ring: np.ndarray) -> float:
+    x, y = ring[:, 0], ring[:, 1]
+    return 0.5 * float(np.dot(x[:-1], y[1:]) - np.dot(x[1:], y[:-1]))
+
+
+def _rings_to_geometry(rings: List[np.ndarray]) -> BaseGeometry:
+    # Shapefile outer rings are clockwise (negative signed area), holes are anticlockwise.
+    shells: List[np.ndarray] = []
+    holes: List[List[np.ndarray]] = []
+    hole_rings = []
+    for ring in rings:
+        if _signed_area(ring) <= 0:
+            shells.append(ring)
+            holes.append([])
+        else:
+            hole_rings.append(ring)
+    if not shells:
+        # Badly oriented data - treat all rings as shells.
+        shells, holes, hole_rings = rings, [[] for _ in rings], []
+    for hole in hole_rings:
+        owner = len(shells) - 1
+        if len(shells) > 1:
+            for i, shell in enumerate(shells):
+                if Polygon(shell).contains(Point(hole[0])):
+                    owner = i
+                    break
+        holes[owner].append(hole)
+    polygons = [Polygon(shell, shell_holes) for shell, shell_holes in zip(shells, holes)]
+    return polygons[0] if len(polygons) == 1 else MultiPolygon(polygons)
+
+
+class ShapefileGeometryReader:
+    """Decode individual geometries from a .shp file, using the record offsets in its .shx index.
+
+    The .shp file is memory-mapped, so only the bytes of the records that are decoded are read. The most recently
+    used decoded geometries are cached, up to `cache_size` of them. Supports (Multi)Polygon shapefiles, which is all
+    that HydroBASINS uses.
+    """
+
+    def __init__(self, shp_path: Union[str, Path], cache_size: int = 10000) -> None:
+        """Read the .shx index of shp_path.
+
+        :param shp_path: path to .shp file - .shx file must be alongside it
+        :param cache_size: max number of decoded geometries to keep (0 to disable caching)
+        """
+        self.shp_path = Path(shp_path)
+        shx = np.fromfile(self.shp_path.with_suffix('.shx'), dtype=np.uint8)
+        # Offsets and lengths are big-endian, in 16 bit words.
+        index = shx[100:].view('>i4').reshape(-1, 2)
+        self.offsets = index[:, 0].astype(np.int64) * 2
+        self.content_lengths = index[:, 1].astype(np.int64) * 2
+        self._shp = np.memmap(self.shp_path, dtype=np.uint8, mode='r')
+        self.cache_size = cache_size
+        self._cache: Dict[int, BaseGeometry] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def _decode(self, record_num: int) -> BaseGeometry:
+        # Skip 8 byte record header.
+        start = self.offsets[record_num] + 8
+        content = self._shp[start:start + self.content_lengths[record_num]]
+        shape_type = int(content[:4].view('<i4')[0])
+        if shape_type == 0:
+            return None
+        if shape_type not in (5, 15, 25):
+            raise ValueError(f'Unsupported shape type {shape_type} in {self.shp_path}')
+        # Skip shape type and bounding box.
+        num_parts, num_points = (int(v) for v in content[36:44].view('<i4'))
+        parts = content[44:44 + 4 * num_parts].view('<i4')
+        points_start = 44 + 4 * num_parts
+        points = content[points_start:points_start + 16 * num_points].view('<f8').reshape(-1, 2)
+        bounds = list(parts) + [num_points]
+        rings = [np.array(points[bounds[i]:bounds[i + 1]]) for i in range(num_parts)]
+        return _rings_to_geometry(rings)
+
+    def geometry(self, record_num: int) -> BaseGeometry:
+        """Geometry of one record, decoded unless it is in the cache.
+
+        :param record_num: record number (0 based)
+        :return: geometry of record
+        """
+        record_num = int(record_num)
+        if record_num in self._cache:
+            self._cache.move_to_end(record_num)
+            return self._cache[record_num]
+        geometry = self._decode(record_num)
+        if self.cache_size > 0:
+            self._cache[record_num] = geometry
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return geometry
+
+    def geometries(self, record_nums: Iterable[int]) -> np.ndarray:
+        """Geometries of several records.
+
+        :param record_nums: record numbers
+        :return: object array of geometries
+        """
+        record_nums = list(record_nums)
+        geometries = np.empty(len(record_nums), dtype=object)
+        geometries[:] = [self.geometry(record_num) for record_num in record_nums]
+        return geometries
+
+
+@lru_cache(maxsize=8)
+def _cached_geometry_reader(shp_path: str, mtime_ns: int, size: int) -> ShapefileGeometryReader:
+    return ShapefileGeometryReader(shp_path)
+
+
+def get_geometry_reader(shp_path: Union[str, Path]) -> ShapefileGeometryReader:
+    """Get a shared `ShapefileGeometryReader` for shp_path, so that decoded geometries are reused.
+
+    A new reader is created if the file has changed.
+
+    :param shp_path: path to .shp file
+    :return: reader for shp_path
+    """
+    stat = Path(shp_path).stat()
+    return _cached_geometry_reader(str(shp_path), stat.st_mtime_ns, stat.st_size)
@@ -1,5 +1,7 @@
 import contextlib
 import io
+import subprocess
+import sys
 from unittest import TestCase
 
 from mock import patch
@@ -30,12 +32,29 @@ class TestDownloadCmd(TestCase):
     @patch('basmati.basmati_cmd.download_main')
     def test2_download(self, mock_download_main):
         basmati_cmd('basmati download -d ALL -r as'.split())
-        mock_download_main.assert_called_with('ALL', 'as', False)
+        mock_download_main.assert_called_with('ALL', 'as', False, 1, None, None, None, False)
 
     @patch('basmati.basmati_cmd.download_main')
     def test3_download(self, mock_download_main):
         basmati_cmd('basmati download -d ALL -r as --delete-zip'.split())
-        mock_download_main.assert_called_with('ALL', 'as', True)
+        mock_download_main.assert_called_with('ALL', 'as', True, 1, None, None, None, False)
+
+    @patch('basmati.basmati_cmd.download_main')
+    def test4_download_jobs(self, mock_download_main):
+        basmati_cmd('basmati download -d ALL -r ALL -j 4'.split())
+        mock_download_main.assert_called_with('ALL', 'ALL', False, 4, None, None, None, False)
+
+    @patch('basmati.basmati_cmd.download_main')
+    def test5_download_extract_options(self, mock_download_main):
+        basmati_cmd('basmati download -d hydrobasins_all_levels -r as --levels 1 2 3 '
+                    '--suffixes .shp .dbf --cache-dir cache'.split())
+        mock_download_main.assert_called_with('hydrobasins_all_levels', 'as', False, 1, [1, 2, 3], ['.shp', '.dbf'],
+                                              'cache', False)
+
+    @patch('basmati.basmati_cmd.download_main')
+    def test6_download_verify(self, mock_download_main):
+        basmati_cmd('basmati download -d ALL -r ALL --verify'.split())
+        mock_download_main.assert_called_with('ALL', 'ALL', False, 1, None, None, None, True)
 
 
 class TestDemoCmd(TestCase):
@@ -44,3 +63,25 @@ class TestDemoCmd(TestCase):
         # raise Exception('mock not working')
         basmati_cmd('basmati demo'.split())
         mock_demo_main.assert_called()
+
+
+class TestBenchCmd(TestCase):
+    @patch('basmati.basmati_cmd.bench_main')
+    def test1_bench(self, mock_bench_main):
+        basmati_cmd('basmati bench'.split())
+        mock_bench_main.assert_called_with(['small'], None, 5, None)
+
+    @patch('basmati.basmati_cmd.bench_main')
+    def test2_bench_options(self, mock_bench_main):
+        basmati_cmd('basmati bench -s small medium -b find_upstream coarse_grain2d -n 2 -o bench.csv'.split())
+        mock_bench_main.assert_called_with(['small', 'medium'], ['find_upstream', 'coarse_grain2d'], 2, 'bench.csv')
+
+    def test3_bench_bad_scale(self):
+        with contextlib.redirect_stderr(io.StringIO()), self.assertRaises(SystemExit):
+            basmati_cmd('basmati bench -s huge'.split())
+
+    def test4_bench_not_imported(self):
+        # Other commands should not pay for importing the benchmarks.
+        code = "import sys, basmati.basmati_cmd; print([m for m in sys.modules if m.startswith('basmati.bench')])"
+        result = subprocess.run([sys.executable, '-c', code], check=True, stdout=subprocess.PIPE, encoding='utf8')
+        assert result.stdout.strip() == '[]'
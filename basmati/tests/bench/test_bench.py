@@ -0,0 +1,111 @@
+import contextlib
+import io
+import tempfile
+from pathlib import Path
+from unittest import TestCase
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from basmati.basmati_bench import bench_main, BENCHMARK_NAMES, SCALE_NAMES
+from basmati.bench import BENCHMARKS, SCALES, run_benchmark, run_benchmarks, synthetic_hydrobasins, random_polygons
+from basmati.hydrosheds import is_downstream
+
+
+class TestSyntheticHydrobasins(TestCase):
+    def setUp(self):
+        self.gdf = synthetic_hydrobasins(top_basins=3, levels=4, bounds=(0, 0, 10, 5))
+
+    def test1_columns(self):
+        assert list(self.gdf.columns) == ['HYBAS_ID', 'NEXT_DOWN', 'PFAF_ID', 'SUB_AREA', 'LEVEL', 'geometry',
+                                          'PFAF_STR']
+        assert self.gdf.crs == 'epsg:4326'
+        assert self.gdf.HYBAS_ID.is_unique
+        assert self.gdf.PFAF_ID.is_unique
+        assert sorted(self.gdf.LEVEL.unique()) == [1, 2, 3, 4]
+        assert (self.gdf.PFAF_STR.str.len() == self.gdf.LEVEL).all()
+
+    def test2_next_down(self):
+        pfaf_of_hybas = dict(zip(self.gdf.HYBAS_ID, self.gdf.PFAF_ID))
+        level_of_hybas = dict(zip(self.gdf.HYBAS_ID, self.gdf.LEVEL))
+        for row in self.gdf.itertuples():
+            if row.NEXT_DOWN == 0:
+                continue
+            # Drains into a basin at the same level that is downstream by Pfafstetter rules.
+            assert level_of_hybas[row.NEXT_DOWN] == row.LEVEL
+            assert is_downstream(row.PFAF_ID, pfaf_of_hybas[row.NEXT_DOWN])
+        assert set(self.gdf[self.gdf.LEVEL == 1].NEXT_DOWN) == {0}
+        # Only outlets of level 1 basins drain to the sea.
+        outlets = self.gdf[self.gdf.NEXT_DOWN == 0].PFAF_STR
+        assert outlets.str[1:].str.strip('1').eq('').all()
+
+    def test3_upstream(self):
+        level4 = self.gdf[self.gdf.LEVEL == 4]
+        for pfaf_id in level4.PFAF_ID.values[::50]:
+            upstream = set(self.gdf.find_upstream(pfaf_id).PFAF_ID)
+            expected = {p for p in level4.PFAF_ID if str(p)[0] == str(pfaf_id)[0] and is_downstream(p, pfaf_id)}
+            assert upstream == expected
+
+    def test4_geometry(self):
+        for level in range(1, 5):
+            gdf_level = self.gdf[self.gdf.LEVEL == level]
+            assert np.isclose(shapely.union_all(gdf_level.geometry.values).area, 50)
+            assert np.isclose(shapely.area(gdf_level.geometry.values).sum(), 50)
+        # Areas are nested, so SUB_AREA never increases going to smaller basins.
+        sub_area = dict(zip(self.gdf.PFAF_ID, self.gdf.SUB_AREA))
+        for row in self.gdf[self.gdf.LEVEL > 1].itertuples():
+            assert row.SUB_AREA <= sub_area[row.PFAF_ID // 10]
+
+    def test5_seed(self):
+        assert self.gdf.equals(synthetic_hydrobasins(top_basins=3, levels=4, bounds=(0, 0, 10, 5)))
+        assert not self.gdf.equals(synthetic_hydrobasins(top_basins=3, levels=4, bounds=(0, 0, 10, 5), seed=1))
+        with self.assertRaises(ValueError):
+            synthetic_hydrobasins(top_basins=10)
+
+
+class TestRandomPolygons(TestCase):
+    def test1_polygons(self):
+        polygons = random_polygons((4, 6), (0, 0, 12, 4), num_vertices=10)
+        assert len(polygons) == 24
+        assert shapely.is_valid(polygons).all()
+        assert shapely.get_num_coordinates(polygons).tolist() == [11] * 24
+        # Each polygon is in its own grid cell.
+        centroids = shapely.get_coordinates(shapely.centroid(polygons))
+        assert (np.floor(centroids[:, 0] / 2) == np.tile(np.arange(6), 4)).all()
+        assert (np.floor(centroids[:, 1]) == np.repeat(np.arange(4), 6)).all()
+        assert not shapely.intersects(polygons[:, None], polygons[None, :])[~np.eye(24, dtype=bool)].any()
+
+
+class TestBenchmarks(TestCase):
+    def test1_run_benchmark(self):
+        for benchmark_cls in BENCHMARKS:
+            result = run_benchmark(benchmark_cls, 'small', repeat=1)
+            assert result['name'] == benchmark_cls.name
+            assert result['size'] > 0
+            assert result['min_s'] > 0
+            assert result['peak_mem_MiB'] >= 0
+
+    def test2_run_benchmarks(self):
+        results = run_benchmarks(['small'], ['find_upstream', 'coarse_grain2d'], repeat=2)
+        assert list(results.name) == ['find_upstream', 'coarse_grain2d']
+        assert (results.min_s <= results.median_s).all()
+        with self.assertRaises(ValueError):
+            run_benchmarks(['huge'])
+        with self.assertRaises(ValueError):
+            run_benchmarks(['small'], ['find_everything'])
+        with self.assertRaises(ValueError):
+            run_benchmark(BENCHMARKS[0], 'small', repeat=0)
+
+    def test3_bench_main(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            output = Path(tempdir) / 'bench.csv'
+            with contextlib.redirect_stdout(io.StringIO()) as stdout:
+                results = bench_main(['small'], ['area_select'], 1, str(output))
+            assert 'area_select' in stdout.getvalue()
+            pd.testing.assert_frame_equal(pd.read_csv(output), results)
+
+    def test4_names(self):
+        # Command line choices are listed separately, so that it does not need to import basmati.bench.
+        assert SCALE_NAMES == list(SCALES)
+        assert BENCHMARK_NAMES == [cls.name for cls in BENCHMARKS]
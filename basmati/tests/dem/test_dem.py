@@ -0,0 +1,73 @@
+import tempfile
+from pathlib import Path
+from unittest import TestCase
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+from basmati.hydrosheds import load_hydrosheds_dem
+
+
+class TestLoadDem(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tempdir = tempfile.TemporaryDirectory()
+        cls.hydrosheds_dir = Path(cls.tempdir.name)
+        cls.dem = np.arange(20 * 30, dtype=np.int16).reshape(20, 30)
+        cls.dem[0, :5] = -32768
+        with rasterio.open(cls.hydrosheds_dir / 'sy_dem_30s.bil', 'w', driver='EHdr', height=20, width=30,
+                           count=1, dtype='int16', nodata=-32768, transform=from_origin(60, 40, 0.5, 0.5)) as dem_buf:
+            dem_buf.write(cls.dem, 1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tempdir.cleanup()
+
+    def test1_load_full(self):
+        bounds, tx, dem, mask = load_hydrosheds_dem(self.hydrosheds_dir, 'sy')
+        assert (dem == self.dem).all()
+        assert (mask[0, :5] == 255).all() and (mask[1:] == 0).all()
+        assert tuple(bounds) == (60, 30, 75, 40)
+        assert tx == from_origin(60, 40, 0.5, 0.5)
+
+    def test2_load_window(self):
+        bounds, tx, dem, mask = load_hydrosheds_dem(self.hydrosheds_dir, 'sy', window=((2, 10), (3, 7)))
+        assert (dem == self.dem[2:10, 3:7]).all()
+        assert tuple(bounds) == (61.5, 35, 63.5, 39)
+        assert tx == from_origin(61.5, 39, 0.5, 0.5)
+
+    def test3_load_bounds(self):
+        bounds_window = load_hydrosheds_dem(self.hydrosheds_dir, 'sy', window=((2, 10), (3, 7)))
+        bounds_bounds = load_hydrosheds_dem(self.hydrosheds_dir, 'sy', bounds=(61.6, 35, 63.4, 38.9))
+        assert bounds_window[0] == bounds_bounds[0]
+        assert (bounds_window[2] == bounds_bounds[2]).all()
+
+    def test4_load_mmap(self):
+        for kwargs in [{}, {'window': ((0, 10), (2, 7))}, {'bounds': (70, 30, 80, 35)}]:
+            bounds, tx, dem, mask = load_hydrosheds_dem(self.hydrosheds_dir, 'sy', **kwargs)
+            bounds_mm, tx_mm, dem_mm, mask_mm = load_hydrosheds_dem(self.hydrosheds_dir, 'sy', mmap=True, **kwargs)
+            assert isinstance(dem_mm, np.memmap)
+            assert bounds == bounds_mm and tx == tx_mm
+            assert (dem == dem_mm).all()
+            assert (mask == mask_mm).all() and mask.dtype == mask_mm.dtype
+
+    def test5_load_mmap_unsupported_layout(self):
+        with rasterio.open(self.hydrosheds_dir / 'sz_dem_30s.bil', 'w', driver='EHdr', height=20, width=30,
+                           count=2, dtype='int16', nodata=-32768, transform=from_origin(60, 40, 0.5, 0.5)) as dem_buf:
+            dem_buf.write(np.stack([self.dem, -self.dem]))
+        with self.assertLogs('basmati.hydrosheds', 'WARNING') as logs:
+            bounds, tx, dem, mask = load_hydrosheds_dem(self.hydrosheds_dir, 'sz', window=((2, 10), (3, 7)), mmap=True)
+        assert 'NBANDS 2' in logs.output[0]
+        assert not isinstance(dem, np.memmap)
+        assert (dem == self.dem[2:10, 3:7]).all()
+
+        # Header bytes at the start of the file.
+        (self.hydrosheds_dir / 'sx_dem_30s.bil').write_bytes(
+            b'\0' * 16 + (self.hydrosheds_dir / 'sy_dem_30s.bil').read_bytes())
+        hdr = (self.hydrosheds_dir / 'sy_dem_30s.hdr').read_text()
+        (self.hydrosheds_dir / 'sx_dem_30s.hdr').write_text(hdr + 'SKIPBYTES      16\n')
+        with self.assertLogs('basmati.hydrosheds', 'WARNING') as logs:
+            bounds, tx, dem, mask = load_hydrosheds_dem(self.hydrosheds_dir, 'sx', mmap=True)
+        assert 'SKIPBYTES 16' in logs.output[0]
+        assert (dem == self.dem).all()
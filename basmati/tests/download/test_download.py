@@ -1,13 +1,22 @@
+import json
 import os
+import re
+import socket
 import tempfile
+import threading
+import zipfile
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from functools import partial
 from pathlib import Path
 from unittest import TestCase
 
 from mock import patch, call
 
 from basmati.basmati_errors import BasmatiError
-from basmati.downloader import (download_main, HydroshedsDownloader, UnrecognizedRegionError,
-                                HYDROBASINS_REGIONS)
+from basmati.version import get_version
+from basmati.downloader import (download_main, download_file, download_file_wget, ConnectionPool,
+                                DownloadCancelledError, HydroshedsDownloader, UnrecognizedRegionError,
+                                HYDROBASINS_REGIONS, HYDROSHEDS_URLS)
 
 
 class TestDownloadMainUnit(TestCase):
@@ -61,6 +70,19 @@ class TestDownloadMainUnit(TestCase):
         download_main('hydrobasins_all_levels', 'ALL', False)
         mock_dl.mock_calls = [call(r) for r in HYDROBASINS_REGIONS]
 
+    @patch.dict('os.environ', {'HYDROSHEDS_DIR': 'dummy_dir'})
+    @patch.object(HydroshedsDownloader, 'download_hydrobasins_all_levels')
+    @patch.object(HydroshedsDownloader, 'download_hydrosheds_dem_30s')
+    def test8_download_main_jobs(self, mock_dl_dem, mock_dl_hb):
+        download_main('ALL', 'ALL', False, jobs=4)
+        assert sorted(c.args[0] for c in mock_dl_dem.mock_calls) == sorted(HYDROBASINS_REGIONS[1:])
+        assert sorted(c.args[0] for c in mock_dl_hb.mock_calls) == sorted(HYDROBASINS_REGIONS[1:])
+
+    @patch.dict('os.environ', {'HYDROSHEDS_DIR': 'dummy_dir'})
+    def test9_download_main_bad_jobs(self):
+        with self.assertRaises(BasmatiError):
+            download_main('ALL', 'ALL', False, jobs=0)
+
 
 class TestHydroshedsDownloaderUnit(TestCase):
     @classmethod
@@ -86,7 +108,7 @@ class TestHydroshedsDownloaderUnit(TestCase):
         with self.assertRaises(UnrecognizedRegionError):
             dl.download_hydrobasins_all_levels('mordor')
 
-    @patch('basmati.downloader.download_file_wget')
+    @patch('basmati.downloader.download_file')
     def test4_hs_dl(self, mock_dl):
         dl = HydroshedsDownloader(self.tempdir.name, False)
         dl.download_hydrobasins_all_levels('as')
@@ -97,7 +119,7 @@ class TestHydroshedsDownloaderUnit(TestCase):
         with self.assertRaises(UnrecognizedRegionError):
             dl.download_hydrosheds_dem_30s('mordor')
 
-    @patch('basmati.downloader.download_file_wget')
+    @patch('basmati.downloader.download_file')
     def test6_hs_dl(self, mock_dl):
         dl = HydroshedsDownloader(self.tempdir.name, False)
         dl.download_hydrosheds_dem_30s('as')
@@ -139,3 +161,365 @@ class TestHydroshedsDownloader(TestCase):
         # Check Europe hydrosheds DEM file exists, and zipfile deleted.
         assert (self.hydrosheds_dir / 'eu_dem_30s.bil').exists()
         assert not (self.hydrosheds_dir / 'eu_dem_30s.zip').exists()
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """Keep-alive static file handler that supports `Range: bytes=<start>-` requests and `/redirect/<path>`.
+
+    Records the requests it gets, and the client port and User-Agent of each.
+    """
+    protocol_version = 'HTTP/1.1'
+    requests = []
+    client_ports = []
+    user_agents = []
+    ignore_range = False
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        RangeRequestHandler.requests.append((self.path, self.headers.get('Range')))
+        RangeRequestHandler.client_ports.append(self.client_address[1])
+        RangeRequestHandler.user_agents.append(self.headers.get('User-Agent'))
+        if self.path.startswith('/redirect/'):
+            self.send_response(302)
+            self.send_header('Location', self.path[len('/redirect'):])
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        range_header = '' if RangeRequestHandler.ignore_range else self.headers.get('Range', '')
+        match = re.match(r'bytes=(\d+)-$', range_header)
+        path = Path(self.translate_path(self.path))
+        if not match or not path.is_file():
+            return super().do_GET()
+        data = path.read_bytes()
+        start = int(match.group(1))
+        self.send_response(206)
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header('Content-Length', str(len(data) - start))
+        self.send_header('Content-Range', f'bytes {start}-{len(data) - 1}/{len(data)}')
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+
+def _write_zip(zippath, members):
+    with zipfile.ZipFile(zippath, 'w') as zf:
+        for name, data in members.items():
+            zf.writestr(name, data)
+
+
+class TestHydroshedsDownloaderLocalServer(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.serve_dir = Path(self.tempdir.name) / 'serve'
+        self.hydrosheds_dir = Path(self.tempdir.name) / 'hydrosheds'
+        self.serve_dir.mkdir()
+        self.hydrosheds_dir.mkdir()
+        self.hb_members = {f'hybas_as_lev{level:02}_v1c.dbf': os.urandom(100000) for level in range(1, 4)}
+        self.dem_members = {'as_dem_30s.bil': os.urandom(300000), 'as_dem_30s.hdr': b'NROWS 1'}
+        _write_zip(self.serve_dir / 'hybas_as_lev01-12_v1c.zip', self.hb_members)
+        _write_zip(self.serve_dir / 'as_dem_30s_bil.zip', self.dem_members)
+
+        handler = partial(RangeRequestHandler, directory=str(self.serve_dir))
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        base_url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        RangeRequestHandler.requests = []
+        RangeRequestHandler.client_ports = []
+        RangeRequestHandler.user_agents = []
+        RangeRequestHandler.ignore_range = False
+        self.base_url = base_url
+        self.urls = {
+            'hydrobasins_all_levels': {'as': (f'{base_url}/hybas_as_lev01-12_v1c.zip', 'hybas_as_lev01-12_v1c.zip')},
+            'hydrosheds_dem_30s': {'as': (f'{base_url}/as_dem_30s_bil.zip', 'as_dem_30s_bil.zip')},
+        }
+
+    def tearDown(self):
+        RangeRequestHandler.ignore_range = False
+        self.server.shutdown()
+        self.server.server_close()
+        self.tempdir.cleanup()
+
+    def _check_members(self, members):
+        for name, data in members.items():
+            assert (self.hydrosheds_dir / name).read_bytes() == data
+
+    def test1_resume(self):
+        zip_data = (self.serve_dir / 'hybas_as_lev01-12_v1c.zip').read_bytes()
+        partpath = self.hydrosheds_dir / 'hybas_as_lev01-12_v1c.zip.part'
+        partpath.write_bytes(zip_data[:123456])
+        with patch.dict(HYDROSHEDS_URLS, self.urls):
+            dl = HydroshedsDownloader(self.hydrosheds_dir, False)
+            dl.download_hydrobasins_all_levels('as')
+        assert not partpath.exists()
+        assert (self.hydrosheds_dir / 'hybas_as_lev01-12_v1c.zip').read_bytes() == zip_data
+        assert RangeRequestHandler.requests == [('/hybas_as_lev01-12_v1c.zip', 'bytes=123456-')]
+        self._check_members(self.hb_members)
+
+    def test2_download_main_jobs(self):
+        with patch.dict(HYDROSHEDS_URLS, self.urls), \
+                patch.dict('os.environ', {'HYDROSHEDS_DIR': str(self.hydrosheds_dir)}):
+            download_main('ALL', 'as', True, jobs=2)
+        assert len(RangeRequestHandler.requests) == 2
+        assert not list(self.hydrosheds_dir.glob('*.zip*'))
+        self._check_members(self.hb_members)
+        self._check_members(self.dem_members)
+
+    def test3_levels_cache_dir(self):
+        from basmati.tests.hydrobasins.test_hydrobasins import _write_synthetic_hydrobasins
+        shapefile_dir = Path(self.tempdir.name) / 'shapefiles'
+        shapefile_dir.mkdir()
+        _write_synthetic_hydrobasins(shapefile_dir)
+        members = {path.name: path.read_bytes() for path in sorted(shapefile_dir.iterdir())}
+        assert len(members) > 4
+        _write_zip(self.serve_dir / 'hybas_as_lev01-12_v1c.zip', members)
+        cache_dir = Path(self.tempdir.name) / 'cache'
+
+        with patch.dict(HYDROSHEDS_URLS, self.urls):
+            dl = HydroshedsDownloader(self.hydrosheds_dir, True, levels=[1], cache_dir=cache_dir)
+            dl.download_hydrobasins_all_levels('as')
+        expected = {name: data for name, data in members.items() if '_lev01_' in name}
+        assert sorted(path.name for path in self.hydrosheds_dir.iterdir() if path.is_file()) == sorted(expected)
+        self._check_members(expected)
+        assert [path.name.split('.')[0] for path in cache_dir.glob('*.parquet')] == ['hybas_sy_lev01_v1c']
+
+    def test4_cache_dir_earlier_members(self):
+        from basmati.tests.hydrobasins.test_hydrobasins import _write_synthetic_hydrobasins
+        shapefile_dir = Path(self.tempdir.name) / 'shapefiles'
+        shapefile_dir.mkdir()
+        _write_synthetic_hydrobasins(shapefile_dir)
+        # No .prj files: they are not needed to build the cache.
+        members = {path.name: path.read_bytes() for path in sorted(shapefile_dir.iterdir())
+                   if '_lev01_' in path.name and path.suffix != '.prj'}
+        _write_zip(self.serve_dir / 'hybas_as_lev01-12_v1c.zip', members)
+        cache_dir = Path(self.tempdir.name) / 'cache'
+
+        self._download()
+        assert not list(cache_dir.glob('*.parquet'))
+        # Only the .dbf is extracted again, the .shp and .shx are from the first run.
+        (self.hydrosheds_dir / 'hybas_sy_lev01_v1c.dbf').unlink()
+        self._download(cache_dir=cache_dir)
+        assert len(RangeRequestHandler.requests) == 1
+        assert [path.name.split('.')[0] for path in cache_dir.glob('*.parquet')] == ['hybas_sy_lev01_v1c']
+
+    def _download(self, delete_zip=False, **kwargs):
+        with patch.dict(HYDROSHEDS_URLS, self.urls):
+            dl = HydroshedsDownloader(self.hydrosheds_dir, delete_zip, **kwargs)
+            dl.download_hydrobasins_all_levels('as')
+        return dl
+
+    def test5_manifest(self):
+        dl = self._download()
+        manifest = json.loads(dl.manifest_path('hydrobasins_all_levels', 'as').read_text())
+        assert sorted(manifest['members']) == sorted(self.hb_members)
+        assert manifest['zip']['size'] == (self.hydrosheds_dir / 'hybas_as_lev01-12_v1c.zip').stat().st_size
+        assert len(RangeRequestHandler.requests) == 1
+
+        # Complete - nothing fetched.
+        self._download()
+        assert len(RangeRequestHandler.requests) == 1
+
+        # Missing and corrupt members are extracted from the intact zip file.
+        names = sorted(self.hb_members)
+        (self.hydrosheds_dir / names[0]).unlink()
+        (self.hydrosheds_dir / names[1]).write_bytes(os.urandom(len(self.hb_members[names[1]])))
+        self._download()
+        assert len(RangeRequestHandler.requests) == 1
+        self._check_members(self.hb_members)
+
+        # Corrupt zip file is fetched again.
+        zippath = self.hydrosheds_dir / 'hybas_as_lev01-12_v1c.zip'
+        zippath.write_bytes(zippath.read_bytes() + b'x')
+        (self.hydrosheds_dir / names[2]).unlink()
+        self._download()
+        assert len(RangeRequestHandler.requests) == 2
+        self._check_members(self.hb_members)
+        assert zippath.read_bytes() == (self.serve_dir / 'hybas_as_lev01-12_v1c.zip').read_bytes()
+
+    def test6_full_verify(self):
+        self._download()
+        # Corrupt a member without changing its size or mtime.
+        path = self.hydrosheds_dir / sorted(self.hb_members)[0]
+        stat = path.stat()
+        path.write_bytes(os.urandom(stat.st_size))
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        self._download()
+        assert path.read_bytes() != self.hb_members[path.name]
+        self._download(full_verify=True)
+        self._check_members(self.hb_members)
+        assert len(RangeRequestHandler.requests) == 1
+
+    def test7_manifest_delete_zip(self):
+        self._download(delete_zip=True)
+        assert not (self.hydrosheds_dir / 'hybas_as_lev01-12_v1c.zip').exists()
+        names = sorted(self.hb_members)
+        (self.hydrosheds_dir / names[0]).unlink()
+        mtime_ns = (self.hydrosheds_dir / names[1]).stat().st_mtime_ns
+        self._download(delete_zip=True)
+        assert len(RangeRequestHandler.requests) == 2
+        self._check_members(self.hb_members)
+        # Only the missing member was extracted again.
+        assert (self.hydrosheds_dir / names[1]).stat().st_mtime_ns == mtime_ns
+        assert not (self.hydrosheds_dir / 'hybas_as_lev01-12_v1c.zip').exists()
+
+    def test8_zip_optional(self):
+        self._download()
+        zippath = self.hydrosheds_dir / 'hybas_as_lev01-12_v1c.zip'
+        zippath.unlink()
+        # All members are intact, so the zip file is not needed.
+        self._download()
+        assert len(RangeRequestHandler.requests) == 1
+        assert not zippath.exists()
+        (self.hydrosheds_dir / sorted(self.hb_members)[0]).unlink()
+        self._download()
+        assert len(RangeRequestHandler.requests) == 2
+        self._check_members(self.hb_members)
+
+    def test9_bootstrap_manifest(self):
+        dl = self._download(delete_zip=True)
+        manifest_path = dl.manifest_path('hydrobasins_all_levels', 'as')
+        manifest_path.unlink()
+        # Files from e.g. an older version are used as they are, without hashing them.
+        self._download(delete_zip=True)
+        assert len(RangeRequestHandler.requests) == 1
+        manifest = json.loads(manifest_path.read_text())
+        assert sorted(manifest['all_members']) == sorted(self.hb_members)
+        assert all(record['sha256'] is None for record in manifest['members'].values())
+
+        names = sorted(self.hb_members)
+        (self.hydrosheds_dir / names[0]).unlink()
+        self._download(delete_zip=True)
+        assert len(RangeRequestHandler.requests) == 2
+        self._check_members(self.hb_members)
+        manifest = json.loads(manifest_path.read_text())
+        assert manifest['members'][names[0]]['sha256'] is not None
+        assert manifest['members'][names[1]]['sha256'] is None
+
+    def test10_bootstrap_manifest_from_zip(self):
+        dl = self._download()
+        manifest_path = dl.manifest_path('hydrobasins_all_levels', 'as')
+        manifest_path.unlink()
+        names = sorted(self.hb_members)
+        (self.hydrosheds_dir / names[0]).unlink()
+        # Corrupt a member without changing its size: only found with full_verify, which checks it against the zip.
+        path = self.hydrosheds_dir / names[1]
+        path.write_bytes(os.urandom(path.stat().st_size))
+        self._download(full_verify=True)
+        assert len(RangeRequestHandler.requests) == 1
+        self._check_members(self.hb_members)
+        manifest = json.loads(manifest_path.read_text())
+        assert all(record['sha256'] is not None for record in manifest['members'].values())
+
+    def test11_download_main_rerun(self):
+        with patch.dict(HYDROSHEDS_URLS, self.urls), \
+                patch.dict('os.environ', {'HYDROSHEDS_DIR': str(self.hydrosheds_dir)}):
+            download_main('ALL', 'ALL', False, jobs=4)
+            assert len(RangeRequestHandler.requests) == 2
+            download_main('ALL', 'ALL', False, jobs=4)
+        assert len(RangeRequestHandler.requests) == 2
+        self._check_members(self.hb_members)
+        self._check_members(self.dem_members)
+
+    def test12_redirect(self):
+        filename = Path('as_dem_30s_bil.zip')
+        download_file(f'{self.base_url}/redirect/{filename}', self.hydrosheds_dir, filename, pool=ConnectionPool())
+        assert (self.hydrosheds_dir / filename).read_bytes() == (self.serve_dir / filename).read_bytes()
+        assert RangeRequestHandler.requests == [(f'/redirect/{filename}', None), (f'/{filename}', None)]
+
+    def test13_connection_reuse(self):
+        pool = ConnectionPool()
+        for filename in ['as_dem_30s_bil.zip', 'hybas_as_lev01-12_v1c.zip']:
+            download_file(f'{self.base_url}/redirect/{filename}', self.hydrosheds_dir, Path(filename), pool=pool)
+        pool.close()
+        assert len(RangeRequestHandler.client_ports) == 4
+        assert len(set(RangeRequestHandler.client_ports)) == 1
+
+    def test14_server_ignores_range(self):
+        RangeRequestHandler.ignore_range = True
+        filename = Path('as_dem_30s_bil.zip')
+        zip_data = (self.serve_dir / filename).read_bytes()
+        (self.hydrosheds_dir / f'{filename}.part').write_bytes(b'x' * 1000)
+        download_file(f'{self.base_url}/{filename}', self.hydrosheds_dir, filename, pool=ConnectionPool())
+        assert (self.hydrosheds_dir / filename).read_bytes() == zip_data
+
+    def test15_already_complete(self):
+        filename = Path('as_dem_30s_bil.zip')
+        zip_data = (self.serve_dir / filename).read_bytes()
+        (self.hydrosheds_dir / f'{filename}.part').write_bytes(zip_data)
+        download_file(f'{self.base_url}/{filename}', self.hydrosheds_dir, filename, pool=ConnectionPool())
+        assert (self.hydrosheds_dir / filename).read_bytes() == zip_data
+
+    def test16_errors(self):
+        with self.assertRaises(BasmatiError):
+            download_file(f'{self.base_url}/missing.zip', self.hydrosheds_dir, Path('missing.zip'))
+        assert not (self.hydrosheds_dir / 'missing.zip.part').exists()
+        filename = Path('as_dem_30s_bil.zip')
+        (self.hydrosheds_dir / filename).write_bytes(b'')
+        with self.assertRaises(BasmatiError):
+            download_file(f'{self.base_url}/{filename}', self.hydrosheds_dir, filename)
+
+    def test17_progress_log(self):
+        filename = Path('as_dem_30s_bil.zip')
+        with self.assertLogs('basmati.download', 'INFO') as logs:
+            download_file(f'{self.base_url}/{filename}', self.hydrosheds_dir, filename, pool=ConnectionPool(),
+                          chunk_size=1000, progress_interval=0)
+        assert any('MiB/s' in line and '%' in line for line in logs.output)
+        assert any(line.endswith('MiB/s)') and 'Downloaded' in line for line in logs.output)
+
+    def test18_user_agent(self):
+        filename = Path('as_dem_30s_bil.zip')
+        download_file(f'{self.base_url}/redirect/{filename}', self.hydrosheds_dir, filename, pool=ConnectionPool())
+        assert RangeRequestHandler.user_agents == [f'basmati/{get_version()}'] * 2
+
+    def test19_download_file_wget(self):
+        filename = Path('as_dem_30s_bil.zip')
+        with self.assertWarns(DeprecationWarning):
+            filepath = download_file_wget(f'{self.base_url}/{filename}', self.hydrosheds_dir, filename)
+        assert filepath.read_bytes() == (self.serve_dir / filename).read_bytes()
+
+    def test20_failed_connection_closed(self):
+        # Server that accepts connections but never responds.
+        listener = socket.create_server(('127.0.0.1', 0))
+        self.addCleanup(listener.close)
+        accepted = []
+        thread = threading.Thread(target=lambda: accepted.extend(listener.accept() for _ in range(2)), daemon=True)
+        thread.start()
+        pool = ConnectionPool(timeout=0.1)
+        conns = []
+        new_connection = pool._new_connection
+        with patch.object(pool, '_new_connection', lambda key: conns.append(new_connection(key)) or conns[-1]):
+            for _ in range(2):
+                with self.assertRaises(socket.timeout):
+                    pool.request(f'http://127.0.0.1:{listener.getsockname()[1]}/file.zip')
+        thread.join()
+        for conn, _ in accepted:
+            conn.close()
+        assert len(conns) == 2
+        assert all(conn.sock is None for conn in conns)
+
+    def test21_corrupt_member(self):
+        zippath = self.serve_dir / 'hybas_as_lev01-12_v1c.zip'
+        zip_data = zippath.read_bytes()
+        corrupt_data = bytearray(zip_data)
+        # Flip a byte in the data of the first (stored) member.
+        corrupt_data[1000] ^= 0xFF
+        zippath.write_bytes(bytes(corrupt_data))
+        with self.assertRaises(BasmatiError):
+            self._download()
+        # Nothing is left to resume from.
+        assert not list(self.hydrosheds_dir.glob('*.zip*'))
+
+        zippath.write_bytes(zip_data)
+        self._download()
+        self._check_members(self.hb_members)
+        assert RangeRequestHandler.requests[-1] == ('/hybas_as_lev01-12_v1c.zip', None)
+
+    def test22_cancel(self):
+        filename = Path('as_dem_30s_bil.zip')
+        cancel = threading.Event()
+        cancel.set()
+        with self.assertRaises(DownloadCancelledError):
+            download_file(f'{self.base_url}/{filename}', self.hydrosheds_dir, filename, pool=ConnectionPool(),
+                          cancel=cancel)
+        assert not (self.hydrosheds_dir / filename).exists()
@@ -1,47 +1,74 @@
+import os
+import tempfile
 from pathlib import Path
 from unittest import TestCase
 import random
 
-from basmati.hydrosheds import load_hydrobasins_geodataframe, is_downstream
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from shapely.geometry import box
+
+from basmati.hydrosheds import (HYDROBASINS_FILE_TPL, load_hydrobasins_geodataframe, is_downstream,
+                                is_downstream_many, BasinNetwork, get_basin_network, clear_basin_indexes,
+                                get_pfaf_index, upstream_labels, attach_geometry)
 
 HYDROSHEDS_DIR = Path('~/HydroSHEDS').expanduser()
 
 
+IS_DOWNSTREAM_CASES = [
+    # https://en.wikipedia.org/wiki/Pfafstetter_Coding_System#Properties
+    (8835, 8833, True),
+    (8835, 8811, True),
+    (8835, 8832, False),
+    (8835, 8821, False),
+    (8835, 9135, False),
+    # Other.
+    (99, 77, True),
+    (89, 81, True),
+    (9, 7, True),
+    (9, 8, False),
+    # More digits upstream.
+    (99, 7, True),
+    (99, 8, False),
+    # More digits downstream.
+    (9, 77, True),
+    (9, 69, False),
+    # Check str OK.
+    ('89', 81, True),
+    (89, '81', True),
+    ('89', '81', True),
+    # Check 0s.
+    (43199, 43100, True),
+    (43199, 43101, True),
+    (43199, 43102, False),
+    (43199, 43120, False),
+]
+
+
 def test_is_downstream():
-    for pfaf_id_a, pfaf_id_b, expected_res in [
-        # https://en.wikipedia.org/wiki/Pfafstetter_Coding_System#Properties
-        (8835, 8833, True),
-        (8835, 8811, True),
-        (8835, 8832, False),
-        (8835, 8821, False),
-        (8835, 9135, False),
-        # Other.
-        (99, 77, True),
-        (89, 81, True),
-        (9, 7, True),
-        (9, 8, False),
-        # More digits upstream.
-        (99, 7, True),
-        (99, 8, False),
-        # More digits downstream.
-        (9, 77, True),
-        (9, 69, False),
-        # Check str OK.
-        ('89', 81, True),
-        (89, '81', True),
-        ('89', '81', True),
-        # Check 0s.
-        (43199, 43100, True),
-        (43199, 43101, True),
-        (43199, 43102, False),
-        (43199, 43120, False),
-    ]:
-        yield check_is_downstream, pfaf_id_a, pfaf_id_b, expected_res
+    for pfaf_id_a, pfaf_id_b, expected_res in IS_DOWNSTREAM_CASES:
+        check_is_downstream(pfaf_id_a, pfaf_id_b, expected_res)
+
+
+def test_is_downstream_many():
+    pfaf_ids_a, pfaf_ids_b, expected_res = zip(*IS_DOWNSTREAM_CASES)
+    assert (is_downstream_many(pfaf_ids_a, pfaf_ids_b) == np.array(expected_res)).all()
+    assert not is_downstream_many(8835, 8835)
+
+
+def test_is_downstream_many_outer():
+    pfaf_ids = [41, 42, 43, 44, 45, 49]
+    res = is_downstream_many(pfaf_ids, pfaf_ids, outer=True)
+    assert res.shape == (6, 6)
+    for i, pfaf_id_a in enumerate(pfaf_ids):
+        for j, pfaf_id_b in enumerate(pfaf_ids):
+            assert res[i, j] == is_downstream(pfaf_id_a, pfaf_id_b)
 
 
 def check_is_downstream(pfaf_id_a, pfaf_id_b, expected_res):
-    print(f'{pfaf_id_b} is downstream of {pfaf_id_a}: {expected_res}')
-    assert is_downstream(pfaf_id_a, pfaf_id_b) == expected_res
+    assert is_downstream(pfaf_id_a, pfaf_id_b) == expected_res, \
+        f'{pfaf_id_b} is downstream of {pfaf_id_a}: expected {expected_res}'
 
 
 class TestHydrobasinsLoad(TestCase):
@@ -129,3 +156,202 @@ class TestHydrobasinsOperations(TestCase):
                 break
             assert (gdf_smaller.LEVEL.values == curr_level).all()
             curr_row = gdf_smaller.iloc[random.randint(0, len(gdf_smaller) - 1)]
+
+
+def _synthetic_gdf():
+    """Two level 1 basins (4, 5) split into level 2 basins following Pfafstetter flow rules."""
+    pfaf_next_down = {
+        4: 0, 5: 0,
+        41: 0, 42: 41, 43: 41, 44: 43, 45: 43, 46: 45, 47: 45, 48: 47, 49: 47,
+        51: 0, 52: 51, 53: 51,
+    }
+    pfaf_ids = list(pfaf_next_down.keys())
+    df = pd.DataFrame({
+        'HYBAS_ID': [1000 + p for p in pfaf_ids],
+        'NEXT_DOWN': [1000 + n if n else 0 for n in pfaf_next_down.values()],
+        'PFAF_ID': pfaf_ids,
+        'LEVEL': [len(str(p)) for p in pfaf_ids],
+        'SUB_AREA': [900., 300.] + [100.] * 9 + [100.] * 3,
+    })
+    gdf = gpd.GeoDataFrame(df)
+    gdf['PFAF_STR'] = gdf.PFAF_ID.apply(str)
+    return gdf
+
+
+class TestBasinNetwork(TestCase):
+    def setUp(self):
+        self.gdf = _synthetic_gdf()
+
+    def test1_network(self):
+        network = BasinNetwork.from_gdf(self.gdf, 2)
+        assert len(network) == 12
+        pos43 = network.position(1043)
+        assert sorted(network.hybas_id[network.children(pos43)]) == [1044, 1045]
+        assert network.parent[network.position(1041)] == -1
+        with self.assertRaises(KeyError):
+            network.position(1004)
+
+    def test2_upstream(self):
+        upstream = self.gdf.find_upstream(45)
+        assert list(upstream.PFAF_ID) == [46, 47, 48, 49]
+        assert len(self.gdf.find_upstream(41)) == 8
+        assert len(self.gdf.find_upstream(49)) == 0
+
+    def test3_downstream(self):
+        downstream = self.gdf.find_downstream(48)
+        assert list(downstream.PFAF_ID) == [41, 43, 45, 47]
+        assert len(self.gdf.find_downstream(51)) == 0
+        for pfaf_id in downstream.PFAF_ID:
+            assert is_downstream(48, pfaf_id)
+
+    def test4_network_cached(self):
+        assert get_basin_network(self.gdf, 2) is get_basin_network(self.gdf, 2)
+        assert get_basin_network(self.gdf[self.gdf.LEVEL == 2], 2) is not get_basin_network(self.gdf, 2)
+
+    def test5_upstream_labels(self):
+        labels = upstream_labels(self.gdf, 2)
+        assert list(labels.index) == list(self.gdf.index[self.gdf.LEVEL == 2])
+        labels = labels.set_index('HYBAS_ID')
+        assert (labels.loc[[1045, 1049, 1041], 'OUTLET_ID'] == 1041).all()
+        assert (labels.loc[[1052, 1053], 'OUTLET_ID'] == 1051).all()
+        assert labels.loc[1045, 'UPSTREAM_IDS'][0] == 1045
+        assert sorted(labels.loc[1045, 'UPSTREAM_IDS']) == [1045, 1046, 1047, 1048, 1049]
+        assert len(labels.loc[1041, 'UPSTREAM_IDS']) == 9
+        for hybas_id in [1041, 1047, 1051]:
+            pfaf_id = hybas_id - 1000
+            upstream = self.gdf.find_upstream(pfaf_id)
+            assert sorted(labels.loc[hybas_id, 'UPSTREAM_IDS'][1:]) == sorted(upstream.HYBAS_ID)
+
+    def test6_network_rebuilt_when_modified(self):
+        network = get_basin_network(self.gdf, 2)
+        self.gdf.sort_values('HYBAS_ID', ascending=False, inplace=True)
+        assert get_basin_network(self.gdf, 2) is not network
+        assert list(self.gdf.find_upstream(45).PFAF_ID) == [49, 48, 47, 46]
+
+        network = get_basin_network(self.gdf, 2)
+        # Values edited in place are not detected: 49 now drains into 41 instead of 47.
+        self.gdf.loc[self.gdf.PFAF_ID == 49, 'NEXT_DOWN'] = 1041
+        clear_basin_indexes(self.gdf)
+        assert get_basin_network(self.gdf, 2) is not network
+        assert list(self.gdf.find_upstream(45).PFAF_ID) == [48, 47, 46]
+        assert list(self.gdf.find_downstream(49).PFAF_ID) == [41]
+
+    def test7_downstream_unsorted(self):
+        # The start basin is excluded wherever it is in the frame (the original implementation dropped the last
+        # row, so was only correct if the start basin came after all of its downstream basins).
+        shuffled = self.gdf.sample(frac=1, random_state=0)
+        for pfaf_id in [48, 45, 53]:
+            downstream = shuffled.find_downstream(pfaf_id)
+            assert pfaf_id not in list(downstream.PFAF_ID)
+            assert sorted(downstream.PFAF_ID) == sorted(self.gdf.find_downstream(pfaf_id).PFAF_ID)
+        assert sorted(self.gdf.sort_values('PFAF_ID', ascending=False).find_downstream(48).PFAF_ID) == [41, 43, 45, 47]
+
+
+class TestPfafIndex(TestCase):
+    def setUp(self):
+        self.gdf = _synthetic_gdf()
+
+    def test1_index(self):
+        pfaf_index = get_pfaf_index(self.gdf)
+        assert pfaf_index is get_pfaf_index(self.gdf)
+        pos4 = pfaf_index.position(4)
+        assert list(pfaf_index.pfaf_id[pfaf_index.children(pos4)]) == list(range(41, 50))
+        assert pfaf_index.parent[pfaf_index.position(53)] == pfaf_index.position(5)
+        assert pfaf_index.parent[pos4] == -1
+        assert list(pfaf_index.positions([5, 6])) == [pfaf_index.position(5), -1]
+
+    def test2_level_larger(self):
+        assert list(self.gdf.find_next_level_larger(47).PFAF_ID) == [4]
+        assert len(self.gdf.find_next_level_larger(4)) == 0
+        assert len(self.gdf.find_next_level_larger(61)) == 0
+
+    def test3_level_smaller(self):
+        assert list(self.gdf.find_next_level_smaller(5).PFAF_ID) == [51, 52, 53]
+        assert len(self.gdf.find_next_level_smaller(53)) == 0
+
+    def test4_area_select(self):
+        assert list(self.gdf.area_select(200, 1000).PFAF_ID) == [4, 5]
+        assert list(self.gdf.area_select(50, 500).PFAF_ID) == [5] + list(range(41, 50))
+
+    def test5_area_select_bands(self):
+        bands = [(200, 1000), (50, 500), (1000, 2000)]
+        selected = self.gdf.area_select_bands(bands)
+        assert len(selected) == 3
+        for (min_area, max_area), gdf_selected in zip(bands, selected):
+            assert list(gdf_selected.index) == list(self.gdf.area_select(min_area, max_area).index)
+        assert len(selected[2]) == 0
+
+
+def _write_synthetic_hydrobasins(hydrosheds_dir, region='sy'):
+    gdf = _synthetic_gdf().drop(columns='PFAF_STR')
+    gdf = gdf.set_geometry([box(i, 0, i + 1, 1) for i in range(len(gdf))], crs='epsg:4326')
+    for level in [1, 2]:
+        gdf_lev = gdf[gdf.LEVEL == level].drop(columns='LEVEL')
+        gdf_lev.to_file(str(Path(hydrosheds_dir, HYDROBASINS_FILE_TPL.format(region=region, level=level))))
+
+
+class TestHydrobasinsLoadOptions(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.hydrosheds_dir = Path(self.tempdir.name)
+        self.cache_dir = self.hydrosheds_dir / 'cache'
+        _write_synthetic_hydrobasins(self.hydrosheds_dir)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test1_cache(self):
+        gdf = load_hydrobasins_geodataframe(self.hydrosheds_dir, 'sy', [1, 2])
+        gdf_cached1 = load_hydrobasins_geodataframe(self.hydrosheds_dir, 'sy', [1, 2], cache_dir=self.cache_dir)
+        assert len(list(self.cache_dir.glob('*.parquet'))) == 2
+        gdf_cached2 = load_hydrobasins_geodataframe(self.hydrosheds_dir, 'sy', [1, 2], cache_dir=self.cache_dir)
+        for gdf_cached in [gdf_cached1, gdf_cached2]:
+            assert (gdf.dtypes == gdf_cached.dtypes).all()
+            assert gdf.equals(gdf_cached)
+            assert gdf_cached.crs == gdf.crs
+
+    def test2_cache_invalidated(self):
+        load_hydrobasins_geodataframe(self.hydrosheds_dir, 'sy', [1], cache_dir=self.cache_dir)
+        cache_paths = list(self.cache_dir.glob('*.parquet'))
+        shp_path = self.hydrosheds_dir / HYDROBASINS_FILE_TPL.format(region='sy', level=1)
+        os.utime(shp_path, ns=(0, 0))
+        load_hydrobasins_geodataframe(self.hydrosheds_dir, 'sy', [1], cache_dir=self.cache_dir)
+        new_cache_paths = list(self.cache_dir.glob('*.parquet'))
+        assert len(new_cache_paths) == 1
+        assert new_cache_paths != cache_paths
+
+    def test3_columns(self):
+        for cache_dir in [None, self.cache_dir]:
+            gdf = load_hydrobasins_geodataframe(self.hydrosheds_dir, 'sy', [1, 2], cache_dir=cache_dir,
+                                                columns=['HYBAS_ID', 'NEXT_DOWN'])
+            assert list(gdf.columns) == ['HYBAS_ID', 'NEXT_DOWN', 'PFAF_ID', 'LEVEL', 'PFAF_STR']
+            assert list(gdf.find_upstream(45).PFAF_ID) == [46, 47, 48, 49]
+
+    def test4_workers(self):
+        gdf = load_hydrobasins_geodataframe(self.hydrosheds_dir, 'sy', [2, 1])
+        for use_processes in [False, True]:
+            gdf_parallel = load_hydrobasins_geodataframe(self.hydrosheds_dir, 'sy', [2, 1], workers=2,
+                                                         use_processes=use_processes)
+            assert (gdf.dtypes == gdf_parallel.dtypes).all()
+            assert gdf.equals(gdf_parallel)
+
+    def test5_no_geometry(self):
+        gdf = load_hydrobasins_geodataframe(self.hydrosheds_dir, 'sy', [1, 2])
+        df = load_hydrobasins_geodataframe(self.hydrosheds_dir, 'sy', [1, 2], geometry=False)
+        assert not isinstance(df, gpd.GeoDataFrame)
+        assert df.LEVEL.dtype == np.int8
+        for column in ['HYBAS_ID', 'NEXT_DOWN', 'PFAF_ID', 'SUB_AREA', 'LEVEL']:
+            assert (df[column].values == gdf[column].values).all()
+        assert list(df.find_upstream(45).index) == list(gdf.find_upstream(45).index)
+        assert list(df.area_select(50, 500).index) == list(gdf.area_select(50, 500).index)
+
+    def test6_attach_geometry(self):
+        gdf = load_hydrobasins_geodataframe(self.hydrosheds_dir, 'sy', [1, 2])
+        df = load_hydrobasins_geodataframe(self.hydrosheds_dir, 'sy', [1, 2], geometry=False,
+                                           columns=['HYBAS_ID', 'NEXT_DOWN'])
+        upstream = attach_geometry(df.find_upstream(45))
+        assert isinstance(upstream, gpd.GeoDataFrame)
+        assert upstream.crs == gdf.crs
+        assert upstream.geometry.equals(gdf.find_upstream(45).geometry)
+        selected = attach_geometry(df[df.PFAF_ID.isin([5, 43])])
+        assert selected.geometry.equals(gdf[gdf.PFAF_ID.isin([5, 43])].geometry)
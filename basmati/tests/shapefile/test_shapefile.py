@@ -0,0 +1,70 @@
+import tempfile
+from pathlib import Path
+from unittest import TestCase
+
+import geopandas as gpd
+from shapely.geometry import box, MultiPolygon, Polygon
+
+from basmati.shapefile import read_dbf, ShapefileGeometryReader, get_geometry_reader
+
+
+class TestShapefile(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tempdir = tempfile.TemporaryDirectory()
+        cls.shp_path = Path(cls.tempdir.name) / 'test.shp'
+        geometries = [
+            box(0, 0, 1, 1),
+            # Polygon with hole.
+            Polygon([(0, 0), (4, 0), (4, 4), (0, 4)], [[(1, 1), (2, 1), (2, 2), (1, 2)]]),
+            # MultiPolygon, second part with hole.
+            MultiPolygon([box(10, 10, 11, 11),
+                          Polygon([(20, 20), (24, 20), (24, 24), (20, 24)], [[(21, 21), (22, 21), (22, 22)]])]),
+        ]
+        cls.gdf = gpd.GeoDataFrame({'HYBAS_ID': [1010000001, 1010000002, 1010000003],
+                                    'SUB_AREA': [1.5, 12.25, 1e6],
+                                    'NAME': ['a', 'bb', 'ccc']},
+                                   geometry=geometries, crs='epsg:4326')
+        cls.gdf.to_file(str(cls.shp_path))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tempdir.cleanup()
+
+    def test1_read_dbf(self):
+        df = read_dbf(self.shp_path.with_suffix('.dbf'))
+        gdf = gpd.read_file(str(self.shp_path), ignore_geometry=True)
+        assert list(df.columns) == list(gdf.columns)
+        for column in df.columns:
+            assert list(df[column]) == list(gdf[column])
+
+    def test2_read_dbf_columns(self):
+        df = read_dbf(self.shp_path.with_suffix('.dbf'), ['SUB_AREA', 'HYBAS_ID'])
+        assert list(df.columns) == ['SUB_AREA', 'HYBAS_ID']
+
+    def test3_geometry_reader(self):
+        reader = ShapefileGeometryReader(self.shp_path)
+        assert len(reader) == 3
+        gdf = gpd.read_file(str(self.shp_path))
+        for i in [2, 0, 1]:
+            assert reader.geometry(i).equals(gdf.geometry.iloc[i])
+        assert reader.geometry(1) is reader.geometry(1)
+        assert reader.geometries([2, 0])[0].geom_type == 'MultiPolygon'
+
+    def test4_get_geometry_reader(self):
+        assert get_geometry_reader(self.shp_path) is get_geometry_reader(self.shp_path)
+
+    def test5_geometry_cache_bounded(self):
+        reader = ShapefileGeometryReader(self.shp_path, cache_size=2)
+        first = reader.geometry(0)
+        reader.geometry(1)
+        assert reader.geometry(0) is first
+        # Record 1 is least recently used, so is evicted.
+        reader.geometry(2)
+        assert len(reader._cache) == 2
+        assert 1 not in reader._cache
+        assert reader.geometry(0) is first
+
+        reader = ShapefileGeometryReader(self.shp_path, cache_size=0)
+        assert reader.geometry(0).equals(first)
+        assert len(reader._cache) == 0
@@ -0,0 +1,285 @@
+from unittest import TestCase
+
+import iris.coords
+import iris.cube
+import numpy as np
+import rasterio
+from shapely.geometry import box, MultiPolygon, Point, Polygon
+
+from basmati.utils import (build_raster_from_geometries, build_weights_from_lon_lat, build_weights_cube_from_cube,
+                           SparseWeights, basin_aggregate, coarse_grain, coarse_grain2d, coarse_grain2d_ndim)
+
+
+def _geometries():
+    return [
+        box(0.5, 0.5, 4.2, 3.7),
+        Polygon([(5, 1), (9.5, 2), (7, 8)]),
+        MultiPolygon([box(0, 5, 2, 9), box(2.5, 8, 4, 9.9)]),
+    ]
+
+
+class TestBuildRaster(TestCase):
+    def setUp(self):
+        self.tx = rasterio.transform.Affine(0.5, 0, 0, 0, 0.5, 0)
+        self.shape = (20, 20)
+
+    def test1_single_pass(self):
+        raster = build_raster_from_geometries(_geometries(), self.shape, self.tx)
+        raster_per_geom = build_raster_from_geometries(_geometries(), self.shape, self.tx, single_pass=False)
+        assert raster.dtype == raster_per_geom.dtype
+        assert (raster == raster_per_geom).all()
+        assert set(np.unique(raster)) == {0, 1, 2, 3}
+
+    def test2_overlapping(self):
+        for single_pass in [True, False]:
+            with self.assertRaises(AssertionError):
+                build_raster_from_geometries(_geometries() + [box(3, 3, 6, 6)], self.shape, self.tx,
+                                             single_pass=single_pass)
+
+    def test3_geometry_partly_outside_raster(self):
+        geometries = [box(-2, -2, 1.2, 1.2), box(8, 8, 12, 12), box(20, 20, 21, 21)]
+        raster = build_raster_from_geometries(geometries, self.shape, self.tx)
+        raster_per_geom = build_raster_from_geometries(geometries, self.shape, self.tx, single_pass=False)
+        assert (raster == raster_per_geom).all()
+        assert (raster == 1).sum() == 4 and (raster == 2).sum() == 16 and (raster == 3).sum() == 0
+
+    def test4_tiled(self):
+        raster = build_raster_from_geometries(_geometries(), self.shape, self.tx)
+        for band_rows in [None, 1, 3, 7]:
+            tiled_raster = build_raster_from_geometries(_geometries(), self.shape, self.tx, workers=2,
+                                                        band_rows=band_rows)
+            assert tiled_raster.dtype == raster.dtype
+            assert (tiled_raster == raster).all()
+        with self.assertRaises(AssertionError):
+            build_raster_from_geometries(_geometries() + [box(3, 3, 6, 6)], self.shape, self.tx, workers=2)
+
+
+def _cube(lon_first=False):
+    latitude = iris.coords.DimCoord(np.linspace(0.25, 9.75, 20), standard_name='latitude', units='degrees')
+    longitude = iris.coords.DimCoord(np.linspace(0.5, 9.5, 10), standard_name='longitude', units='degrees')
+    if lon_first:
+        return iris.cube.Cube(np.zeros((10, 20)), dim_coords_and_dims=[(longitude, 0), (latitude, 1)])
+    return iris.cube.Cube(np.zeros((20, 10)), dim_coords_and_dims=[(latitude, 0), (longitude, 1)])
+
+
+class TestBuildWeights(TestCase):
+    def test1_sparse(self):
+        args = (_geometries(), 0, 10, 0, 10, 10, 20)
+        weights = build_weights_from_lon_lat(*args, oversample_factor=4)
+        sparse_weights = build_weights_from_lon_lat(*args, oversample_factor=4, sparse=True)
+        assert isinstance(sparse_weights, SparseWeights)
+        assert sparse_weights.shape == weights.shape == (3, 20, 10)
+        assert sparse_weights.matrix.shape == (3, 200)
+        assert np.allclose(sparse_weights.toarray(), weights)
+        assert np.allclose(sparse_weights.toarray(1), weights[1])
+        assert sparse_weights.matrix.nnz == (weights != 0).sum()
+
+    def test2_sparse_cube(self):
+        for lon_first in [False, True]:
+            cube = _cube(lon_first)
+            weights_cube = build_weights_cube_from_cube(_geometries(), cube, 'w', oversample_factor=4)
+            sparse_weights = build_weights_cube_from_cube(_geometries(), cube, 'w', oversample_factor=4,
+                                                          sparse=True)
+            assert sparse_weights.lon_first == lon_first
+            sparse_weights_cube = sparse_weights.to_cube()
+            assert sparse_weights_cube.shape == weights_cube.shape
+            assert sparse_weights_cube.coord_dims('latitude') == weights_cube.coord_dims('latitude')
+            assert np.allclose(sparse_weights_cube.data, weights_cube.data)
+
+    def test3_exact(self):
+        geometries = _geometries() + [Point(8.5, 8.5).buffer(1)]
+        args = (geometries, 0, 10, 0, 10, 10, 20)
+        weights = build_weights_from_lon_lat(*args, method='exact')
+        assert weights.shape == (4, 20, 10)
+        assert ((weights >= 0) & (weights <= 1)).all()
+        # Weights times cell area sum to the area of each geometry.
+        assert np.allclose(weights.sum(axis=(1, 2)) * 0.5, [g.area for g in geometries])
+        # Cells fully inside box(0.5, 0.5, 4.2, 3.7) are 1, those on its edges are partial.
+        assert (weights[0, 1:7, 1:4] == 1).all()
+        assert weights[0, 0, 0] == 0 and np.isclose(weights[0, 1, 0], 0.5 * 0.5 / 0.5)
+        assert np.isclose(weights[0, 7, 4], 0.2 * 0.2 / 0.5)
+
+        oversampled = build_weights_from_lon_lat(*args, oversample_factor=20)
+        assert np.abs(weights - oversampled).max() < 0.1
+        sparse_weights = build_weights_from_lon_lat(*args, method='exact', sparse=True)
+        assert np.allclose(sparse_weights.toarray(), weights)
+
+    def test4_exact_cube(self):
+        cube = _cube(lon_first=True)
+        weights_cube = build_weights_cube_from_cube(_geometries(), cube, 'w', method='exact')
+        assert weights_cube.shape == (3, 10, 20)
+        assert np.allclose(weights_cube.data.sum(axis=(1, 2)) * 0.5, [g.area for g in _geometries()])
+
+    def test5_unknown_method(self):
+        with self.assertRaises(ValueError):
+            build_weights_from_lon_lat(_geometries(), 0, 10, 0, 10, 10, 20, method='approx')
+
+
+    def test6_exact_descending_lat(self):
+        # e.g. north to south cubes, such as ERA5.
+        ascending = build_weights_from_lon_lat(_geometries(), 0, 10, 0, 10, 10, 20, method='exact')
+        descending = build_weights_from_lon_lat(_geometries(), 0, 10, 10, 0, 10, 20, method='exact')
+        assert np.allclose(descending, ascending[:, ::-1])
+        oversampled = build_weights_from_lon_lat(_geometries(), 0, 10, 10, 0, 10, 20, oversample_factor=20)
+        assert np.abs(descending - oversampled).max() < 0.1
+
+        cube = _cube()
+        cube = cube[::-1]
+        assert cube.coord('latitude').points[0] > cube.coord('latitude').points[-1]
+        weights_cube = build_weights_cube_from_cube(_geometries(), cube, 'w', method='exact')
+        assert np.allclose(weights_cube.data, ascending[:, ::-1])
+
+def _time_cube(lon_first=False, lazy=False):
+    time = iris.coords.DimCoord(np.arange(7), standard_name='time', units='hours since 2000-01-01')
+    data = np.random.default_rng(0).random((7, 20, 10))
+    if lon_first:
+        data = data.swapaxes(1, 2)
+    spatial = _cube(lon_first)
+    cube = iris.cube.Cube(data, long_name='precip', units='mm hr-1',
+                          dim_coords_and_dims=[(time, 0)] + [(c, spatial.coord_dims(c)[0] + 1)
+                                                             for c in spatial.dim_coords])
+    if lazy:
+        import dask.array as da
+        cube.data = da.from_array(cube.data, chunks=(2, -1, -1))
+    return cube
+
+
+class TestBasinAggregate(TestCase):
+    def _broadcast(self, cube, weights_cube, stat):
+        # Reference implementation - the broadcast that basin_aggregate replaces.
+        lat_dim = cube.coord_dims('latitude')[0]
+        data = cube.data if lat_dim == 1 else cube.data.swapaxes(1, 2)
+        weights = weights_cube.data if weights_cube.coord_dims('latitude')[0] == 1 else weights_cube.data.swapaxes(1, 2)
+        weighted_sum = (data[:, None] * weights[None]).sum(axis=(2, 3))
+        if stat == 'sum':
+            return weighted_sum
+        return weighted_sum / weights.sum(axis=(1, 2))
+
+    def test1_mean_sum(self):
+        for lon_first in [False, True]:
+            cube = _time_cube(lon_first)
+            weights_cube = build_weights_cube_from_cube(_geometries(), cube, 'w', oversample_factor=4)
+            for stat in ['mean', 'sum']:
+                expected = self._broadcast(cube, weights_cube, stat)
+                for weights in [weights_cube, weights_cube.data,
+                                build_weights_cube_from_cube(_geometries(), cube, 'w', oversample_factor=4,
+                                                             sparse=True)]:
+                    if isinstance(weights, np.ndarray) and lon_first:
+                        continue
+                    aggregated = basin_aggregate(cube, weights, stat=stat, chunk_size=3)
+                    assert aggregated.shape == (7, 3)
+                    assert aggregated.coord('time') == cube.coord('time')
+                    assert aggregated.coord_dims('basin_index') == (1,)
+                    assert aggregated.name() == 'precip'
+                    assert np.allclose(aggregated.data, expected)
+
+    def test2_lazy(self):
+        cube = _time_cube(lazy=True)
+        weights = build_weights_cube_from_cube(_geometries(), cube, 'w', method='exact', sparse=True)
+        aggregated = basin_aggregate(cube, weights, chunk_size=2)
+        assert cube.has_lazy_data()
+        assert np.allclose(aggregated.data, self._broadcast(cube, weights.to_cube(), 'mean'))
+
+    def test3_masked(self):
+        cube = _time_cube()
+        weights = build_weights_cube_from_cube(_geometries(), cube, 'w', oversample_factor=4, sparse=True)
+        dense_weights = weights.toarray()
+        data = np.ma.masked_array(cube.data)
+        data[0, :10] = np.ma.masked
+        data[1] = np.ma.masked
+        cube.data = data
+        aggregated = basin_aggregate(cube, weights)
+        # Basin 0 is wholly in the masked half at time 0.
+        assert aggregated.data.mask[0, 0] and aggregated.data.mask[1].all()
+        assert not aggregated.data.mask[2:].any()
+        valid = ~data.mask[0]
+        expected = (data.data[0] * dense_weights[1] * valid).sum() / (dense_weights[1] * valid).sum()
+        assert np.isclose(aggregated.data[0, 1], expected)
+
+    def test4_mismatch(self):
+        weights = build_weights_from_lon_lat(_geometries(), 0, 10, 0, 10, 5, 5, sparse=True)
+        with self.assertRaises(ValueError):
+            basin_aggregate(_time_cube(), weights)
+        with self.assertRaises(ValueError):
+            basin_aggregate(_time_cube(), weights, stat='median')
+
+
+class TestLazyWeights(TestCase):
+    def test1_lazy(self):
+        for lon_first in [False, True]:
+            for method in ['oversample', 'exact']:
+                cube = _cube(lon_first)
+                weights_cube = build_weights_cube_from_cube(_geometries(), cube, 'w', oversample_factor=4,
+                                                            method=method)
+                lazy_weights_cube = build_weights_cube_from_cube(_geometries(), cube, 'w', oversample_factor=4,
+                                                                 method=method, lazy=True, chunks=(2, 7))
+                assert lazy_weights_cube.has_lazy_data()
+                assert lazy_weights_cube.shape == weights_cube.shape
+                assert lazy_weights_cube.coord_dims('latitude') == weights_cube.coord_dims('latitude')
+                lat_chunks = lazy_weights_cube.lazy_data().chunks[lazy_weights_cube.coord_dims('latitude')[0]]
+                assert lazy_weights_cube.lazy_data().chunks[0] == (2, 1) and lat_chunks == (7, 7, 6)
+                assert np.allclose(lazy_weights_cube.data, weights_cube.data)
+
+    def test2_lazy_arithmetic(self):
+        cube = _time_cube(lazy=True)
+        weights_cube = build_weights_cube_from_cube(_geometries(), cube, 'w', method='exact', lazy=True)
+        weighted = cube.lazy_data()[:, None] * weights_cube.lazy_data()[None]
+        basin_sums = weighted.sum(axis=(2, 3))
+        assert np.allclose(basin_sums.compute(), basin_aggregate(cube, weights_cube, stat='sum').data)
+
+    def test3_lazy_sparse(self):
+        with self.assertRaises(ValueError):
+            build_weights_cube_from_cube(_geometries(), _cube(), 'w', lazy=True, sparse=True)
+
+
+class TestCoarseGrain(TestCase):
+    def setUp(self):
+        self.arr = np.random.default_rng(0).integers(-100, 100, (3, 23, 17)).astype(np.int16)
+
+    def _reference(self, arr, grain_size, func, mask=None):
+        # Loop over each grain - slow but simple.
+        num0 = -(-arr.shape[-2] // grain_size[0])
+        num1 = -(-arr.shape[-1] // grain_size[1])
+        out = np.ma.masked_all(arr.shape[:-2] + (num0, num1))
+        for i in range(num0):
+            for j in range(num1):
+                index = (..., slice(i * grain_size[0], (i + 1) * grain_size[0]),
+                         slice(j * grain_size[1], (j + 1) * grain_size[1]))
+                for lead in np.ndindex(arr.shape[:-2]):
+                    values = arr[lead][index[1:]]
+                    if mask is not None:
+                        values = values[~mask[lead][index[1:]]]
+                    if values.size:
+                        out[lead + (i, j)] = func(values)
+        return out
+
+    def test1_divisible(self):
+        arr = self.arr[0, :20, :15]
+        assert np.allclose(coarse_grain2d(arr, (5, 3)), arr.reshape(4, 5, 5, 3).mean(axis=(1, 3)))
+        assert np.allclose(coarse_grain2d_ndim(self.arr[:, :20, :15], (5, 3)),
+                           self.arr[:, :20, :15].reshape(3, 4, 5, 5, 3).mean(axis=(2, 4)))
+
+    def test2_ragged_stats(self):
+        for stat, func in [('mean', np.mean), ('sum', np.sum), ('min', np.min), ('max', np.max)]:
+            for block_rows in [None, 1, 2]:
+                out = coarse_grain(self.arr, (5, 4), stat=stat, block_rows=block_rows)
+                assert out.shape == (3, 5, 5)
+                assert not np.ma.isMaskedArray(out)
+                assert np.allclose(out, self._reference(self.arr, (5, 4), func))
+
+    def test3_mask(self):
+        mask = np.zeros(self.arr.shape[-2:], dtype=np.uint8)
+        mask[:7, :9] = 255
+        mask[20:, 3] = 255
+        bool_mask = np.broadcast_to(mask != 0, self.arr.shape)
+        for stat, func in [('mean', np.mean), ('sum', np.sum), ('min', np.min), ('max', np.max)]:
+            expected = self._reference(self.arr, (5, 4), func, mask=bool_mask)
+            for arr, kwargs in [(self.arr, {'mask': mask}), (np.ma.masked_array(self.arr, bool_mask), {})]:
+                out = coarse_grain(arr, (5, 4), stat=stat, block_rows=2, **kwargs)
+                assert (out.mask == expected.mask).all()
+                assert out.mask[:, 0, :2].all() and not out.mask[:, 1:].any()
+                assert np.allclose(out.compressed(), expected.compressed())
+
+    def test4_unknown_stat(self):
+        with self.assertRaises(ValueError):
+            coarse_grain(self.arr, (5, 4), stat='median')
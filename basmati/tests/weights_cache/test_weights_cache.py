@@ -0,0 +1,76 @@
+import os
+import tempfile
+from pathlib import Path
+from unittest import TestCase
+
+import mock
+import numpy as np
+import scipy.sparse
+from shapely.geometry import box
+
+from basmati import utils
+from basmati.tests.utils.test_utils import _cube, _geometries
+from basmati.weights_cache import WeightsCache
+
+
+class TestWeightsCache(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache_dir = Path(self.tmpdir.name) / 'weights_cache'
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test1_key(self):
+        grid = (10.0, 0.0, 10.0, 0.0, 20, 10)
+        key = WeightsCache.key(_geometries(), grid, oversample_factor=10)
+        assert key == WeightsCache.key(_geometries(), grid, oversample_factor=10)
+        assert key != WeightsCache.key(_geometries(), grid, oversample_factor=5)
+        assert key != WeightsCache.key(_geometries(), (10.0, 0.0, 10.0, 0.0, 10, 10), oversample_factor=10)
+        assert key != WeightsCache.key(_geometries()[::-1], grid, oversample_factor=10)
+        moved = _geometries()[:-1] + [box(0, 5, 2, 9.0000001)]
+        assert key != WeightsCache.key(moved, grid, oversample_factor=10)
+
+    def test2_get_put(self):
+        cache = WeightsCache(self.cache_dir)
+        matrix = scipy.sparse.random(3, 200, density=0.1, format='csr', random_state=0)
+        assert cache.get('abc') is None
+        cache.put('abc', matrix, 20, 10)
+        cached_matrix, nlat, nlon = cache.get('abc')
+        assert (nlat, nlon) == (20, 10)
+        assert (cached_matrix != matrix).nnz == 0
+
+    def test3_eviction(self):
+        matrix = scipy.sparse.random(50, 2000, density=0.1, format='csr', random_state=0)
+        cache = WeightsCache(self.cache_dir)
+        cache.put('a', matrix, 40, 50)
+        entry_size = cache.size()
+        cache.max_size = int(2.5 * entry_size)
+        cache.put('b', matrix, 40, 50)
+        # Make b older than a, then use a, so that b is the least recently used.
+        a_path, b_path = cache.path('a'), cache.path('b')
+        b_mtime_ns = b_path.stat().st_mtime_ns - 10**9
+        os.utime(b_path, ns=(b_mtime_ns, b_mtime_ns))
+        os.utime(a_path, ns=(b_mtime_ns - 10**9, b_mtime_ns - 10**9))
+        assert cache.get('a') is not None
+        cache.put('c', matrix, 40, 50)
+        assert a_path.exists() and not b_path.exists() and cache.path('c').exists()
+        assert cache.size() <= cache.max_size
+
+    def test4_build_weights_cube_from_cube(self):
+        cube = _cube()
+        weights = utils.build_weights_cube_from_cube(_geometries(), cube, 'w', oversample_factor=4)
+        cache = WeightsCache(self.cache_dir)
+        cached_weights = utils.build_weights_cube_from_cube(_geometries(), cube, 'w', oversample_factor=4,
+                                                            cache=cache)
+        assert len(list(self.cache_dir.glob('*.npz'))) == 1
+        with mock.patch('basmati.utils.build_weights_from_lon_lat') as mock_build:
+            hit_weights = utils.build_weights_cube_from_cube(_geometries(), cube, 'w', oversample_factor=4,
+                                                             cache=str(self.cache_dir))
+            hit_sparse_weights = utils.build_weights_cube_from_cube(_geometries(), _cube(lon_first=True), 'w',
+                                                                    oversample_factor=4, cache=cache, sparse=True)
+            mock_build.assert_not_called()
+        assert np.allclose(cached_weights.data, weights.data)
+        assert np.allclose(hit_weights.data, weights.data)
+        assert hit_sparse_weights.lon_first
+        assert np.allclose(hit_sparse_weights.toarray(), weights.data)
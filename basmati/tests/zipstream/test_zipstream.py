@@ -0,0 +1,131 @@
+import io
+import os
+import tempfile
+import threading
+import time
+import zipfile
+from pathlib import Path
+from unittest import TestCase
+
+from basmati.basmati_errors import BasmatiError
+from basmati.downloader import member_filter
+from basmati.zipstream import GrowingFile, extract_zip_stream
+
+
+class _Unseekable(io.RawIOBase):
+    # Write-only stream, which makes zipfile write data descriptors after each member.
+    def __init__(self):
+        self.buf = io.BytesIO()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        return self.buf.write(b)
+
+
+def _members():
+    return {
+        'hybas_sy_lev01_v1c.dbf': os.urandom(5000),
+        'hybas_sy_lev01_v1c.shp': b'abc' * 100000,
+        'hybas_sy_lev02_v1c.shp': b'def' * 100000,
+        'readme.txt': b'',
+        'hybas_sy_lev02_v1c.dbf': os.urandom(50000),
+    }
+
+
+def _zip_bytes(members, seekable=True):
+    stream = io.BytesIO() if seekable else _Unseekable()
+    with zipfile.ZipFile(stream, 'w') as zf:
+        for name, data in members.items():
+            compress_type = zipfile.ZIP_STORED if name.endswith('.dbf') and seekable else zipfile.ZIP_DEFLATED
+            zf.writestr(name, data, compress_type=compress_type)
+    return stream.getvalue() if seekable else stream.buf.getvalue()
+
+
+class TestExtractZipStream(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.tmp = Path(self.tempdir.name)
+        self.outdir = self.tmp / 'out'
+        self.outdir.mkdir()
+        self.done = threading.Event()
+        self.members = _members()
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def _extract(self, zip_data, **kwargs):
+        zippath = self.tmp / 'test.zip'
+        zippath.write_bytes(zip_data)
+        self.done.set()
+        with GrowingFile(self.tmp / 'test.zip.part', zippath, self.done) as stream:
+            return extract_zip_stream(stream, self.outdir, **kwargs)
+
+    def _check(self, members, extracted):
+        assert sorted(p.name for p in extracted) == sorted(members)
+        for name, data in members.items():
+            assert (self.outdir / name).read_bytes() == data
+        assert not list(self.outdir.glob('*.tmp'))
+
+    def test1_extract(self):
+        self._check(self.members, self._extract(_zip_bytes(self.members)))
+
+    def test2_data_descriptors(self):
+        zip_data = _zip_bytes(self.members, seekable=False)
+        with zipfile.ZipFile(io.BytesIO(zip_data)) as zf:
+            assert all(info.flag_bits & 0x08 for info in zf.infolist())
+        self._check(self.members, self._extract(zip_data))
+
+    def test3_filter(self):
+        members = self.members
+        for zip_data in [_zip_bytes(members), _zip_bytes(members, seekable=False)]:
+            extracted = self._extract(zip_data, member_filter=member_filter(levels=[1], suffixes=['.shp']))
+            assert [p.name for p in extracted] == ['hybas_sy_lev01_v1c.shp']
+            assert (self.outdir / 'hybas_sy_lev01_v1c.shp').read_bytes() == members['hybas_sy_lev01_v1c.shp']
+
+    def test4_growing_file(self):
+        zip_data = _zip_bytes(self.members, seekable=False)
+        partpath = self.tmp / 'test.zip.part'
+        zippath = self.tmp / 'test.zip'
+        extracted_before_done = []
+
+        def write_slowly():
+            with open(partpath, 'wb') as f:
+                for i in range(0, len(zip_data), 1000):
+                    f.write(zip_data[i:i + 1000])
+                    f.flush()
+                    time.sleep(0.005)
+            partpath.replace(zippath)
+            self.done.set()
+
+        writer = threading.Thread(target=write_slowly)
+        writer.start()
+        with GrowingFile(partpath, zippath, self.done, poll_interval=0.001) as stream:
+            extracted = extract_zip_stream(stream, self.outdir,
+                                           on_member=lambda p: extracted_before_done.append(not self.done.is_set()))
+        writer.join()
+        self._check(self.members, extracted)
+        # First member was extracted while the zip file was still being written.
+        assert extracted_before_done[0]
+
+    def test5_corrupt(self):
+        zip_data = bytearray(_zip_bytes(self.members))
+        # Flip a byte in the data of the first (stored) member.
+        zip_data[100] ^= 0xFF
+        with self.assertRaises(BasmatiError):
+            self._extract(bytes(zip_data))
+        assert not list(self.outdir.iterdir())
+
+    def test6_truncated(self):
+        for seekable in [True, False]:
+            zip_data = _zip_bytes(self.members, seekable=seekable)
+            for end in [len(zip_data) // 2, len(zip_data) // 3, 40]:
+                with self.assertRaises(BasmatiError):
+                    self._extract(zip_data[:end])
+                # The member being extracted when the data ran out is not left behind.
+                assert not list(self.outdir.glob('*.tmp'))
+
+    def test7_outside_basedir(self):
+        with self.assertRaises(BasmatiError):
+            self._extract(_zip_bytes({'../evil.txt': b'evil'}))
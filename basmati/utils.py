@@ -1,15 +1,22 @@
 import subprocess as sp
-from typing import List, Collection
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Callable, List, Collection, Tuple, Union
 
 import iris
 import iris.cube
 import numpy as np
 import rasterio
+from rasterio.enums import MergeAlg
 from rasterio.features import rasterize
 from rasterio.transform import Affine
-from scipy import ndimage
+import scipy.sparse
+import shapely
+from shapely.geometry import box
 from shapely.geometry.base import BaseGeometry
 
+from basmati.weights_cache import WeightsCache
+
 
 def sysrun(cmd: str) -> sp.CompletedProcess:
     """Run a system command
@@ -24,32 +31,133 @@ def sysrun(cmd: str) -> sp.CompletedProcess:
     return sp.run(cmd, check=True, shell=True, stdout=sp.PIPE, stderr=sp.PIPE, encoding='utf8')
 
 
+def _geometry_window(geom: BaseGeometry, shape: Collection[int], tx: Affine) -> Tuple[slice, slice]:
+    # Row and column slices of the cells that overlap the bounds of geom, clipped to shape.
+    minx, miny, maxx, maxy = geom.bounds
+    inv_tx = ~tx
+    cols, rows = zip(*[inv_tx * (x, y) for x in (minx, maxx) for y in (miny, maxy)])
+    row_start = max(int(np.floor(min(rows))), 0)
+    row_stop = min(int(np.ceil(max(rows))), shape[0])
+    col_start = max(int(np.floor(min(cols))), 0)
+    col_stop = min(int(np.ceil(max(cols))), shape[1])
+    return slice(row_start, row_stop), slice(col_start, col_stop)
+
+
+def _rasterize_band(shm_name: str, shape: Tuple[int, int], rows: slice,
+                    geometries: List[BaseGeometry], labels: List[int], tx: Affine) -> bool:
+    # Rasterize geometries into rows of the shared raster. Returns False if any geometries overlap.
+    from multiprocessing import shared_memory
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        raster = np.ndarray(shape, dtype=np.int64, buffer=shm.buf)
+        band_shape = (rows.stop - rows.start, shape[1])
+        band_tx = tx * Affine.translation(0, rows.start)
+        raster[rows] = rasterize(zip(geometries, labels), band_shape, transform=band_tx, dtype=np.int32)
+        count = rasterize(zip(geometries, [1] * len(geometries)), band_shape, transform=band_tx,
+                          merge_alg=MergeAlg.add, dtype=np.uint16)
+        return bool((count <= 1).all())
+    finally:
+        shm.close()
+
+
+def _build_raster_tiled(geometries: List[BaseGeometry], shape: Tuple[int, int], tx: Affine,
+                        workers: int, band_rows: int) -> np.ndarray:
+    # Only needed when rasterizing with workers.
+    from multiprocessing import shared_memory
+
+    tree = shapely.STRtree(geometries)
+    bands = []
+    for row_start in range(0, shape[0], band_rows):
+        rows = slice(row_start, min(row_start + band_rows, shape[0]))
+        corners = [tx * (col, row) for col in (0, shape[1]) for row in (rows.start, rows.stop)]
+        xs, ys = zip(*corners)
+        # Only geometries that intersect the band need to be rasterized for it.
+        index = np.sort(tree.query(box(min(xs), min(ys), max(xs), max(ys))))
+        bands.append((rows, [geometries[i] for i in index], list(index + 1)))
+
+    shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * 8, 1))
+    raster = np.ndarray(shape, dtype=np.int64, buffer=shm.buf)
+    try:
+        raster[:] = 0
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_rasterize_band, shm.name, shape, rows, band_geometries, labels, tx)
+                       for rows, band_geometries, labels in bands if band_geometries]
+            no_overlaps = [future.result() for future in futures]
+        assert all(no_overlaps), 'overlapping geometries'
+        return raster.astype(int)
+    finally:
+        del raster
+        shm.close()
+        shm.unlink()
+
+
 def build_raster_from_geometries(geometries: Collection[BaseGeometry],
-                                 shape: Collection[int], tx: Affine) -> np.ndarray:
+                                 shape: Collection[int], tx: Affine,
+                                 single_pass: bool = True,
+                                 workers: int = 1,
+                                 band_rows: int = None) -> np.ndarray:
     """Build a 2D raster from the geometries (e.g. `gdf.geometry`)
 
     Each geometry is assigned an index, which increments by one for each geometry.
     In the returned raster, the cells corresponding to each geometry will be filled in with the appropriate index value.
 
+    By default, all geometries are burnt into the raster in one call to `rasterize`, and a second call counts the
+    geometries that cover each cell to check for overlaps. With `single_pass=False`, each geometry is rasterized
+    separately, over the window given by its bounds, and checked against the raster so far.
+
+    With `workers > 1`, the raster is split into bands of band_rows rows, which are rasterized in parallel in a
+    process pool and written into shared memory. Each band only rasterizes the geometries that intersect it, found
+    using an STRtree.
+
     :param geometries: Individual geometries
     :param shape: shape of desired raster
     :param tx: affine transform to apply to each geometry before rasterizing
+    :param single_pass: rasterize all geometries at once
+    :param workers: number of processes to rasterize bands with
+    :param band_rows: rows in each band (default: enough for 4 bands per worker)
+    :raises: AssertionError if any geometries overlap
     :return: 2D raster where each index is the raster of an individual geometry.
     """
+    if workers > 1:
+        if band_rows is None:
+            band_rows = max(1, -(-shape[0] // (4 * workers)))
+        return _build_raster_tiled(list(geometries), tuple(shape), tx, workers, band_rows)
+
+    if single_pass:
+        geometries = list(geometries)
+        raster = np.zeros(shape, dtype=int)
+        if not geometries:
+            return raster
+        raster[:] = rasterize(zip(geometries, range(1, len(geometries) + 1)), shape, transform=tx,
+                              dtype=np.int32)
+        count = rasterize(zip(geometries, [1] * len(geometries)), shape, transform=tx,
+                          merge_alg=MergeAlg.add, dtype=np.uint16)
+        assert (count <= 1).all(), 'overlapping geometries'
+        return raster
+
     raster = np.zeros(shape, dtype=int)
     for i, geom in enumerate(geometries):
+        # Only rasterize over the cells covered by the geometry's bounds.
+        rows, cols = _geometry_window(geom, shape, tx)
+        if rows.start >= rows.stop or cols.start >= cols.stop:
+            continue
+        window_shape = (rows.stop - rows.start, cols.stop - cols.start)
+        window_tx = tx * Affine.translation(cols.start, rows.start)
         if geom.geom_type == 'MultiPolygon':
-            geom_raster = rasterize(zip(geom.geoms, [i + 1] * len(geom.geoms)), shape, transform=tx)
+            geom_raster = rasterize(zip(geom.geoms, [i + 1] * len(geom.geoms)), window_shape, transform=window_tx)
         else:
-            geom_raster = rasterize(zip([geom], [i + 1]), shape, transform=tx)
-        assert (raster[geom_raster != 0] == 0).all(), 'overlapping geometries'
-        raster |= geom_raster
+            geom_raster = rasterize(zip([geom], [i + 1]), window_shape, transform=window_tx)
+        raster_window = raster[rows, cols]
+        assert (raster_window[geom_raster != 0] == 0).all(), 'overlapping geometries'
+        raster_window |= geom_raster
     return raster
 
 
 def build_raster_from_lon_lat(geometries: Collection[BaseGeometry],
                               lon_min: float, lon_max: float, lat_min: float, lat_max: float,
-                              nlon: int, nlat: int) -> np.ndarray:
+                              nlon: int, nlat: int,
+                              workers: int = 1) -> np.ndarray:
     """Build raster from lon/lat box with number in each direction specified
 
     Each geometry is assigned an index, which increments by one for each geometry.
@@ -62,6 +170,7 @@ def build_raster_from_lon_lat(geometries: Collection[BaseGeometry],
     :param lat_max: maximum latitude
     :param nlon: number of longitudinal cells
     :param nlat: number of latitudinal cells
+    :param workers: number of processes to rasterize with, in bands of rows
     :return: 2D raster where each index is the raster of an individual geometry.
     """
     scale_lon = (lon_max - lon_min) / nlon
@@ -71,7 +180,8 @@ def build_raster_from_lon_lat(geometries: Collection[BaseGeometry],
                                           0, scale_lat, lat_min)
     raster = build_raster_from_geometries(geometries,
                                           (nlat, nlon),
-                                          affine_tx)
+                                          affine_tx,
+                                          workers=workers)
     return raster
 
 
@@ -110,16 +220,177 @@ def build_raster_cube_from_cube(geometries: Collection[BaseGeometry], cube: iris
     return raster_cube
 
 
+class SparseWeights:
+    """Basin weights stored as a sparse matrix, with one row per geometry and one column per grid cell.
+
+    Cells are numbered in (lat, lon) order, i.e. `cell = lat_index * nlon + lon_index`. Each basin only touches a
+    small fraction of the cells in a large domain, so this uses much less memory than the equivalent 3D dense
+    weights array.
+    """
+
+    def __init__(self, matrix: scipy.sparse.spmatrix, nlat: int, nlon: int,
+                 latitude: iris.coords.Coord = None, longitude: iris.coords.Coord = None,
+                 name: str = None, lon_first: bool = False) -> None:
+        """Wrap matrix, which has shape (num_geometries, nlat * nlon).
+
+        :param matrix: sparse weights matrix
+        :param nlat: number of latitudinal cells
+        :param nlon: number of longitudinal cells
+        :param latitude: latitude coord of target cube (optional)
+        :param longitude: longitude coord of target cube (optional)
+        :param name: name of weights (optional)
+        :param lon_first: target cube has longitude before latitude
+        """
+        assert matrix.shape[1] == nlat * nlon
+        self.matrix = scipy.sparse.csr_matrix(matrix)
+        self.nlat = nlat
+        self.nlon = nlon
+        self.latitude = latitude
+        self.longitude = longitude
+        self.name = name
+        self.lon_first = lon_first
+
+    def __len__(self) -> int:
+        return self.matrix.shape[0]
+
+    @property
+    def shape(self) -> Tuple[int, int, int]:
+        """Shape of the equivalent dense weights: (num_geometries, nlat, nlon)."""
+        return len(self), self.nlat, self.nlon
+
+    def toarray(self, index: int = None) -> np.ndarray:
+        """Dense weights, for all geometries or for one.
+
+        :param index: index of geometry, all geometries if `None`
+        :return: 3D weights (or 2D weights if index is given) with dims (lat, lon) for each geometry
+        """
+        if index is None:
+            return self.matrix.toarray().reshape(self.shape)
+        return self.matrix[index].toarray().reshape(self.nlat, self.nlon)
+
+    def to_cube(self) -> iris.cube.Cube:
+        """Dense weights cube, as returned by `build_weights_cube_from_cube(..., sparse=False)`.
+
+        :return: 3D weights cube where each element of first index is weights for an individual geometry.
+        """
+        assert self.latitude is not None and self.longitude is not None, 'lat/lon coords needed to build cube'
+        return _weights_cube(self.toarray(), self.name, self.latitude, self.longitude, self.lon_first)
+
+
+def _sparse_weights_from_raster(raster_highres: np.ndarray, num_geometries: int,
+                                nlat: int, nlon: int, oversample_factor: int) -> scipy.sparse.csr_matrix:
+    rows, cols = np.nonzero(raster_highres)
+    labels = raster_highres[rows, cols] - 1
+    cells = (rows // oversample_factor) * nlon + cols // oversample_factor
+    # Duplicate (label, cell) entries are summed when converting to CSR.
+    matrix = scipy.sparse.coo_matrix((np.ones(len(labels)), (labels, cells)),
+                                     shape=(num_geometries, nlat * nlon)).tocsr()
+    matrix.data /= oversample_factor**2
+    return matrix
+
+
+def _ranges(counts: np.ndarray) -> np.ndarray:
+    # Concatenation of range(count) for each count.
+    counts = np.asarray(counts, dtype=np.int64)
+    return np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+
+def _clip_by_group(geometries: np.ndarray, groups: np.ndarray, rect: Callable[[int], Tuple[float, ...]]) -> np.ndarray:
+    # Clip each geometry to rect(group), with one vectorized call per group (clip_by_rect takes scalar bounds).
+    clipped = np.empty(len(geometries), dtype=object)
+    order = np.argsort(groups, kind='stable')
+    group_values, starts = np.unique(groups[order], return_index=True)
+    for group, index in zip(group_values, np.split(order, starts[1:])):
+        clipped[index] = shapely.clip_by_rect(geometries[index], *rect(group))
+    return clipped
+
+
+def _exact_weights(geometries: Collection[BaseGeometry],
+                   lon_min: float, lon_max: float, lat_min: float, lat_max: float,
+                   nlon: int, nlat: int, chunk_cells: int = 2**18) -> scipy.sparse.csr_matrix:
+    scale_lon = (lon_max - lon_min) / nlon
+    scale_lat = (lat_max - lat_min) / nlat
+    cell_area = abs(scale_lon * scale_lat)
+    geometries = np.asarray(list(geometries), dtype=object)
+
+    x_min, x_max = sorted((lon_min, lon_max))
+    y_min, y_max = sorted((lat_min, lat_max))
+
+    # Rectangles of rows/columns - edges are sorted as latitudes (or longitudes) can be descending.
+    def row_rect(row: int) -> Tuple[float, float, float, float]:
+        y0, y1 = sorted((lat_min + row * scale_lat, lat_min + (row + 1) * scale_lat))
+        return x_min, y0, x_max, y1
+
+    def col_rect(col: int) -> Tuple[float, float, float, float]:
+        x0, x1 = sorted((lon_min + col * scale_lon, lon_min + (col + 1) * scale_lon))
+        return x0, y_min, x1, y_max
+
+    # Window of cells that overlap the bounds of each geometry (empty for empty geometries).
+    minx, miny, maxx, maxy = shapely.bounds(geometries).T
+    with np.errstate(invalid='ignore'):
+        col_a, col_b = (minx - lon_min) / scale_lon, (maxx - lon_min) / scale_lon
+        row_a, row_b = (miny - lat_min) / scale_lat, (maxy - lat_min) / scale_lat
+        col_start = np.clip(np.floor(np.fmin(col_a, col_b)), 0, nlon)
+        col_stop = np.clip(np.ceil(np.fmax(col_a, col_b)), 0, nlon)
+        row_start = np.clip(np.floor(np.fmin(row_a, row_b)), 0, nlat)
+        row_stop = np.clip(np.ceil(np.fmax(row_a, row_b)), 0, nlat)
+    empty = np.isnan(minx)
+    col_start, col_stop, row_start, row_stop = (np.where(empty, 0, a).astype(np.int64)
+                                                for a in (col_start, col_stop, row_start, row_stop))
+    ncols = np.maximum(col_stop - col_start, 0)
+    nrows = np.where(ncols > 0, np.maximum(row_stop - row_start, 0), 0)
+
+    # Geometries are processed in chunks of about chunk_cells window cells, to bound the memory used by the
+    # clipped geometries. Within each chunk, clipping is vectorized over all geometries in each row, then each column.
+    chunk_bounds = np.searchsorted(np.cumsum(nrows * ncols), np.arange(chunk_cells, (nrows * ncols).sum(),
+                                                                         chunk_cells))
+    labels, cells, values = [], [], []
+    for chunk in np.split(np.arange(len(geometries)), np.unique(chunk_bounds + 1)):
+        # One strip per (geometry, row) in its window. Clip to each row first, so that clipping to each cell only
+        # has to handle the vertices in its row.
+        strip_geom = np.repeat(chunk, nrows[chunk])
+        strip_row = row_start[strip_geom] + _ranges(nrows[chunk])
+        strips = _clip_by_group(geometries[strip_geom], strip_row, row_rect)
+        nonempty = ~shapely.is_empty(strips)
+        strips, strip_geom, strip_row = (a[nonempty] for a in (strips, strip_geom, strip_row))
+
+        # One cell per (strip, column) in its window. Strips are already within their row, so clipping them to
+        # each column clips them to each cell.
+        cell_strip = np.repeat(np.arange(len(strips)), ncols[strip_geom])
+        cell_col = col_start[strip_geom][cell_strip] + _ranges(ncols[strip_geom])
+        clipped = _clip_by_group(strips[cell_strip], cell_col, col_rect)
+        fractions = shapely.area(clipped) / cell_area
+        keep = np.flatnonzero(fractions > 0)
+        labels.append(strip_geom[cell_strip[keep]])
+        cells.append(strip_row[cell_strip[keep]] * nlon + cell_col[keep])
+        values.append(fractions[keep])
+
+    labels, cells, values = (np.concatenate(a) for a in (labels, cells, values))
+    matrix = scipy.sparse.coo_matrix((values, (labels, cells)), shape=(len(geometries), nlat * nlon)).tocsr()
+    # Guard against rounding errors in the clipped areas.
+    np.clip(matrix.data, 0, 1, out=matrix.data)
+    return matrix
+
+
 def build_weights_from_lon_lat(geometries: Collection[BaseGeometry],
                                lon_min: float, lon_max: float, lat_min: float, lat_max: float,
                                nlon: int, nlat: int,
-                               oversample_factor: int = 10) -> np.ndarray:
+                               oversample_factor: int = 10,
+                               sparse: bool = False,
+                               method: str = 'oversample',
+                               workers: int = 1) -> Union[np.ndarray, SparseWeights]:
     """Build weights from lon/lat box with number in each direction specified and using the given oversample_factor
 
     In the returned weights array, first index is for individual weights. Each weight is for one geometry, and is
     between 0 and 1. All interior weights will be one, exterior 0. Weights where the geometry crosses a grid cell have
     a value which is calculated by oversampling the given raster based on the oversample_factor.
 
+    With `method='exact'`, each geometry is instead clipped against the grid cells it overlaps, and the weights are
+    the exact fractions of the cells' areas that it covers (oversample_factor is ignored).
+
+    With `sparse=True`, the weights are returned as a `SparseWeights`, which is built without creating the dense
+    array.
+
     :param geometries: Individual geometries
     :param lon_min: minimum longitude
     :param lon_max: maximum longitude
@@ -128,31 +399,120 @@ def build_weights_from_lon_lat(geometries: Collection[BaseGeometry],
     :param nlon: number of longitudinal cells
     :param nlat: number of latitudinal cells
     :param oversample_factor: amount of additional cells to use in each direction when oversampling
+    :param sparse: return sparse weights
+    :param method: 'oversample' or 'exact'
+    :param workers: number of processes to rasterize the oversampled raster with
+    :raises: `ValueError` if method is not recognized
     :return: 3D weights where each element of first index is weights for an individual geometry.
     """
+    if method == 'exact':
+        matrix = _exact_weights(geometries, lon_min, lon_max, lat_min, lat_max, nlon, nlat)
+        if sparse:
+            return SparseWeights(matrix, nlat, nlon)
+        return matrix.toarray().reshape(len(geometries), nlat, nlon)
+    elif method != 'oversample':
+        raise ValueError(f'Unknown method: {method}')
+
     raster_highres = build_raster_from_lon_lat(geometries, lon_min, lon_max, lat_min, lat_max,
                                                nlon * oversample_factor,
-                                               nlat * oversample_factor)
+                                               nlat * oversample_factor,
+                                               workers=workers)
+    if sparse:
+        matrix = _sparse_weights_from_raster(raster_highres, len(geometries), nlat, nlon, oversample_factor)
+        return SparseWeights(matrix, nlat, nlon)
+
+    # Count the high-res cells with each label in each coarse cell in one pass, by combining label and coarse cell
+    # into a single key. Label 0 (outside all geometries) is dropped.
+    ncells = nlat * nlon
+    cells = (np.arange(nlat)[:, None, None, None] * nlon +
+             np.arange(nlon)[None, None, :, None])
     raster_highres_reshaped = raster_highres.reshape(nlat, oversample_factor, nlon, oversample_factor)
-    weights = np.zeros((len(geometries), nlat, nlon))
-    for i in range(weights.shape[0]):
-        weights[i] = (raster_highres_reshaped == (i + 1)).sum(axis=(1, 3)) / (oversample_factor**2)
+    keys = (raster_highres_reshaped * ncells + cells).ravel()
+    counts = np.bincount(keys, minlength=(len(geometries) + 1) * ncells)
+    weights = counts[ncells:].reshape(len(geometries), nlat, nlon) / (oversample_factor**2)
 
     return weights
 
 
+def _lazy_weights(geometries: Collection[BaseGeometry],
+                  lon_min: float, lon_max: float, lat_min: float, lat_max: float,
+                  nlon: int, nlat: int, oversample_factor: int, method: str,
+                  chunks: Tuple[int, int]) -> 'dask.array.Array':
+    # dask is only needed for lazy weights.
+    import dask.array as da
+
+    geometries = list(geometries)
+    scale_lat = (lat_max - lat_min) / nlat
+
+    def build_block(block_info=None):
+        (basin_start, basin_stop), (lat_start, lat_stop), _ = block_info[None]['array-location']
+        # Cells in the band are the same as the cells in the full grid, so the weights are identical.
+        return build_weights_from_lon_lat(geometries[basin_start:basin_stop], lon_min, lon_max,
+                                          lat_min + lat_start * scale_lat, lat_min + lat_stop * scale_lat,
+                                          nlon, lat_stop - lat_start, oversample_factor, method=method)
+
+    basin_chunk, lat_chunk = chunks
+    return da.map_blocks(build_block, dtype=float, meta=np.array((), dtype=float),
+                         chunks=(da.core.normalize_chunks(basin_chunk, (len(geometries),))[0],
+                                 da.core.normalize_chunks(lat_chunk, (nlat,))[0],
+                                 (nlon,)))
+
+
+def _weights_cube(weights: np.ndarray, name: str, latitude: iris.coords.Coord, longitude: iris.coords.Coord,
+                  lon_first: bool) -> iris.cube.Cube:
+    basin_index_coord = iris.coords.DimCoord(np.arange(len(weights)), long_name='basin_index')
+    # Originally assumed order was lat then lon -- if it is not, need to swap weights dims.
+    if lon_first:
+        weights = weights.swapaxes(1, 2)
+        index_lon, index_lat = 1, 2
+    else:
+        index_lat, index_lon = 1, 2
+
+    weights_cube = iris.cube.Cube(weights, long_name=f'{name}', units='-',
+                                  dim_coords_and_dims=[(basin_index_coord, 0),
+                                                       (latitude, index_lat),
+                                                       (longitude, index_lon)])
+    return weights_cube
+
+
 def build_weights_cube_from_cube(geometries: Collection[BaseGeometry], cube: iris.cube.Cube, name: str,
-                                 oversample_factor: int = 10) -> iris.cube.Cube:
+                                 oversample_factor: int = 10,
+                                 sparse: bool = False,
+                                 method: str = 'oversample',
+                                 cache: Union[str, Path, WeightsCache] = None,
+                                 lazy: bool = False,
+                                 chunks: Tuple[int, int] = (100, 180),
+                                 workers: int = 1) -> Union[iris.cube.Cube, SparseWeights]:
     """Build weights cube from target cube and using the given oversample_factor
 
     In the returned weights array, first index is for individual weights. Each weight is for one geometry, and is
     between 0 and 1. All interior weights will be one, exterior 0. Weights where the geometry crosses a grid cell have
     a value which is calculated by oversampling the given raster based on the oversample_factor.
 
+    With `method='exact'`, weights are the exact fractions of each grid cell covered by each geometry, rather than
+    being estimated by oversampling.
+
+    With `sparse=True`, a `SparseWeights` is returned instead of a cube. It keeps the cube's lat/lon coords, and
+    `SparseWeights.to_cube` gives the dense cube.
+
+    If `cache` is given, weights are looked up in it (keyed on the geometries, the grid of cube, oversample_factor and
+    method) and only built, then stored, on a miss.
+
+    With `lazy=True`, the weights cube has dask-backed data, chunked along basin_index and latitude by chunks. Each
+    chunk is only built when it is computed, so weights for large grids can be used in lazy iris arithmetic. This needs dask, which is only
+    imported when `lazy=True`.
+
     :param geometries: Individual geometries
     :param cube: target cube
     :param name: name of output weights cube.
     :param oversample_factor: amount of additional cells to use in each direction when oversampling
+    :param sparse: return sparse weights
+    :param method: 'oversample' or 'exact'
+    :param cache: `WeightsCache`, or directory of one
+    :param lazy: return weights cube with lazy data
+    :param chunks: number of basins and latitudes in each chunk of lazy data
+    :param workers: number of processes to rasterize the oversampled raster with (not used if lazy)
+    :raises: `ValueError` if lazy is combined with sparse or cache
     :return: 3D weights where each element of first index is weights for an individual geometry.
     """
     # Check that cube has lat/lon coords and that they are final two coords.
@@ -171,25 +531,129 @@ def build_weights_cube_from_cube(geometries: Collection[BaseGeometry], cube: iri
 
     lat_max, lat_min, lon_max, lon_min, nlat, nlon = get_latlon_from_cube(cube)
 
-    weights = build_weights_from_lon_lat(geometries, lon_min, lon_max, lat_min, lat_max, nlon, nlat, oversample_factor)
-
-    basin_index_coord = iris.coords.DimCoord(np.arange(len(geometries)), long_name='basin_index')
-
-    # Adjust so that they match the dims of weights.
-    # I.e. cube.ndim == 2, index_lon == 0, index_lat == 1
-    # => index_lon = 1, index_lat = 2
-    index_lon = index_lon - cube.ndim + 3
-    index_lat = index_lat - cube.ndim + 3
-    # Originally assumed order was lat then lon -- if it is not, need to swap weights dims.
-    if index_lat - index_lon == 1:
-        weights = weights.swapaxes(1, 2)
-
-    weights_cube = iris.cube.Cube(weights, long_name=f'{name}', units='-',
-                                  dim_coords_and_dims=[(basin_index_coord, 0),
-                                                       (latitude, index_lat),
-                                                       (longitude, index_lon)])
-
-    return weights_cube
+    if lazy:
+        if sparse or cache is not None:
+            raise ValueError('lazy weights cannot be sparse or cached')
+        weights = _lazy_weights(geometries, lon_min, lon_max, lat_min, lat_max, nlon, nlat,
+                                oversample_factor, method, chunks)
+    elif cache is None:
+        weights = build_weights_from_lon_lat(geometries, lon_min, lon_max, lat_min, lat_max, nlon, nlat,
+                                             oversample_factor, sparse=sparse, method=method, workers=workers)
+    else:
+        if not isinstance(cache, WeightsCache):
+            cache = WeightsCache(cache)
+        key = cache.key(geometries, (lat_max, lat_min, lon_max, lon_min, nlat, nlon), method=method,
+                        oversample_factor=oversample_factor if method == 'oversample' else None)
+        entry = cache.get(key)
+        if entry is None:
+            weights = build_weights_from_lon_lat(geometries, lon_min, lon_max, lat_min, lat_max, nlon, nlat,
+                                                 oversample_factor, sparse=True, method=method, workers=workers)
+            cache.put(key, weights.matrix, nlat, nlon)
+        else:
+            weights = SparseWeights(*entry)
+        if not sparse:
+            weights = weights.toarray()
+    lon_first = index_lat - index_lon == 1
+    if sparse:
+        weights.latitude = latitude
+        weights.longitude = longitude
+        weights.name = name
+        weights.lon_first = lon_first
+        return weights
+
+    return _weights_cube(weights, name, latitude, longitude, lon_first)
+
+
+def _as_sparse_weights(weights: Union[np.ndarray, iris.cube.Cube, SparseWeights]) -> SparseWeights:
+    if isinstance(weights, SparseWeights):
+        return weights
+    latitude = longitude = None
+    lon_first = False
+    if isinstance(weights, iris.cube.Cube):
+        latitude = weights.coord('latitude')
+        longitude = weights.coord('longitude')
+        lon_first = weights.coord_dims(latitude) == (2,)
+        weights = weights.data
+        if lon_first:
+            weights = weights.swapaxes(1, 2)
+    assert weights.ndim == 3, 'weights must have dims (basin, lat, lon)'
+    num_geometries, nlat, nlon = weights.shape
+    return SparseWeights(scipy.sparse.csr_matrix(np.asarray(weights).reshape(num_geometries, -1)), nlat, nlon,
+                         latitude, longitude, lon_first=lon_first)
+
+
+def basin_aggregate(cube: iris.cube.Cube, weights: Union[np.ndarray, iris.cube.Cube, SparseWeights],
+                    stat: str = 'mean', chunk_size: int = None) -> iris.cube.Cube:
+    """Aggregate cube over each basin using precomputed weights
+
+    The weights are applied as a sparse matrix product to chunks of the leading dim of cube, so that no
+    temporary array of shape (time, basin, lat, lon) is created, and only one chunk of a lazy cube is loaded at a time.
+    Masked values are ignored: means are normalized by the weights of the unmasked cells, and basins with no
+    unmasked cells are masked.
+
+    :param cube: cube with latitude and longitude as its last two dims
+    :param weights: weights from `build_weights_cube_from_cube` or `build_weights_from_lon_lat` (dense or sparse)
+    :param stat: 'mean' (weighted mean) or 'sum' (weighted sum)
+    :param chunk_size: number of elements of leading dim to process at once (default: about 8M values per chunk)
+    :raises: `ValueError` if stat is not recognized or weights do not match cube
+    :return: cube with the leading dims of cube and a final basin_index dim
+    """
+    if stat not in ['mean', 'sum']:
+        raise ValueError(f'Unknown stat: {stat}')
+    weights = _as_sparse_weights(weights)
+
+    lat_dims = cube.coord_dims('latitude')
+    lon_dims = cube.coord_dims('longitude')
+    if sorted(lat_dims + lon_dims) != [cube.ndim - 2, cube.ndim - 1]:
+        raise ValueError('longitude and latitude must be last two dims of cube')
+    cube_lon_first = lon_dims == (cube.ndim - 2,)
+    if cube.shape[-2:] != ((weights.nlon, weights.nlat) if cube_lon_first else (weights.nlat, weights.nlon)):
+        raise ValueError(f'weights with shape {weights.shape} do not match cube with shape {cube.shape}')
+
+    matrix = weights.matrix
+    total_weights = np.asarray(matrix.sum(axis=1)).ravel()
+    lead_shape = cube.shape[:-2]
+    data = cube.core_data()
+    if cube.ndim == 2:
+        data = data[None]
+    if chunk_size is None:
+        chunk_size = max(1, 2**23 // (np.prod(data.shape[1:], dtype=int) or 1))
+
+    aggregated = []
+    for start in range(0, data.shape[0], chunk_size):
+        chunk = data[start:start + chunk_size]
+        if hasattr(chunk, 'compute'):
+            chunk = chunk.compute()
+        if cube_lon_first:
+            chunk = chunk.swapaxes(-1, -2)
+        chunk = chunk.reshape(-1, weights.nlat * weights.nlon)
+        mask = np.ma.getmask(chunk)
+        weighted_sum = (matrix @ np.ma.filled(chunk, 0).T).T
+        if mask is np.ma.nomask:
+            valid_weights = np.broadcast_to(total_weights, weighted_sum.shape)
+        else:
+            valid_weights = (matrix @ (~mask).T.astype(float)).T
+        no_data = valid_weights == 0
+        if stat == 'mean':
+            weighted_sum = np.divide(weighted_sum, valid_weights, out=np.zeros_like(weighted_sum), where=~no_data)
+        aggregated.append(np.ma.masked_array(weighted_sum, mask=no_data))
+
+    aggregated = np.ma.concatenate(aggregated).reshape(lead_shape + (len(weights),))
+    if not aggregated.mask.any():
+        aggregated = aggregated.data
+
+    basin_index_coord = iris.coords.DimCoord(np.arange(len(weights)), long_name='basin_index')
+    lead_dims = set(range(len(lead_shape)))
+    dim_coords_and_dims = [(coord, cube.coord_dims(coord)) for coord in cube.dim_coords
+                           if set(cube.coord_dims(coord)) <= lead_dims]
+    dim_coords_and_dims.append((basin_index_coord, len(lead_shape)))
+    aux_coords_and_dims = [(coord, cube.coord_dims(coord)) for coord in cube.aux_coords
+                           if set(cube.coord_dims(coord)) <= lead_dims]
+    aggregated_cube = iris.cube.Cube(aggregated, dim_coords_and_dims=dim_coords_and_dims,
+                                     aux_coords_and_dims=aux_coords_and_dims)
+    aggregated_cube.metadata = cube.metadata
+    aggregated_cube.add_cell_method(iris.coords.CellMethod(stat, coords=('latitude', 'longitude')))
+    return aggregated_cube
 
 
 def get_latlon_from_cube(cube):
@@ -210,34 +674,106 @@ def get_latlon_from_cube(cube):
     return lat_max, lat_min, lon_max, lon_min, nlat, nlon
 
 
+def coarse_grain(arr: np.ndarray, grain_size: Collection[int], stat: str = 'mean',
+                 mask: np.ndarray = None, block_rows: int = None) -> np.ndarray:
+    """Coarse grain the last two axes of arr based on grain_size
+
+    If the shape of arr is not divisible by grain_size, the grains along the last row and column are smaller, and
+    cover what is left. Masked cells are left out of each grain's stat. Grains where every cell is masked are
+    masked in the output.
+
+    The stat is computed with ufunc reduceat calls over blocks of rows, so no full-size label or temporary arrays are
+    created.
+
+    :param arr: array to coarse grain (may be a masked array)
+    :param grain_size: 2 value size of grain
+    :param stat: one of 'mean', 'sum', 'min' or 'max'
+    :param mask: cells to leave out, nonzero where masked, e.g. DEM mask from `load_hydrosheds_dem`
+    :param block_rows: number of rows of grains to process at once (default: about 1M cells per block)
+    :raises: `ValueError` if stat is not recognized
+    :return: coarse-grained array, masked if arr is masked or mask is given
+    """
+    if stat not in ['mean', 'sum', 'min', 'max']:
+        raise ValueError(f'Unknown stat: {stat}')
+    if np.ma.isMaskedArray(arr):
+        arr_mask = np.ma.getmask(arr)
+        if arr_mask is not np.ma.nomask:
+            mask = arr_mask if mask is None else (arr_mask | (np.asarray(mask) != 0))
+        arr = arr.data
+    if mask is not None:
+        mask = np.broadcast_to(mask, arr.shape)
+
+    grain0, grain1 = grain_size
+    size0, size1 = arr.shape[-2:]
+    row_starts = np.arange(0, size0, grain0)
+    col_starts = np.arange(0, size1, grain1)
+    num0, num1 = len(row_starts), len(col_starts)
+    if block_rows is None:
+        lead_size = int(np.prod(arr.shape[:-2], dtype=int))
+        block_rows = max(1, 2**20 // max(lead_size * grain0 * size1, 1))
+
+    if stat == 'mean':
+        out_dtype = np.float64
+    elif stat == 'sum':
+        out_dtype = np.int64 if arr.dtype.kind in 'biu' else arr.dtype
+    else:
+        out_dtype = arr.dtype
+    out = np.empty(arr.shape[:-2] + (num0, num1), dtype=out_dtype)
+    # Number of unmasked cells in each grain.
+    counts = None if mask is None else np.empty(out.shape, dtype=np.int64)
+
+    ufunc = {'mean': np.add, 'sum': np.add, 'min': np.minimum, 'max': np.maximum}[stat]
+    if stat == 'min':
+        fill_value = np.inf if arr.dtype.kind == 'f' else np.iinfo(arr.dtype).max
+    elif stat == 'max':
+        fill_value = -np.inf if arr.dtype.kind == 'f' else np.iinfo(arr.dtype).min
+    else:
+        fill_value = 0
+
+    for block_start in range(0, num0, block_rows):
+        block_stop = min(block_start + block_rows, num0)
+        rows = slice(row_starts[block_start], row_starts[block_stop] if block_stop < num0 else size0)
+        block = arr[..., rows, :]
+        block_row_starts = row_starts[block_start:block_stop] - rows.start
+        if mask is not None:
+            valid = ~(mask[..., rows, :] != 0)
+            block = np.where(valid, block, np.array(fill_value).astype(block.dtype))
+            valid_count = np.add.reduceat(np.add.reduceat(valid, block_row_starts, axis=-2, dtype=np.int64),
+                                          col_starts, axis=-1)
+            counts[..., block_start:block_stop, :] = valid_count
+        reduce_dtype = out_dtype if ufunc is np.add else None
+        out[..., block_start:block_stop, :] = ufunc.reduceat(ufunc.reduceat(block, block_row_starts, axis=-2,
+                                                                            dtype=reduce_dtype),
+                                                             col_starts, axis=-1, dtype=reduce_dtype)
+
+    if stat == 'mean':
+        if counts is None:
+            counts = np.outer(np.diff(np.append(row_starts, size0)), np.diff(np.append(col_starts, size1)))
+        out /= np.maximum(counts, 1)
+    if mask is None:
+        return out
+    return np.ma.masked_array(out, mask=counts == 0)
+
+
 def coarse_grain2d(arr: np.ndarray, grain_size: List[int]) -> np.ndarray:
     """Coarse grain a 2D arr based on grain_size
 
+    See `coarse_grain`, which this calls with `stat='mean'`.
+
     :param arr: array to coarse grain
     :param grain_size: 2 value size of grain
     :return: coarse-grained array
     """
-    assert arr.shape[0] % grain_size[0] == 0
-    assert arr.shape[1] % grain_size[1] == 0
-    num0 = arr.shape[0] // grain_size[0]
-    num1 = arr.shape[1] // grain_size[1]
-    return arr.reshape(num0, grain_size[0], num1, grain_size[1]).mean(axis=(1, 3))
+    return coarse_grain(arr, grain_size)
 
 
 def coarse_grain2d_ndim(arr: np.ndarray, grain_size: List[int]) -> np.ndarray:
-    """Coarse grain an N-D arr based on grain_size
+    """Coarse grain an N-D arr along its last two axes based on grain_size
+
+    See `coarse_grain`, which this calls with `stat='mean'`.
 
     :param arr: array to coarse grain
-    :param grain_size: N value size of grain
+    :param grain_size: 2 value size of grain
     :return: coarse-grained array
     """
-    assert arr.shape[0] % grain_size[0] == 0
-    assert arr.shape[1] % grain_size[1] == 0
-    num0 = arr.shape[0] // grain_size[0]
-    num1 = arr.shape[1] // grain_size[1]
-    num_grains = num0 * num1
-    index = np.arange(num_grains)
-    labels = (index.reshape((num0, num1))
-              .repeat(grain_size[1], axis=1)
-              .repeat(grain_size[0], axis=0))
-    return ndimage.mean(arr, labels=labels, index=index).reshape(num0, num1)
+    return coarse_grain(arr, grain_size)
@@ -0,0 +1,129 @@
+"""On-disk cache of basin weights.
+
+Entries are keyed on the content of the geometries (their WKB), the target grid and the settings used to build the
+weights, so the same basins on the same grid are only ever weighted once. Weights are stored as compressed sparse
+matrices. The least recently used entries are removed once the cache grows beyond its maximum size.
+"""
+import hashlib
+import os
+from logging import getLogger
+from pathlib import Path
+from typing import Collection, Optional, Tuple, Union
+
+import numpy as np
+import scipy.sparse
+import shapely
+from shapely.geometry.base import BaseGeometry
+
+logger = getLogger('basmati.weights_cache')
+
+DEFAULT_MAX_SIZE = 2**30
+
+
+class WeightsCache:
+    """Content-addressed cache of sparse weights matrices in a directory."""
+
+    def __init__(self, cache_dir: Union[str, Path], max_size: int = DEFAULT_MAX_SIZE) -> None:
+        """Use cache_dir for the cache, which is created if needed.
+
+        :param cache_dir: directory of cache
+        :param max_size: maximum total size of cache files, in bytes
+        """
+        self.cache_dir = Path(cache_dir)
+        self.max_size = max_size
+
+    @staticmethod
+    def key(geometries: Collection[BaseGeometry], grid: Tuple, **settings) -> str:
+        """Key for the weights of geometries on grid.
+
+        :param geometries: Individual geometries
+        :param grid: description of target grid, e.g. result of `get_latlon_from_cube`
+        :param settings: any other settings that affect the weights, e.g. oversample_factor
+        :return: hex digest that identifies the weights
+        """
+        digest = hashlib.sha256()
+        wkbs = shapely.to_wkb(np.asarray(list(geometries), dtype=object), byte_order=1)
+        digest.update(str(len(wkbs)).encode())
+        for wkb in wkbs:
+            # Prefix each WKB with its length, so that geometry boundaries are part of the key.
+            digest.update(len(wkb).to_bytes(8, 'little'))
+            digest.update(wkb)
+        # repr of floats round-trips, so grids only share a key if they are identical.
+        digest.update(repr(tuple(float(v) for v in grid)).encode())
+        digest.update(repr(sorted(settings.items())).encode())
+        return digest.hexdigest()
+
+    def path(self, key: str) -> Path:
+        """Path of cache file for key.
+
+        :param key: key from `WeightsCache.key`
+        :return: path of cache file
+        """
+        return self.cache_dir / f'{key}.npz'
+
+    def get(self, key: str) -> Optional[Tuple[scipy.sparse.csr_matrix, int, int]]:
+        """Get the weights for key, if they are in the cache.
+
+        :param key: key from `WeightsCache.key`
+        :return: tuple(matrix, nlat, nlon), or `None` if not in cache
+        """
+        path = self.path(key)
+        try:
+            with np.load(path) as entry:
+                matrix = scipy.sparse.csr_matrix((entry['data'], entry['indices'], entry['indptr']),
+                                                 shape=tuple(entry['shape']))
+                nlat, nlon = (int(v) for v in entry['nlat_nlon'])
+        except FileNotFoundError:
+            logger.debug(f'Weights cache miss: {key}')
+            return None
+        logger.debug(f'Weights cache hit: {key}')
+        # Mark as recently used.
+        os.utime(path)
+        return matrix, nlat, nlon
+
+    def put(self, key: str, matrix: scipy.sparse.spmatrix, nlat: int, nlon: int) -> None:
+        """Store the weights for key, then evict old entries if the cache is too big.
+
+        :param key: key from `WeightsCache.key`
+        :param matrix: sparse weights matrix with shape (num_geometries, nlat * nlon)
+        :param nlat: number of latitudinal cells
+        :param nlon: number of longitudinal cells
+        """
+        matrix = scipy.sparse.csr_matrix(matrix)
+        path = self.path(key)
+        logger.debug(f'Writing weights cache: {path}')
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # Write then rename, so that an interrupted write never leaves a partial cache file.
+        tmp_path = path.with_suffix('.tmp.npz')
+        np.savez_compressed(tmp_path, data=matrix.data, indices=matrix.indices.astype(np.int32),
+                            indptr=matrix.indptr.astype(np.int64), shape=np.array(matrix.shape),
+                            nlat_nlon=np.array([nlat, nlon]))
+        tmp_path.replace(path)
+        self.evict()
+
+    def size(self) -> int:
+        """Total size of cache files, in bytes."""
+        return sum(path.stat().st_size for path in self.cache_dir.glob('*.npz'))
+
+    def evict(self) -> None:
+        """Remove least recently used entries until the cache is no bigger than max_size."""
+        if not self.cache_dir.exists():
+            return
+        entries = []
+        for path in self.cache_dir.glob('*.npz'):
+            if path.name.endswith('.tmp.npz'):
+                continue
+            stat = path.stat()
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            logger.debug(f'Evicting weights cache: {path}')
+            path.unlink()
+            total_size -= size
+
+    def clear(self) -> None:
+        """Remove all entries."""
+        for path in self.cache_dir.glob('*.npz'):
+            path.unlink()
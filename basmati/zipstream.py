@@ -0,0 +1,257 @@
+"""Extract zip files as they are being downloaded.
+
+Zip files start each member with a local file header, so members can be extracted in order from the front of the
+file as soon as their bytes have arrived, without waiting for the central directory at the end.
+"""
+import struct
+import threading
+import time
+import zlib
+from logging import getLogger
+from pathlib import Path
+from typing import Callable, List, Optional, Union
+
+from basmati.basmati_errors import BasmatiError
+
+logger = getLogger('basmati.download')
+
+LOCAL_HEADER_SIG = 0x04034b50
+DATA_DESCRIPTOR_SIG = 0x08074b50
+LOCAL_HEADER = struct.Struct('<HHHHHIIIHH')
+CHUNK_SIZE = 2**20
+
+
+class GrowingFile:
+    """Read a file that is still being written, waiting for bytes that have not been written yet.
+
+    The file is first looked for at partpath, where it is being downloaded to, and then at filepath, which it is
+    renamed to once complete. Once `done` is set, reads return whatever is left rather than waiting.
+    """
+
+    def __init__(self, partpath: Union[str, Path], filepath: Union[str, Path], done: threading.Event,
+                 poll_interval: float = 0.05) -> None:
+        """Set up reader - file is opened on first read.
+
+        :param partpath: path file is being written to
+        :param filepath: path file is renamed to when complete
+        :param done: set when writing has finished (successfully or not)
+        :param poll_interval: time between checks for more data, in s
+        """
+        self.partpath = Path(partpath)
+        self.filepath = Path(filepath)
+        self.done = done
+        self.poll_interval = poll_interval
+        self._file = None
+        self._pushback = b''
+
+    def _open(self) -> bool:
+        while self._file is None:
+            # Check done first: if it is set, the file has been renamed if it is ever going to be.
+            done = self.done.is_set()
+            for path in [self.partpath, self.filepath]:
+                try:
+                    self._file = open(path, 'rb')
+                    break
+                except FileNotFoundError:
+                    pass
+            else:
+                if done:
+                    return False
+                time.sleep(self.poll_interval)
+        return True
+
+    def read(self, size: int) -> bytes:
+        """Read size bytes, waiting until they are available.
+
+        :param size: number of bytes to read
+        :return: bytes read - fewer than size only if writing has finished
+        """
+        data = self._pushback[:size]
+        self._pushback = self._pushback[size:]
+        if len(data) == size or not self._open():
+            return data
+        while True:
+            done = self.done.is_set()
+            data += self._file.read(size - len(data))
+            if len(data) == size or done:
+                return data
+            time.sleep(self.poll_interval)
+
+    def read1(self, size: int) -> bytes:
+        """Read up to size bytes, waiting only until some are available.
+
+        :param size: maximum number of bytes to read
+        :return: bytes read - empty only if writing has finished and there is nothing left
+        """
+        if self._pushback:
+            data = self._pushback[:size]
+            self._pushback = self._pushback[size:]
+            return data
+        if not self._open():
+            return b''
+        while True:
+            done = self.done.is_set()
+            data = self._file.read(size)
+            if data or done:
+                return data
+            time.sleep(self.poll_interval)
+
+    def unread(self, data: bytes) -> None:
+        """Push data back, so that it is returned by the next read.
+
+        :param data: bytes to push back
+        """
+        self._pushback = data + self._pushback
+
+    def close(self) -> None:
+        """Close file."""
+        if self._file is not None:
+            self._file.close()
+
+    def __enter__(self) -> 'GrowingFile':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def _read_exactly(stream: GrowingFile, size: int) -> bytes:
+    data = stream.read(size)
+    if len(data) != size:
+        raise BasmatiError('Unexpected end of zip file')
+    return data
+
+
+def _zip64_sizes(extra: bytes, compressed_size: int, uncompressed_size: int) -> tuple:
+    # The zip64 extra field holds the sizes that are 0xFFFFFFFF in the header, uncompressed size first.
+    offset = 0
+    while offset + 4 <= len(extra):
+        header_id, data_size = struct.unpack('<HH', extra[offset:offset + 4])
+        if header_id == 0x0001:
+            values = extra[offset + 4:offset + 4 + data_size]
+            if uncompressed_size == 0xFFFFFFFF:
+                uncompressed_size, = struct.unpack('<Q', values[:8])
+                values = values[8:]
+            if compressed_size == 0xFFFFFFFF:
+                compressed_size, = struct.unpack('<Q', values[:8])
+            return compressed_size, uncompressed_size, True
+        offset += 4 + data_size
+    return compressed_size, uncompressed_size, False
+
+
+def _copy_member(stream: GrowingFile, out, method: int, compressed_size: Optional[int]) -> int:
+    # Copy (and decompress) one member's data from stream to out (if given). Returns CRC of uncompressed data.
+    crc = 0
+    if method == 0:
+        remaining = compressed_size
+        while remaining:
+            data = _read_exactly(stream, min(CHUNK_SIZE, remaining))
+            remaining -= len(data)
+            crc = zlib.crc32(data, crc)
+            if out:
+                out.write(data)
+        return crc
+
+    decompressor = zlib.decompressobj(-15)
+    remaining = compressed_size
+    while not decompressor.eof:
+        if remaining is None:
+            data = stream.read1(CHUNK_SIZE)
+            if not data:
+                raise BasmatiError('Unexpected end of zip file')
+        else:
+            if not remaining:
+                raise BasmatiError('Truncated deflate data in zip file')
+            data = _read_exactly(stream, min(CHUNK_SIZE, remaining))
+            remaining -= len(data)
+        chunk = decompressor.decompress(data)
+        crc = zlib.crc32(chunk, crc)
+        if out:
+            out.write(chunk)
+    if decompressor.unused_data:
+        # Only possible if the size was not known, i.e. these bytes belong to the data descriptor and beyond.
+        stream.unread(decompressor.unused_data)
+    return crc
+
+
+def extract_zip_stream(stream: GrowingFile, basedir: Union[str, Path],
+                       member_filter: Callable[[str], bool] = None,
+                       on_member: Callable[[Path], None] = None) -> List[Path]:
+    """Extract members of a zip file from stream, in the order that they are in the file.
+
+    Supports stored and deflated members, including those with data descriptors (sizes after the data). Each
+    member's CRC is checked, and it is written to a temporary file that is renamed when complete.
+
+    :param stream: zip file to read
+    :param basedir: directory to extract to
+    :param member_filter: called with the name of each member, and only members for which it returns True are
+        extracted (all if `None`)
+    :param on_member: called with the path of each member once it has been extracted
+    :raises: BasmatiError if the zip file is corrupt or uses unsupported features
+    :return: paths of extracted members
+    """
+    basedir = Path(basedir)
+    extracted = []
+    while True:
+        sig = stream.read(4)
+        if len(sig) < 4 or struct.unpack('<I', sig)[0] != LOCAL_HEADER_SIG:
+            # Reached central directory (or end of file).
+            break
+        (version, flags, method, mod_time, mod_date,
+         crc, compressed_size, uncompressed_size, name_len, extra_len) = LOCAL_HEADER.unpack(
+            _read_exactly(stream, LOCAL_HEADER.size))
+        name = _read_exactly(stream, name_len).decode('utf-8' if flags & 0x800 else 'cp437')
+        extra = _read_exactly(stream, extra_len)
+        compressed_size, uncompressed_size, zip64 = _zip64_sizes(extra, compressed_size, uncompressed_size)
+        has_descriptor = bool(flags & 0x08)
+
+        if flags & 0x01:
+            raise BasmatiError(f'Encrypted zip member not supported: {name}')
+        if method not in (0, 8):
+            raise BasmatiError(f'Unsupported compression method {method} for zip member: {name}')
+        if method == 0 and has_descriptor:
+            raise BasmatiError(f'Cannot stream stored zip member with data descriptor: {name}')
+
+        target = (basedir / name).resolve()
+        if basedir.resolve() not in target.parents:
+            raise BasmatiError(f'Zip member outside of {basedir}: {name}')
+        is_dir = name.endswith('/')
+        wanted = not is_dir and (member_filter is None or member_filter(name))
+        if is_dir:
+            target.mkdir(parents=True, exist_ok=True)
+
+        tmp_path = target.with_name(target.name + '.tmp')
+        out = None
+        if wanted:
+            logger.debug(f'Extracting {name}')
+            target.parent.mkdir(parents=True, exist_ok=True)
+            out = open(tmp_path, 'wb')
+        try:
+            try:
+                actual_crc = _copy_member(stream, out, method, None if has_descriptor else compressed_size)
+            finally:
+                if out:
+                    out.close()
+
+            if has_descriptor:
+                descriptor = _read_exactly(stream, 4)
+                if struct.unpack('<I', descriptor)[0] == DATA_DESCRIPTOR_SIG:
+                    descriptor = _read_exactly(stream, 4)
+                crc, = struct.unpack('<I', descriptor)
+                _read_exactly(stream, 16 if zip64 else 8)
+
+            if actual_crc != crc:
+                raise BasmatiError(f'CRC mismatch for zip member: {name}')
+            if wanted:
+                tmp_path.replace(target)
+        except BaseException:
+            # Never leave a partial member behind, whatever went wrong (including e.g. KeyboardInterrupt).
+            if wanted:
+                tmp_path.unlink(missing_ok=True)
+            raise
+
+        if wanted:
+            extracted.append(target)
+            if on_member:
+                on_member(target)
+    return extracted
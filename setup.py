@@ -28,6 +28,7 @@ setup(
     packages=[
         'basmati',
         'basmati.demo',
+        'basmati.bench',
         ],
     # scripts=[
     #     'bin/basmati',
@@ -37,7 +38,7 @@ setup(
             'basmati=basmati.basmati_cmd:basmati_cmd'
         ]
     },
-    python_requires='>=3.6',
+    python_requires='>=3.8',
     install_requires=[
         'numpy',
         'scipy',
@@ -46,11 +47,13 @@ setup(
         'rasterio',
         'matplotlib',
         'configparser',
-        'shapely',
+        'shapely>=2',
         ],
     extras_require={
         'testing': ['nose', 'mock'],
         'analysis': ['iris'],
+        'cache': ['pyarrow'],
+        'lazy': ['dask'],
     },
     package_data={'basmati.demo': ['schiemann2018mean_supplementary_tableS1.csv']},
     url='https://github.com/markmuetz/basmati',
@@ -59,7 +62,7 @@ setup(
         'Intended Audience :: Science/Research',
         'Natural Language :: English',
         'Operating System :: POSIX :: Linux',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.8',
         'Topic :: Scientific/Engineering :: Atmospheric Science',
         ],
     keywords=[''],